@@ -22,6 +22,7 @@ from neutron.common import utils as n_utils
 from oslo_config import cfg
 from oslo_log import log as logging
 
+from quark.agent import stats
 from quark.agent import xapi
 from quark.cache import security_groups_client as sg_cli
 
@@ -32,7 +33,19 @@ agent_opts = [
     cfg.IntOpt("polling_interval",
                default=10,
                help=_("Number of seconds to wait between poll iterations of "
-                      "XAPI and the configured security groups registry."))
+                      "XAPI and the configured security groups registry.")),
+    cfg.BoolOpt("listen_for_changes",
+                default=False,
+                help=_("Apply rule changes as they are published by the "
+                       "security groups registry instead of reading the "
+                       "state of every VIF each poll iteration. XAPI is "
+                       "still asked for VIF changes every "
+                       "polling_interval.")),
+    cfg.IntOpt("reconcile_interval",
+               default=300,
+               help=_("With listen_for_changes, number of seconds between "
+                      "full passes over the registry state of every VIF, "
+                      "catching any change whose notification was missed."))
 ]
 
 CONF.register_opts(agent_opts, "AGENT")
@@ -91,42 +104,196 @@ def ack_groups(client, groups):
         client.update_group_states_for_vifs(groups, True)
 
 
+def publish_host_vifs(client, host, interfaces, published):
+    """Replaces the host's VIF set in redis if interfaces changed.
+
+    Returns the set of VIF keys now published for the host.
+    """
+    vif_keys = set(client.vif_key(vif.device_id, vif.mac_address)
+                   for vif in interfaces)
+    if vif_keys != published:
+        client.set_host_vifs(host, vif_keys)
+    return vif_keys
+
+
+def observe_propagation(groups_client, agent_stats, vifs):
+    """Records how long ago the rules now applied to vifs were written."""
+    if not vifs:
+        return
+    now = time.time()
+    try:
+        written_at = groups_client.get_rules_written_at(vifs)
+    except Exception:
+        LOG.exception("Unable to get rule write times from the registry")
+        return
+    for value in written_at:
+        if value:
+            agent_stats.observe_latency(now - float(value))
+
+
+def apply_changes(groups_client, xapi_client, interfaces, agent_stats):
+    with agent_stats.phase("states"):
+        sg_states = groups_client.get_security_group_states(interfaces)
+    with agent_stats.phase("partition"):
+        new_sg, updated_sg, removed_sg = partition_vifs(xapi_client,
+                                                        interfaces,
+                                                        sg_states)
+    agent_stats.count_changes(new_sg, updated_sg, removed_sg)
+    with agent_stats.phase("apply"):
+        xapi_client.update_interfaces(new_sg, updated_sg, removed_sg)
+    groups_to_ack = [v for v in new_sg + updated_sg if v.success]
+    with agent_stats.phase("ack"):
+        ack_groups(groups_client, groups_to_ack)
+    # NOTE: VIFs self-healing from an ack'd state carry old rules, only
+    #       newly written ones say anything about propagation latency
+    observe_propagation(groups_client, agent_stats,
+                        [v for v in groups_to_ack if sg_states[v] is False])
+
+
+class ChangeListener(object):
+    """Applies rule changes to VIFs as the registry publishes them.
+
+    Only the channels of this host's VIFs are subscribed to. Only VIFs
+    whose keys were published as changed, and VIFs XAPI reports as added
+    or modified, are re-read from the registry and re-partitioned. Every
+    reconcile_interval, and after any lost subscription or failed pass,
+    every VIF is checked as a fallback for missed notifications.
+    """
+
+    def __init__(self, groups_client, xapi_client, agent_stats=None):
+        self.groups_client = groups_client
+        self.xapi_client = xapi_client
+        self.stats = agent_stats or stats.AgentStats()
+        self.interfaces = {}
+        self.published = None
+        self._pubsub = None
+        self._subscribed = set()
+        self._next_poll = 0
+        self._next_reconcile = 0
+
+    def _refresh_interfaces(self):
+        with self.stats.phase("xapi"):
+            interfaces, changed = self.xapi_client.get_interface_changes()
+        self.stats.interfaces = len(interfaces)
+        self.interfaces = dict(
+            (self.groups_client.vif_key(vif.device_id, vif.mac_address), vif)
+            for vif in interfaces)
+        # NOTE: subscribe before any new VIF's rules are read, so a write
+        #       in between is not missed
+        try:
+            self._subscribed = self.groups_client.update_vif_subscriptions(
+                self._pubsub, self._subscribed, self.interfaces)
+        except Exception:
+            self._pubsub = None
+            raise
+        try:
+            self.published = publish_host_vifs(
+                self.groups_client, self.xapi_client.host_uuid, interfaces,
+                self.published)
+        except Exception:
+            LOG.exception("Unable to publish this host's VIFs to the "
+                          "registry")
+        return changed
+
+    def run_once(self):
+        if self._pubsub is None:
+            self._pubsub = self.groups_client.subscribe_vif_changes(
+                self.interfaces)
+            self._subscribed = set(self.interfaces)
+            # Anything published while unsubscribed was missed
+            self._next_reconcile = 0
+
+        timeout = max(self._next_poll - time.time(), 0)
+        try:
+            changed = self.groups_client.get_vif_changes(self._pubsub,
+                                                         timeout)
+        except Exception:
+            self._pubsub = None
+            raise
+
+        self.stats.start_cycle()
+        try:
+            self._apply(changed)
+        except Exception:
+            # The changes received are lost with this pass, so check
+            # everything on the next one
+            self._next_reconcile = 0
+            raise
+        finally:
+            self.stats.end_cycle()
+
+    def _apply(self, changed):
+        to_check = set()
+        now = time.time()
+        if now >= self._next_poll:
+            to_check.update(self._refresh_interfaces())
+            self._next_poll = (now + CONF.AGENT.polling_interval +
+                               random.random() * 2)
+        to_check.update(self.interfaces[key] for key in changed
+                        if key in self.interfaces)
+        if now >= self._next_reconcile:
+            to_check = set(self.interfaces.values())
+            self._next_reconcile = now + CONF.AGENT.reconcile_interval
+
+        if to_check:
+            LOG.debug("Applying security groups to %d VIF(s)" %
+                      len(to_check))
+            apply_changes(self.groups_client, self.xapi_client, to_check,
+                          self.stats)
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                LOG.exception("Unable to apply security group changes from "
+                              "the registry to xapi")
+                _sleep()
+
+
 def run():
     """Fetches changes and applies them to VIFs periodically
 
     Process as of RM11449:
     * Get all groups from redis
     * Fetch ALL VIFs from Xen
+    * Publish this hypervisor's VIF keys to redis if they changed
     * Walk ALL VIFs and partition them into added, updated and removed
     * Walk the final "modified" VIFs list and apply flows to each
     """
     groups_client = sg_cli.SecurityGroupsClient()
     xapi_client = xapi.XapiClient()
+    agent_stats = stats.AgentStats()
 
     interfaces = set()
+    published = None
     while True:
+        agent_stats.start_cycle()
         try:
-            interfaces = xapi_client.get_interfaces()
+            with agent_stats.phase("xapi"):
+                interfaces = xapi_client.get_interfaces()
+            agent_stats.interfaces = len(interfaces)
         except Exception:
             LOG.exception("Unable to get instances/interfaces from xapi")
+            agent_stats.end_cycle()
             _sleep()
             continue
 
         try:
-            sg_states = groups_client.get_security_group_states(interfaces)
-            new_sg, updated_sg, removed_sg = partition_vifs(xapi_client,
-                                                            interfaces,
-                                                            sg_states)
-            xapi_client.update_interfaces(new_sg, updated_sg, removed_sg)
-            groups_to_ack = [v for v in new_sg + updated_sg if v.success]
-            ack_groups(groups_client, groups_to_ack)
+            published = publish_host_vifs(groups_client,
+                                          xapi_client.host_uuid,
+                                          interfaces, published)
+        except Exception:
+            LOG.exception("Unable to publish this host's VIFs to the "
+                          "registry")
 
+        try:
+            apply_changes(groups_client, xapi_client, interfaces,
+                          agent_stats)
         except Exception:
             LOG.exception("Unable to get security groups from registry and "
                           "apply them to xapi")
-            _sleep()
-            continue
-
+        agent_stats.end_cycle()
         _sleep()
 
 
@@ -138,4 +305,8 @@ def main():
         sys.exit(_("ERROR: Unable to find configuration file via the default"
                    " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
                    " the '--config-file' option!"))
-    run()
+    if CONF.AGENT.listen_for_changes:
+        ChangeListener(sg_cli.SecurityGroupsClient(),
+                       xapi.XapiClient()).run()
+    else:
+        run()
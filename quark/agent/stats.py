@@ -0,0 +1,171 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per-cycle timings and counters for the security groups agent
+"""
+
+import bisect
+import contextlib
+import os
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+agent_opts = [
+    cfg.StrOpt("stats_file",
+               help=_("Path the agent rewrites after every cycle with its "
+                      "timings and counters in the Prometheus text format, "
+                      "e.g. for the node exporter textfile collector. "
+                      "Unset disables it.")),
+]
+
+CONF.register_opts(agent_opts, "AGENT")
+
+PHASES = ("xapi", "states", "partition", "apply", "ack")
+CHANGES = ("added", "updated", "removed")
+# NOTE: propagation latency is measured from the API server's clock to the
+#       hypervisor's, so it is only as good as their clock sync
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class AgentStats(object):
+    """Phase timings of the last cycle and counters since the agent started.
+
+    Wrap each phase of a cycle in phase(), between start_cycle() and
+    end_cycle(). A phase that raises counts as a failure of that phase.
+    """
+
+    def __init__(self):
+        self.cycles = 0
+        self.interfaces = 0
+        self.last_cycle = {}
+        self.last_cycle_at = None
+        self.last_changes = dict((change, 0) for change in CHANGES)
+        self.changes = dict((change, 0) for change in CHANGES)
+        self.failures = dict((phase, 0) for phase in PHASES)
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self._current = {}
+        self._current_changes = {}
+
+    def start_cycle(self):
+        self._current = {}
+        self._current_changes = dict((change, 0) for change in CHANGES)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.failures[name] += 1
+            raise
+        finally:
+            self._current[name] = (self._current.get(name, 0) +
+                                   time.time() - start)
+
+    def count_changes(self, added, updated, removed):
+        for change, vifs in zip(CHANGES, (added, updated, removed)):
+            self._current_changes[change] += len(vifs)
+            self.changes[change] += len(vifs)
+
+    def observe_latency(self, seconds):
+        seconds = max(seconds, 0)
+        idx = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if idx < len(LATENCY_BUCKETS):
+            self.latency_buckets[idx] += 1
+        self.latency_sum += seconds
+        self.latency_count += 1
+
+    def end_cycle(self):
+        self.cycles += 1
+        self.last_cycle = self._current
+        self.last_changes = self._current_changes
+        self.last_cycle_at = time.time()
+        LOG.debug("Agent cycle %d: %s, %s" % (
+            self.cycles,
+            ", ".join("%s %.3fs" % (phase, self.last_cycle[phase])
+                      for phase in PHASES if phase in self.last_cycle),
+            ", ".join("%d %s" % (self.last_changes[change], change)
+                      for change in CHANGES)))
+        self.write()
+
+    def render(self):
+        lines = []
+
+        def _metric(name, kind, help, samples):
+            lines.append("# HELP quark_agent_%s %s" % (name, help))
+            lines.append("# TYPE quark_agent_%s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("quark_agent_%s%s %r" % (name, labels, value))
+
+        _metric("cycles_total", "counter", "Agent cycles run.",
+                [("", self.cycles)])
+        _metric("last_cycle_timestamp_seconds", "gauge",
+                "When the last cycle ended.",
+                [("", self.last_cycle_at or 0)])
+        _metric("interfaces", "gauge", "VIFs of instances on this host.",
+                [("", self.interfaces)])
+        _metric("phase_seconds", "gauge",
+                "Time spent in each phase of the last cycle.",
+                [('{phase="%s"}' % phase, self.last_cycle.get(phase, 0))
+                 for phase in PHASES])
+        _metric("phase_failures_total", "counter",
+                "Cycles in which a phase failed.",
+                [('{phase="%s"}' % phase, self.failures[phase])
+                 for phase in PHASES])
+        _metric("last_cycle_vifs", "gauge",
+                "VIFs added, updated or removed in the last cycle.",
+                [('{change="%s"}' % change, self.last_changes[change])
+                 for change in CHANGES])
+        _metric("vifs_total", "counter", "VIFs added, updated or removed.",
+                [('{change="%s"}' % change, self.changes[change])
+                 for change in CHANGES])
+
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            cumulative += count
+            buckets.append(('{le="%s"}' % bound, cumulative))
+        buckets.append(('{le="+Inf"}', self.latency_count))
+        _metric("rule_propagation_seconds", "histogram",
+                "Time from a rule write to its flows being applied.", [])
+        for labels, value in buckets:
+            lines.append("quark_agent_rule_propagation_seconds_bucket%s %s" %
+                         (labels, value))
+        lines.append("quark_agent_rule_propagation_seconds_sum %r" %
+                     self.latency_sum)
+        lines.append("quark_agent_rule_propagation_seconds_count %s" %
+                     self.latency_count)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        """Atomically replaces path, or AGENT.stats_file, with render()."""
+        path = path or CONF.AGENT.stats_file
+        if not path:
+            return
+        tmp_path = "%s.tmp" % path
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(self.render())
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            LOG.exception("Failed to write agent stats to %s" % path)
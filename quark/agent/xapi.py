@@ -15,6 +15,9 @@
 
 from collections import namedtuple
 import contextlib
+import itertools
+import threading
+import time
 
 from oslo_config import cfg
 from oslo_log import log as logging
@@ -28,12 +31,28 @@ agent_opts = [
     cfg.StrOpt("xapi_connection_url"),
     cfg.StrOpt("xapi_connection_username", default="root"),
     cfg.IntOpt("xapi_enable_groups_retries", default=5),
-    cfg.StrOpt("xapi_connection_password")
+    cfg.StrOpt("xapi_connection_password"),
+    cfg.IntOpt("xapi_flow_workers",
+               default=4,
+               help=_("Number of XAPI sessions used in parallel to tag VIFs "
+                      "and refresh their flows when more than one VIF "
+                      "changed. 1 applies every VIF in turn on the main "
+                      "session."))
 ]
 
 CONF.register_opts(agent_opts, "AGENT")
 SECURITY_GROUPS_KEY = "security_groups"
 VM = namedtuple('VM', ['ref', 'uuid', 'vifs', 'dom_id'])
+EVENT_CLASSES = ["VM", "VIF"]
+
+
+def _is_instance(rec):
+    # NOTE(asadoughi): Copied from xen-networking-scripts/utils.py
+    return (rec['power_state'].lower() == 'running' and
+            not rec['is_a_template'] and
+            not rec['is_control_domain'] and
+            ('nova_uuid' in rec['other_config'] or
+             rec['name_label'].startswith('instance-')))
 
 
 class VIF(object):
@@ -93,11 +112,25 @@ class XapiClient(object):
     SECURITY_GROUPS_VALUE = "enabled"
 
     def __init__(self):
+        self._xapi_session = None
+        # VM records of running instances and all VIF records by OpaqueRef,
+        # kept current from the event.from token in _event_token
+        self._event_token = None
+        self._vm_records = {}
+        self._vif_records = {}
+        self._changed_vifs = set()
+        self._worker_sessions = []
+        self.last_update_stats = None
+
         with self.sessioned() as session:
             self._host_ref = session.xenapi.session.get_this_host(
                 session.handle)
             self._host_uuid = session.xenapi.host.get_uuid(self._host_ref)
 
+    @property
+    def host_uuid(self):
+        return self._host_uuid
+
     def _session(self):
         LOG.debug("Created new Xapi session")
 
@@ -108,32 +141,37 @@ class XapiClient(object):
 
     @contextlib.contextmanager
     def sessioned(self):
-        session = None
+        """Yields the long-lived XAPI session, logging in on first use.
+
+        Any exception discards the session, so the next call logs in
+        afresh, and forces a full reload of the record cache.
+        """
         try:
-            session = self._session()
-            yield session
+            if self._xapi_session is None:
+                self._xapi_session = self._session()
+            yield self._xapi_session
         except Exception:
-            LOG.exception("Failed to create a XAPI session")
+            LOG.exception("Failed to create or use a XAPI session")
+            self._logout()
             raise
-        finally:
-            if session is not None:
+
+    def _logout(self):
+        session, self._xapi_session = self._xapi_session, None
+        self._event_token = None
+        if session is not None:
+            try:
                 session.xenapi.session.logout()
+            except Exception:
+                LOG.debug("Failed to log out of a XAPI session")
 
     def get_instances(self, session):
         """Returns a dict of `VM OpaqueRef` (str) -> `xapi.VM`."""
         LOG.debug("Getting instances from Xapi")
 
         recs = session.xenapi.VM.get_all_records()
-
-        # NOTE(asadoughi): Copied from xen-networking-scripts/utils.py
-        is_inst = lambda r: (r['power_state'].lower() == 'running' and
-                             not r['is_a_template'] and
-                             not r['is_control_domain'] and
-                             ('nova_uuid' in r['other_config'] or
-                              r['name_label'].startswith('instance-')))
         instances = dict()
         for vm_ref, rec in recs.iteritems():
-            if not is_inst(rec):
+            if not _is_instance(rec):
                 continue
             instances[vm_ref] = VM(ref=vm_ref,
                                    uuid=rec["other_config"]["nova_uuid"],
@@ -141,23 +179,68 @@ class XapiClient(object):
                                    dom_id=rec["domid"])
         return instances
 
-    def get_interfaces(self):
-        """Returns a set of VIFs from `get_instances` return value."""
-        LOG.debug("Getting interfaces from Xapi")
-
-        with self.sessioned() as session:
-            instances = self.get_instances(session)
-            recs = session.xenapi.VIF.get_all_records()
+    def _update_records(self, session):
+        """Applies VM and VIF events since the last call to the cache.
 
+        The first call, or the first after a failure, passes an empty token
+        and so gets every current record as an add event.
+        """
+        if self._event_token is None:
+            self._vm_records = {}
+            self._vif_records = {}
+        # NOTE: from is a python keyword, hence the getattr
+        result = getattr(session.xenapi.event, "from")(
+            EVENT_CLASSES, self._event_token or "", 0.0)
+
+        for event in result["events"]:
+            ref = event["ref"]
+            deleted = event["operation"] == "del" or "snapshot" not in event
+            if event["class"].lower() == "vm":
+                if deleted or not _is_instance(event["snapshot"]):
+                    vm_rec = self._vm_records.pop(ref, None)
+                else:
+                    vm_rec = self._vm_records[ref] = event["snapshot"]
+                if vm_rec:
+                    self._changed_vifs.update(vm_rec["VIFs"])
+            elif event["class"].lower() == "vif":
+                if deleted:
+                    self._vif_records.pop(ref, None)
+                else:
+                    self._vif_records[ref] = event["snapshot"]
+                self._changed_vifs.add(ref)
+        self._event_token = result["token"]
+        LOG.debug("Applied %d XAPI event(s)" % len(result["events"]))
+
+    def _interfaces(self, vif_refs):
         interfaces = set()
-        for vif_ref, rec in recs.iteritems():
-            vm = instances.get(rec["VM"])
-            if not vm:
+        for vif_ref in vif_refs:
+            rec = self._vif_records.get(vif_ref)
+            vm_rec = rec and self._vm_records.get(rec["VM"])
+            if not vm_rec:
                 continue
-            device_id = vm.uuid
+            device_id = vm_rec["other_config"]["nova_uuid"]
             interfaces.add(VIF(device_id, rec, vif_ref))
         return interfaces
 
+    def get_interface_changes(self):
+        """Returns all VIFs and the VIFs changed since the last call.
+
+        Only VM and VIF events since the last call are fetched from XAPI.
+        The changed VIFs are those added or modified, or whose VM was.
+        """
+        LOG.debug("Getting interface changes from Xapi")
+
+        with self.sessioned() as session:
+            self._update_records(session)
+
+        changed, self._changed_vifs = self._changed_vifs, set()
+        return (self._interfaces(self._vif_records.keys()),
+                self._interfaces(changed))
+
+    def get_interfaces(self):
+        """Returns the set of VIFs of running instances."""
+        return self.get_interface_changes()[0]
+
     def _set_security_groups(self, session, interfaces):
         LOG.debug("Setting security groups on %s", interfaces)
 
@@ -166,6 +249,8 @@ class XapiClient(object):
                 session.xenapi.VIF.add_to_other_config(
                     vif.ref, SECURITY_GROUPS_KEY,
                     self.SECURITY_GROUPS_VALUE)
+                vif.record.setdefault("other_config", {})[
+                    SECURITY_GROUPS_KEY] = self.SECURITY_GROUPS_VALUE
             except XenAPI.Failure:
                 # We shouldn't lose all of them because one failed
                 # An example of a continuable failure is the VIF was deleted
@@ -182,6 +267,8 @@ class XapiClient(object):
                 session.xenapi.VIF.remove_from_other_config(
                     vif.ref,
                     SECURITY_GROUPS_KEY)
+                vif.record.get("other_config", {}).pop(SECURITY_GROUPS_KEY,
+                                                       None)
             except XenAPI.Failure:
                 # NOTE(mdietz): RM11399 - removing a parameter that doesn't
                 #               exist is idempotent. Trying to remove it
@@ -191,38 +278,129 @@ class XapiClient(object):
                 LOG.exception("Failed to disable security groups for VIF "
                               "with MAC %s" % vif.mac_address)
 
+    def _flow_args(self, session, vif):
+        """Returns the flow plugin arguments for vif.
+
+        Uses the VIF and VM records already cached from XAPI events where
+        possible, only fetching them for VIFs not seen through the cache.
+        """
+        vm_rec = self._vm_records.get(vif.record.get("VM"))
+        if vm_rec is not None and "device" in vif.record:
+            return {"dom_id": vm_rec["domid"],
+                    "vif_index": vif.record["device"]}
+        vif_rec = session.xenapi.VIF.get_record(vif.ref)
+        vm_rec = session.xenapi.VM.get_record(vif_rec["VM"])
+        return {"dom_id": vm_rec["domid"], "vif_index": vif_rec["device"]}
+
     def _refresh_interfaces(self, session, interfaces):
+        """Refreshes the flows of interfaces, returning per-VIF timings."""
         LOG.debug("Refreshing devices on %s", interfaces)
 
+        timings = []
         for vif in interfaces:
             try:
-                vif_rec = session.xenapi.VIF.get_record(vif.ref)
-                vm_rec = session.xenapi.VM.get_record(vif_rec["VM"])
-                vif_index = vif_rec["device"]
-                dom_id = vm_rec["domid"]
-                vif.succeed()
+                args = self._flow_args(session, vif)
             except XenAPI.Failure:
                 LOG.exception("Failure when looking up VMs or VIFs")
                 continue
 
-            args = {"dom_id": dom_id, "vif_index": vif_index}
-            session.xenapi.host.call_plugin(
-                self._host_ref,
-                "neutron_vif_flow",
-                "online_instance_flows",
-                args)
+            start = time.time()
+            try:
+                session.xenapi.host.call_plugin(
+                    self._host_ref,
+                    "neutron_vif_flow",
+                    "online_instance_flows",
+                    args)
+            except XenAPI.Failure:
+                LOG.exception("Failed to refresh flows for VIF with MAC %s" %
+                              vif.mac_address)
+                continue
+            elapsed = time.time() - start
+            LOG.debug("Refreshed flows for VIF %s in %.3fs" % (vif, elapsed))
+            timings.append(elapsed)
+            vif.succeed()
+        return timings
+
+    def _update_some_interfaces(self, session, added_sg, updated_sg,
+                                removed_sg):
+        self._set_security_groups(session, added_sg)
+        self._unset_security_groups(session, removed_sg)
+        return self._refresh_interfaces(session,
+                                        added_sg + updated_sg + removed_sg)
+
+    def _update_interfaces_parallel(self, workers, added_sg, updated_sg,
+                                    removed_sg):
+        """Spreads the VIFs over workers threads, each on its own session.
+
+        An XAPI session is not safe to share between threads, so every
+        worker keeps a session of its own across calls. A worker that fails
+        drops its session and logs in again next time.
+        """
+        self._worker_sessions.extend(
+            [None] * (workers - len(self._worker_sessions)))
+        results = [[] for _ in xrange(workers)]
+        combined = ([(vif, "added") for vif in added_sg] +
+                    [(vif, "updated") for vif in updated_sg] +
+                    [(vif, "removed") for vif in removed_sg])
+
+        def _work(i):
+            share = combined[i::workers]
+            session = self._worker_sessions[i]
+            try:
+                if session is None:
+                    session = self._worker_sessions[i] = self._session()
+                results[i] = self._update_some_interfaces(
+                    session,
+                    [vif for vif, change in share if change == "added"],
+                    [vif for vif, change in share if change == "updated"],
+                    [vif for vif, change in share if change == "removed"])
+            except Exception:
+                LOG.exception("XAPI worker %d failed to update interfaces" %
+                              i)
+                self._worker_sessions[i] = None
+                if session is not None:
+                    try:
+                        session.xenapi.session.logout()
+                    except Exception:
+                        LOG.debug("Failed to log out of a XAPI session")
+
+        threads = [threading.Thread(target=_work, args=(i,))
+                   for i in xrange(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return list(itertools.chain(*results))
 
     def update_interfaces(self, added_sg, updated_sg, removed_sg):
         """Handles changes to interfaces' security groups
 
         Calls refresh_interfaces on argument VIFs. Set security groups on
         added_sg's VIFs. Unsets security groups on removed_sg's VIFs.
+        Several VIFs are spread over up to xapi_flow_workers sessions.
         """
         if not (added_sg or updated_sg or removed_sg):
             return
 
-        with self.sessioned() as session:
-            self._set_security_groups(session, added_sg)
-            self._unset_security_groups(session, removed_sg)
-            combined = added_sg + updated_sg + removed_sg
-            self._refresh_interfaces(session, combined)
+        added_sg, updated_sg, removed_sg = (list(added_sg), list(updated_sg),
+                                            list(removed_sg))
+        count = len(added_sg) + len(updated_sg) + len(removed_sg)
+        workers = max(min(CONF.AGENT.xapi_flow_workers, count), 1)
+        start = time.time()
+        if workers == 1:
+            with self.sessioned() as session:
+                timings = self._update_some_interfaces(
+                    session, added_sg, updated_sg, removed_sg)
+        else:
+            timings = self._update_interfaces_parallel(
+                workers, added_sg, updated_sg, removed_sg)
+
+        self.last_update_stats = dict(
+            vifs=count, refreshed=len(timings), workers=workers,
+            seconds=time.time() - start,
+            max_flow_seconds=max(timings) if timings else 0,
+            mean_flow_seconds=sum(timings) / len(timings) if timings else 0)
+        LOG.info("Refreshed flows for %(refreshed)d of %(vifs)d VIF(s) with "
+                 "%(workers)d worker(s) in %(seconds).3fs, slowest "
+                 "%(max_flow_seconds).3fs, mean %(mean_flow_seconds).3fs" %
+                 self.last_update_stats)
@@ -17,6 +17,8 @@ import netaddr
 from neutron.common import exceptions
 from oslo_log import log as logging
 
+from quark import policy_ranges
+
 LOG = logging.getLogger(__name__)
 
 
@@ -131,8 +133,12 @@ class AllocationPools(object):
             # allocatable
             cidrset = netaddr.IPSet()
 
-        for p in self._policies:
-            cidrset.add(netaddr.IPNetwork(p))
+        if isinstance(self._policies, policy_ranges.PolicyRanges):
+            for ip_range in self._policies.ip_ranges(version):
+                cidrset |= netaddr.IPSet(ip_range.cidrs())
+        else:
+            for p in self._policies:
+                cidrset.add(netaddr.IPNetwork(p))
 
         self._exclude_cidrs = cidrset
 
@@ -149,8 +155,13 @@ class AllocationPools(object):
         self._policies.append(policy)
 
     def validate_gateway_excluded(self, gateway_ip):
-        self._refresh_excludes()
         gateway_ip_addr = netaddr.IPAddress(gateway_ip)
+        if (isinstance(self._policies, policy_ranges.PolicyRanges) and
+                gateway_ip_addr in self._policies):
+            # Excluded by policy, no need to build the full exclude set
+            return
+
+        self._refresh_excludes()
         if gateway_ip_addr in self._subnet_cidr:
             if (not self._exclude_cidrs or
                     (self._exclude_cidrs and gateway_ip_addr
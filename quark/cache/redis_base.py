@@ -15,6 +15,7 @@
 
 import functools
 import json
+import os
 import string
 
 import netaddr
@@ -30,6 +31,7 @@ CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 MAC_TRANS_TABLE = string.maketrans(string.ascii_uppercase,
                                    string.ascii_lowercase)
+VIF_KEY_PATTERN = "*.????????????"
 
 quark_opts = [
     cfg.ListOpt("redis_sentinel_hosts",
@@ -47,7 +49,11 @@ quark_opts = [
                help=("The database number to use")),
     cfg.FloatOpt("redis_socket_timeout",
                  default=0.1,
-                 help=("Timeout for Redis socket operations"))]
+                 help=("Timeout for Redis socket operations")),
+    cfg.IntOpt("redis_scan_count",
+               default=1000,
+               help=_("COUNT hint given to each SCAN when listing VIF keys, "
+                      "and the number of keys checked per pipeline"))]
 
 CONF.register_opts(quark_opts, "QUARK")
 
@@ -58,24 +64,52 @@ CONF.register_opts(quark_opts, "QUARK")
 #               we connect to a slave, we connect by telling it
 #               we want a slave and ending up with a connection,
 #               with no control over SSL or anything else.  :-|
+# NOTE: Connections are pooled per client class for now, see
+#       ClientBase.connection_pool.
 
 
 def handle_connection_error(fn):
     @functools.wraps(fn)
-    def wrapped(*args, **kwargs):
+    def wrapped(self, *args, **kwargs):
         try:
-            return fn(*args, **kwargs)
+            return fn(self, *args, **kwargs)
         except TwiceRedis.generic_error as e:
             LOG.exception(e)
+            # NOTE: pooled connections may point at a master sentinel has
+            #       since demoted, make the next call start afresh
+            self.disconnect()
             raise q_exc.RedisConnectionFailure()
     return wrapped
 
 
 class ClientBase(object):
+    # NOTE: The TwiceRedis client owns the master and slave connection
+    #       pools. It is shared by every client of a class in the process,
+    #       so connections are reused between calls rather than set up and
+    #       torn down around every write. A forked child, e.g. an API
+    #       worker, must not share the parent's sockets, so the client is
+    #       created again whenever the pid changes.
+    connection_pool = None
+    connection_pool_pid = None
+
     def __init__(self):
-        self._client = self.get_redis_client()
+        self.get_redis_client()
+
+    @property
+    def _client(self):
+        return self.get_redis_client()
 
     def get_redis_client(self):
+        cls = type(self)
+        pid = os.getpid()
+        if cls.connection_pool is None or cls.connection_pool_pid != pid:
+            # NOTE: the parent's client is dropped, not disconnected, as
+            #       that would shut down the sockets the parent still uses
+            cls.connection_pool = self._create_redis_client()
+            cls.connection_pool_pid = pid
+        return cls.connection_pool
+
+    def _create_redis_client(self):
         sentinels = [tuple(str.split(host_pair, ':'))
                      for host_pair in CONF.QUARK.redis_sentinel_hosts]
 
@@ -93,31 +127,52 @@ class ClientBase(object):
         mac = mac.translate(MAC_TRANS_TABLE, ":-")
         return "{0}.{1}".format(device_id, mac)
 
+    def disconnect(self):
+        for client in (self._client.master, self._client.slave):
+            try:
+                client.disconnect()
+            except Exception:
+                LOG.exception("Failed to disconnect from redis")
+
     @handle_connection_error
     def ping(self):
-        # NOTE(tr3buchet): if this gets used by anything other than the
-        #                  redis_sg_tool, self._client.disconnect()
-        #                  needs to be called before returning
         return self._client.master.ping() and self._client.slave.ping()
 
-    @handle_connection_error
     def vif_keys(self, field=None):
-        keys = self._client.slave.keys("*.????????????")
-        filtered = []
-        if isinstance(keys, str):
-            keys = [keys]
+        return list(self.iter_vif_keys(field=field))
+
+    def iter_vif_keys(self, field=None, count=None):
+        """Yields VIF keys, optionally only those holding field.
+
+        Walks the keyspace on the slave with SCAN rather than KEYS, so redis
+        is never blocked for the whole keyspace and only one batch of keys
+        is held at a time. With a field, each batch is checked with HEXISTS
+        in a single pipeline. As with any SCAN, a key may be yielded more
+        than once if the keyspace is rehashed mid-walk.
+        """
+        count = count or CONF.QUARK.redis_scan_count
+        cursor = 0
+        while True:
+            cursor, keys = self._scan_vif_keys(cursor, count)
+            if keys and field:
+                keys = self._filter_vif_keys(keys, field)
+            for key in keys:
+                yield key
+            if not int(cursor):
+                return
+
+    @handle_connection_error
+    def _scan_vif_keys(self, cursor, count):
+        return self._client.slave.scan(cursor, match=VIF_KEY_PATTERN,
+                                       count=count)
+
+    @handle_connection_error
+    def _filter_vif_keys(self, keys, field):
         with self._client.slave.pipeline() as pipe:
             for key in keys:
-                value = None
-                if field:
-                    value = pipe.hget(key, field)
-                else:
-                    value = pipe.hgetall(key)
-            values = pipe.execute()
-        for value in values:
-            if value:
-                filtered.append(key)
-        return filtered
+                pipe.hexists(key, field)
+            exists = pipe.execute()
+        return [key for key, present in zip(keys, exists) if present]
 
     @handle_connection_error
     def set_field(self, key, field, data):
@@ -126,21 +181,18 @@ class ClientBase(object):
     @handle_connection_error
     def set_field_raw(self, key, field, data):
         self._client.master.hset(key, field, data)
-        self._client.master.disconnect()
 
     @handle_connection_error
     def get_field(self, key, field):
         return self._client.slave.hget(key, field)
 
     @handle_connection_error
-    def delete_field(self, key, field):
-        self._client.master.hdel(key, field)
-        self._client.master.disconnect()
+    def delete_field(self, key, *fields):
+        self._client.master.hdel(key, *fields)
 
     @handle_connection_error
     def delete_key(self, key):
         self._client.master.delete(key)
-        self._client.master.disconnect()
 
     @handle_connection_error
     def get_fields(self, keys, field):
@@ -156,4 +208,3 @@ class ClientBase(object):
             for key in keys:
                 pipe.hset(key, field, value)
             pipe.execute()
-        self._client.master.disconnect()
@@ -14,6 +14,7 @@
 #
 
 import json
+import time
 
 import netaddr
 from oslo_config import cfg
@@ -22,6 +23,7 @@ from oslo_log import log as logging
 from quark.cache import redis_base
 from quark.environment import Capabilities
 from quark import exceptions as q_exc
+from quark import lru_cache
 from quark import protocols
 from quark import utils
 
@@ -31,10 +33,52 @@ LOG = logging.getLogger(__name__)
 SECURITY_GROUP_RULE_KEY = "rules"
 SECURITY_GROUP_HASH_ATTR = "security group rules"
 SECURITY_GROUP_ACK = "security group ack"
+SECURITY_GROUP_WRITTEN_AT = "security group written at"
+
+# NOTE: neither index key matches redis_base.VIF_KEY_PATTERN, so the sets
+#       never show up as VIFs in a keyspace SCAN
+VIF_INDEX_KEY = "quark:vifs"
+HOST_VIF_INDEX_KEY = "quark:vifs:host:%s"
+# Every rule write or delete publishes the VIF key on the VIF's own
+# channel, so agents that listen for changes rather than polling every VIF
+# only hear about the VIFs on their host
+VIF_CHANGES_CHANNEL = "quark:vifs:changes:%s"
 
 ALL_V4 = netaddr.IPNetwork("::ffff:0.0.0.0/96")
 ALL_V6 = netaddr.IPNetwork("::/0")
 
+quark_opts = [
+    cfg.IntOpt("security_group_rules_cache_size",
+               default=4096,
+               help=_("Number of serialized security groups each process "
+                      "keeps in memory. 0 disables the cache."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+class SerializedGroupCache(lru_cache.LRUCache):
+    """Bounded LRU of serialized group rules keyed by (group id, revision).
+
+    SecurityGroup.revision is bumped in the database on every rule create
+    and delete, so an entry is never stale: a changed group is looked up
+    under its new revision and the old entry ages out. Groups that have not
+    been persisted yet carry no revision and are never cached. Cached lists
+    are shared between callers and must not be mutated.
+    """
+
+    size_opt = ("QUARK", "security_group_rules_cache_size")
+
+    def get(self, group, build):
+        """Returns the group's serialized rules, calling build() on a miss."""
+        group_id, revision = group.get("id"), group.get("revision")
+        if group_id is None or revision is None:
+            return build()
+        return self.get_or_build((group_id, revision), build)
+
+
+SERIALIZED_GROUP_CACHE = SerializedGroupCache()
+
 
 class SecurityGroupsClient(redis_base.ClientBase):
     def _convert_remote_network(self, remote_ip_prefix):
@@ -138,36 +182,190 @@ class SecurityGroupsClient(redis_base.ClientBase):
         """
         rules = []
         for group in groups:
-            rules.extend(self.serialize_rules(group.rules))
+            rules.extend(self.serialize_group(group))
         return rules
 
+    def serialize_group(self, group):
+        """Returns the serialized rules of one group, memoized by revision.
+
+        The returned list is shared through SERIALIZED_GROUP_CACHE and must
+        not be mutated.
+        """
+        return SERIALIZED_GROUP_CACHE.get(
+            group, lambda: self.serialize_rules(group.rules))
+
     def get_rules_for_port(self, device_id, mac_address):
         rules = self.get_field(
             self.vif_key(device_id, mac_address), SECURITY_GROUP_HASH_ATTR)
         if rules:
             return json.loads(rules)
 
+    def _pipeline_rules(self, pipe, device_id, mac_address, rules):
+        redis_key = self.vif_key(device_id, mac_address)
+        rule_dict = {SECURITY_GROUP_RULE_KEY: rules}
+        pipe.hset(redis_key, SECURITY_GROUP_HASH_ATTR, json.dumps(rule_dict))
+        pipe.hset(redis_key, SECURITY_GROUP_ACK, False)
+        pipe.hset(redis_key, SECURITY_GROUP_WRITTEN_AT, time.time())
+        pipe.sadd(VIF_INDEX_KEY, redis_key)
+        pipe.publish(VIF_CHANGES_CHANNEL % redis_key, redis_key)
+
+    @redis_base.handle_connection_error
     def apply_rules(self, device_id, mac_address, rules):
-        """Writes a series of security group rules to a redis server."""
+        """Writes a series of security group rules to a redis server.
+
+        The rules and the cleared ack are written in one MULTI/EXEC so the
+        agent never sees new rules with the previous ack or vice versa.
+        """
         LOG.info("Applying security group rules for device %s with MAC %s" %
                  (device_id, mac_address))
+        with self._client.master.pipeline() as pipe:
+            self._pipeline_rules(pipe, device_id, mac_address, rules)
+            pipe.execute()
 
-        rule_dict = {SECURITY_GROUP_RULE_KEY: rules}
-        redis_key = self.vif_key(device_id, mac_address)
-        # TODO(mdietz): Pipeline these. Requires some rewriting
-        self.set_field(redis_key, SECURITY_GROUP_HASH_ATTR, rule_dict)
-        self.set_field_raw(redis_key, SECURITY_GROUP_ACK, False)
+    @redis_base.handle_connection_error
+    def apply_rules_many(self, vifs):
+        """Like apply_rules, for many VIFs in a single MULTI/EXEC.
 
+        :param vifs: iterable of (device_id, mac_address, rules) tuples
+        """
+        count = 0
+        with self._client.master.pipeline() as pipe:
+            for device_id, mac_address, rules in vifs:
+                self._pipeline_rules(pipe, device_id, mac_address, rules)
+                count += 1
+            if count:
+                pipe.execute()
+        LOG.info("Applied security group rules for %d VIF(s)" % count)
+
+    @redis_base.handle_connection_error
     def delete_vif_rules(self, device_id, mac_address):
-        # Redis HDEL command will ignore key safely if it doesn't exist
-        self.delete_field(self.vif_key(device_id, mac_address),
-                          SECURITY_GROUP_HASH_ATTR)
-        self.delete_field(self.vif_key(device_id, mac_address),
-                          SECURITY_GROUP_ACK)
+        # Redis HDEL and SREM commands ignore missing keys and members safely
+        redis_key = self.vif_key(device_id, mac_address)
+        with self._client.master.pipeline() as pipe:
+            pipe.hdel(redis_key, SECURITY_GROUP_HASH_ATTR, SECURITY_GROUP_ACK,
+                      SECURITY_GROUP_WRITTEN_AT)
+            pipe.srem(VIF_INDEX_KEY, redis_key)
+            pipe.publish(VIF_CHANGES_CHANNEL % redis_key, redis_key)
+            pipe.execute()
 
     def delete_vif(self, device_id, mac_address):
-        # Redis DEL command will ignore key safely if it doesn't exist
-        self.delete_key(self.vif_key(device_id, mac_address))
+        self.delete_vif_key(self.vif_key(device_id, mac_address))
+
+    @redis_base.handle_connection_error
+    def delete_vif_key(self, redis_key):
+        # Redis DEL and SREM commands ignore missing keys and members safely
+        with self._client.master.pipeline() as pipe:
+            pipe.delete(redis_key)
+            pipe.srem(VIF_INDEX_KEY, redis_key)
+            pipe.publish(VIF_CHANGES_CHANNEL % redis_key, redis_key)
+            pipe.execute()
+
+    @redis_base.handle_connection_error
+    def subscribe_vif_changes(self, vif_keys=()):
+        """Returns a pubsub subscribed to changes of the given VIF keys."""
+        pubsub = self._client.slave.pubsub(ignore_subscribe_messages=True)
+        if vif_keys:
+            pubsub.subscribe(*[VIF_CHANGES_CHANNEL % key for key in vif_keys])
+        return pubsub
+
+    @redis_base.handle_connection_error
+    def update_vif_subscriptions(self, pubsub, subscribed, vif_keys):
+        """Subscribes pubsub to changes of exactly vif_keys.
+
+        subscribed is the set of VIF keys pubsub is subscribed to now.
+        Returns the set it is subscribed to afterwards.
+        """
+        vif_keys = set(vif_keys)
+        added = vif_keys - subscribed
+        removed = subscribed - vif_keys
+        if added:
+            pubsub.subscribe(*[VIF_CHANGES_CHANNEL % key for key in added])
+        if removed:
+            pubsub.unsubscribe(*[VIF_CHANGES_CHANNEL % key
+                                 for key in removed])
+        return vif_keys
+
+    @redis_base.handle_connection_error
+    def get_vif_changes(self, pubsub, timeout):
+        """Returns the set of VIF keys published as changed.
+
+        Waits up to timeout seconds for the first change, then drains
+        whatever else has already arrived without waiting.
+        """
+        changed = set()
+        if not pubsub.subscribed:
+            # NOTE: redis-py refuses to read from a pubsub that never
+            #       subscribed to anything, e.g. on a host without VIFs
+            time.sleep(timeout)
+            return changed
+        message = pubsub.get_message(timeout=timeout)
+        while message:
+            if message["type"] == "message":
+                changed.add(message["data"])
+            message = pubsub.get_message()
+        return changed
+
+    @redis_base.handle_connection_error
+    def indexed_vif_count(self, host=None):
+        """Returns the number of VIFs with rules, or of host's VIFs."""
+        return self._client.slave.scard(self._index_key(host))
+
+    def iter_indexed_vif_keys(self, host=None, count=None):
+        """Yields the VIF keys with rules, or those of host's VIFs.
+
+        Reads the index set with SSCAN, so only one batch of members is
+        held at a time.
+        """
+        count = count or CONF.QUARK.redis_scan_count
+        cursor = 0
+        while True:
+            cursor, keys = self._sscan_index(self._index_key(host), cursor,
+                                             count)
+            for key in keys:
+                yield key
+            if not int(cursor):
+                return
+
+    @redis_base.handle_connection_error
+    def _sscan_index(self, index_key, cursor, count):
+        return self._client.slave.sscan(index_key, cursor, count=count)
+
+    def _index_key(self, host):
+        if host is None:
+            return VIF_INDEX_KEY
+        return HOST_VIF_INDEX_KEY % host
+
+    @redis_base.handle_connection_error
+    def set_host_vifs(self, host, vif_keys):
+        """Replaces the set of VIF keys present on hypervisor host."""
+        index_key = self._index_key(host)
+        with self._client.master.pipeline() as pipe:
+            pipe.delete(index_key)
+            if vif_keys:
+                pipe.sadd(index_key, *vif_keys)
+            pipe.execute()
+
+    def rebuild_vif_index(self):
+        """Adds every VIF key holding rules to the index set.
+
+        Fills the index for VIFs written before it was maintained. Returns
+        the number of keys found.
+        """
+        count = 0
+        batch = []
+        for redis_key in self.iter_vif_keys(field=SECURITY_GROUP_HASH_ATTR):
+            batch.append(redis_key)
+            if len(batch) >= CONF.QUARK.redis_scan_count:
+                count += self._add_to_index(batch)
+                batch = []
+        if batch:
+            count += self._add_to_index(batch)
+        return count
+
+    @redis_base.handle_connection_error
+    def _add_to_index(self, vif_keys):
+        self._client.master.sadd(VIF_INDEX_KEY, *vif_keys)
+        return len(vif_keys)
 
     @utils.retry_loop(3)
     def get_security_group_states(self, interfaces):
@@ -202,6 +400,12 @@ class SecurityGroupsClient(redis_base.ClientBase):
                     LOG.debug("Skipping bad ack value %s" % security_group_ack)
         return ret
 
+    def get_rules_written_at(self, vifs):
+        """Returns when the rules of each of vifs were last written."""
+        vif_keys = [self.vif_key(vif.device_id, vif.mac_address)
+                    for vif in vifs]
+        return self.get_fields(vif_keys, SECURITY_GROUP_WRITTEN_AT)
+
     @utils.retry_loop(3)
     def update_group_states_for_vifs(self, vifs, ack):
         """Updates security groups by setting the ack field"""
@@ -25,10 +25,13 @@ from oslo_utils import timeutils
 from oslo_utils import uuidutils
 from sqlalchemy import event
 from sqlalchemy import func as sql_func
-from sqlalchemy import and_, asc, desc, orm, or_, not_
+from sqlalchemy import and_, asc, case, desc, orm, or_, not_
+from sqlalchemy import sql
 from sqlalchemy.orm import class_mapper
 
+from quark import address_index
 from quark.db import models
+from quark import ip_policy_cache
 from quark import network_strategy
 from quark import protocols
 from quark import tags
@@ -186,11 +189,7 @@ def scoped(f):
     return wrapped
 
 
-@scoped
-def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
-              **filters):
-    query = context.session.query(models.Port).options(
-        orm.joinedload(models.Port.ip_addresses))
+def _port_filters(context, filters):
     model_filters = _model_query(context, models.Port, filters)
     if filters.get("ip_address_id"):
         model_filters.append(models.Port.ip_addresses.any(
@@ -202,10 +201,23 @@ def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
     if filters.get("service"):
         model_filters.append(models.Port.associations.any(
             models.PortIpAssociation.service == filters["service"]))
+    return model_filters
+
+
+@scoped
+def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
+              **filters):
+    query = context.session.query(models.Port).options(
+        orm.joinedload(models.Port.ip_addresses))
+    model_filters = _port_filters(context, filters)
 
     if "join_security_groups" in filters:
         query = query.options(orm.joinedload(models.Port.security_groups))
 
+    if "join_tags" in filters:
+        query = query.options(
+            orm.subqueryload("tag_association.tags_association"))
+
     if fields and "port_subnets" in fields:
         query = query.options(orm.joinedload("ip_addresses.subnet"))
         query = query.options(
@@ -216,6 +228,74 @@ def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
                           sorts, marker_obj)
 
 
+def port_find_batches(context, batch_size, fields=None, keyset=True,
+                      **filters):
+    """Yields the ports matching filters, batch_size rows per query.
+
+    Everything the port views read (IP addresses and their associations,
+    the port's own associations, security groups and tags) is loaded with
+    one extra query per relationship per batch instead of lazily per port,
+    and only one batch of rows is referenced at a time.
+
+    With keyset, batches are walked in id order with keyset pagination
+    (id > last id) rather than OFFSET, so every batch costs the same and
+    memory stays bounded. Without it, the matching ids are read up front
+    in the order port_find returns unsorted ports, and the ports are
+    loaded batch_size ids at a time in that order; only the ids are held
+    for the whole walk.
+    """
+    _listify(filters)
+    model_filters = _port_filters(context, filters)
+    options = [
+        orm.subqueryload(models.Port.ip_addresses).subqueryload(
+            models.IPAddress.associations),
+        orm.subqueryload(models.Port.associations),
+        orm.subqueryload(models.Port.security_groups),
+        orm.subqueryload("tag_association.tags_association")]
+    if fields and "port_subnets" in fields:
+        options.extend([
+            orm.subqueryload("ip_addresses.subnet"),
+            orm.subqueryload("ip_addresses.subnet.dns_nameservers"),
+            orm.subqueryload("ip_addresses.subnet.routes")])
+
+    if keyset:
+        batches = _port_keyset_batches(context, batch_size, options,
+                                       model_filters)
+    else:
+        batches = _port_id_batches(context, batch_size, options,
+                                   model_filters)
+    for batch in batches:
+        for port in batch:
+            yield port
+
+
+def _port_keyset_batches(context, batch_size, options, model_filters):
+    last_id = None
+    while True:
+        query = context.session.query(models.Port).options(*options)
+        query = query.filter(*model_filters)
+        if last_id is not None:
+            query = query.filter(models.Port.id > last_id)
+        batch = query.order_by(models.Port.id).limit(batch_size).all()
+        if batch:
+            yield batch
+        if not batch or len(batch) < batch_size:
+            return
+        last_id = batch[-1]["id"]
+
+
+def _port_id_batches(context, batch_size, options, model_filters):
+    query = context.session.query(models.Port.id).filter(*model_filters)
+    port_ids = [port_id for port_id, in query]
+    for start in xrange(0, len(port_ids), batch_size):
+        batch_ids = port_ids[start:start + batch_size]
+        query = context.session.query(models.Port).options(*options)
+        query = query.filter(models.Port.id.in_(batch_ids))
+        ports = dict((port["id"], port) for port in query)
+        # NOTE: a port deleted since its id was read is skipped.
+        yield [ports[port_id] for port_id in batch_ids if port_id in ports]
+
+
 @scoped
 def port_find_by_ip_address(context, **filters):
     query = context.session.query(models.IPAddress).options(
@@ -314,14 +394,23 @@ def ip_address_create(context, **address_dict):
     ip_address["_deallocated"] = 0
     ip_address["allocated_at"] = timeutils.utcnow()
     context.session.add(ip_address)
+    subnet_update_usage_counts(context, ip_address["subnet_id"], allocated=1)
     return ip_address
 
 
 def ip_address_delete(context, addr):
+    if addr["_deallocated"]:
+        subnet_update_usage_counts(context, addr["subnet_id"],
+                                   deallocated_reusable=-1)
+    else:
+        subnet_update_usage_counts(context, addr["subnet_id"], allocated=-1)
     context.session.delete(addr)
 
 
 def ip_address_deallocate(context, address, **kwargs):
+    if not address["_deallocated"]:
+        subnet_update_usage_counts(context, address["subnet_id"],
+                                   allocated=-1, deallocated_reusable=1)
     kwargs["_deallocated"] = 1
     kwargs["deallocated_at"] = timeutils.utcnow()
     return ip_address_update(context, address, **kwargs)
@@ -365,11 +454,83 @@ def ip_address_count_all(context, filters):
     return query.filter(*model_filters).scalar()
 
 
+def _ip_address_in_usable_subnet():
+    return sql.exists().where(and_(
+        models.Subnet.id == models.IPAddress.subnet_id,
+        models.Subnet.do_not_use == 0,  # noqa
+        models.IPAddress.address >= models.Subnet.first_ip,
+        models.IPAddress.address <= models.Subnet.last_ip)).correlate(
+            models.IPAddress)
+
+
+def _ip_address_in_subnet_bounds():
+    return sql.exists().where(and_(
+        models.Subnet.id == models.IPAddress.subnet_id,
+        models.IPAddress.address >= models.Subnet.first_ip,
+        models.IPAddress.address <= models.Subnet.last_ip)).correlate(
+            models.IPAddress)
+
+
+def _ip_address_excluded_by_policy():
+    return sql.exists().where(and_(
+        models.Subnet.id == models.IPAddress.subnet_id,
+        models.IPPolicyCIDR.ip_policy_id == models.Subnet.ip_policy_id,
+        models.IPAddress.address >= models.IPPolicyCIDR.first_ip,
+        models.IPAddress.address <= models.IPPolicyCIDR.last_ip)).correlate(
+            models.IPAddress)
+
+
+def _ip_address_reallocate_filters(context, filters):
+    """Filters for claiming deallocated addresses that are safe to reuse.
+
+    Besides the caller's criteria, only addresses inside the bounds of a
+    usable subnet are claimed, and unless a specific address was asked for
+    (policies don't prevent explicit assignment), none that fall in the
+    subnet's IP policy. Doing this in the UPDATE means an invalid row is
+    never claimed, rather than claimed, loaded, checked and deleted on
+    the next retry.
+    """
+    model_filters = _model_query(context, models.IPAddress, filters)
+    model_filters.append(_ip_address_in_usable_subnet())
+    if filters.get("ip_address") is None:
+        model_filters.append(not_(_ip_address_excluded_by_policy()))
+    return model_filters
+
+
+# What ip_address_reallocate claimed an address from
+CLAIMED_DEALLOCATED = "deallocated"
+CLAIMED_ALLOCATED = "allocated"
+
+
 @scoped
 def ip_address_reallocate(context, update_kwargs, **filters):
+    """Claims one address matching filters by updating it in place.
+
+    Without a deallocated filter, as when an address is asked for
+    explicitly, a deallocated match is claimed in preference to an
+    allocated one. Each attempt filters on the state it claims from, so
+    the answer holds even if the row changes state in between.
+
+    Returns CLAIMED_DEALLOCATED or CLAIMED_ALLOCATED, or None if no
+    address was claimed.
+    """
     LOG.debug("ip_address_reallocate %s", filters)
+    if "deallocated" in filters:
+        if _ip_address_claim(context, update_kwargs, filters):
+            return CLAIMED_DEALLOCATED
+        return None
+
+    for claimed, deallocated in ((CLAIMED_DEALLOCATED, True),
+                                 (CLAIMED_ALLOCATED, False)):
+        if _ip_address_claim(context, update_kwargs,
+                             dict(filters, _deallocated=deallocated)):
+            return claimed
+    return None
+
+
+def _ip_address_claim(context, update_kwargs, filters):
     query = context.session.query(models.IPAddress)
-    model_filters = _model_query(context, models.IPAddress, filters)
+    model_filters = _ip_address_reallocate_filters(context, filters)
     query = query.filter(*model_filters)
     row_count = query.update(update_kwargs,
                              update_args={"mysql_limit": 1},
@@ -377,7 +538,23 @@ def ip_address_reallocate(context, update_kwargs, **filters):
     return row_count == 1
 
 
-def ip_address_reallocate_find(context, transaction_id):
+@scoped
+def ip_address_reallocate_many(context, update_kwargs, count, **filters):
+    LOG.debug("ip_address_reallocate_many %s %s", count, filters)
+    query = context.session.query(models.IPAddress)
+    model_filters = _ip_address_reallocate_filters(context, filters)
+    query = query.filter(*model_filters)
+    return query.update(update_kwargs,
+                        update_args={"mysql_limit": count},
+                        synchronize_session=False)
+
+
+def ip_address_reallocate_find(context, transaction_id, deallocated=True):
+    """Returns the address claimed under transaction_id, if still usable.
+
+    deallocated says whether it was claimed from the deallocated state,
+    and so whether the subnet's usage counters move.
+    """
     address = ip_address_find(context, transaction_id=transaction_id,
                               scope=ONE)
     if not address:
@@ -385,8 +562,28 @@ def ip_address_reallocate_find(context, transaction_id):
                  transaction_id)
         return
 
+    return _ip_address_reallocatable(context, address, deallocated)
+
+
+def ip_address_reallocate_find_many(context, transaction_id):
+    addresses = ip_address_find(context, transaction_id=transaction_id,
+                                scope=ALL)
+    reallocated = []
+    for address in addresses:
+        address = _ip_address_reallocatable(context, address)
+        if address:
+            reallocated.append(address)
+    return reallocated
+
+
+def _ip_address_reallocatable(context, address, deallocated=True):
     LOG.info("Potentially reallocatable IP found: "
              "{0}".format(address["address_readable"]))
+    # NOTE: ip_address_reallocate has already flipped the row to allocated.
+    #       An address claimed while allocated changed no state.
+    if deallocated:
+        subnet_update_usage_counts(context, address["subnet_id"],
+                                   allocated=1, deallocated_reusable=-1)
     subnet = address.get('subnet')
     if not subnet:
         LOG.debug("No subnet associated with address")
@@ -401,29 +598,55 @@ def ip_address_reallocate_find(context, transaction_id):
     else:
         addr = addr.ipv6()
 
-    # TODO(amir): performance test replacing this with SQL in
-    #             ip_address_reallocate's UPDATE statement
-    policy = models.IPPolicy.get_ip_policy_cidrs(subnet)
-    if policy is not None and addr in policy:
+    # NOTE: ip_address_reallocate already skips these in SQL. This only
+    #       catches policy CIDRs lacking first_ip/last_ip and addresses
+    #       asked for explicitly.
+    policy = models.IPPolicy.get_ip_policy_ranges(subnet)
+    if addr in policy:
         LOG.info("Deleting Address {0} due to policy "
                  "violation".format(
                      address["address_readable"]))
-        context.session.delete(address)
+        ip_address_delete(context, address)
         return
 
-    # TODO(amir): performance test replacing this with SQL in
-    #             ip_address_reallocate's UPDATE statement
     cidr = netaddr.IPNetwork(address["subnet"]["cidr"])
     if addr not in cidr:
         LOG.info("Address {0} isn't in the subnet "
                  "it claims to be in".format(
                      address["address_readable"]))
-        context.session.delete(address)
+        ip_address_delete(context, address)
         return
 
     return address
 
 
+def ip_address_purge_unreallocatable(context, limit=None):
+    """Deletes deallocated addresses that could never be reallocated.
+
+    These are addresses outside the bounds of their subnet, or caught by
+    the subnet's IP policy. ip_address_reallocate will never claim them,
+    so they'd otherwise sit in the table forever. Returns the number of
+    addresses deleted.
+    """
+    query = context.session.query(models.IPAddress)
+    query = query.with_lockmode("update")
+    query = query.filter(models.IPAddress._deallocated == 1)
+    query = query.filter(models.IPAddress.subnet_id.isnot(None))
+    query = query.filter(or_(not_(_ip_address_in_subnet_bounds()),
+                             _ip_address_excluded_by_policy()))
+    if limit:
+        query = query.limit(limit)
+
+    purged = 0
+    for address in query.all():
+        LOG.info("Purging unreallocatable address {0} from subnet "
+                 "{1}".format(address["address_readable"],
+                              address["subnet_id"]))
+        ip_address_delete(context, address)
+        purged += 1
+    return purged
+
+
 @scoped
 def mac_address_find(context, lock_mode=False, **filters):
     query = context.session.query(models.MacAddress)
@@ -448,6 +671,15 @@ def mac_address_reallocate(context, update_kwargs, **filters):
     return row_count == 1
 
 
+def mac_address_reallocate_many(context, update_kwargs, count, **filters):
+    LOG.debug("mac_address_reallocate_many %s %s", count, filters)
+    query = context.session.query(models.MacAddress)
+    model_filters = _model_query(context, models.MacAddress, filters)
+    query = query.filter(*model_filters)
+    return query.update(update_kwargs, update_args={"mysql_limit": count},
+                        synchronize_session=False)
+
+
 def mac_address_reallocate_find(context, transaction_id):
     mac = mac_address_find(context, transaction_id=transaction_id,
                            scope=ONE)
@@ -456,6 +688,21 @@ def mac_address_reallocate_find(context, transaction_id):
                  transaction_id)
         return
 
+    return _mac_address_reallocatable(context, mac)
+
+
+def mac_address_reallocate_find_many(context, transaction_id):
+    macs = mac_address_find(context, transaction_id=transaction_id,
+                            scope=ALL)
+    reallocated = []
+    for mac in macs:
+        mac = _mac_address_reallocatable(context, mac)
+        if mac:
+            reallocated.append(mac)
+    return reallocated
+
+
+def _mac_address_reallocatable(context, mac):
     # NOTE(mdietz): This is a HACK. Please see RM11043 for details
     if mac["mac_address_range"] and mac["mac_address_range"]["do_not_use"]:
         mac_address_delete(context, mac)
@@ -509,7 +756,7 @@ def mac_address_range_update(context, mac_range, **kwargs):
     return mac_range
 
 
-def mac_range_update_next_auto_assign_mac(context, mac_range):
+def mac_range_update_next_auto_assign_mac(context, mac_range, count=1):
     query = context.session.query(models.MacAddressRange)
     query = query.filter(models.MacAddressRange.id == mac_range["id"])
     query = query.filter(models.MacAddressRange.next_auto_assign_mac != -1)
@@ -518,13 +765,39 @@ def mac_range_update_next_auto_assign_mac(context, mac_range):
     # http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html
     query = query.update(
         {"next_auto_assign_mac":
-         models.MacAddressRange.next_auto_assign_mac + 1},
+         models.MacAddressRange.next_auto_assign_mac + count},
         synchronize_session=False)
 
     # Returns a count of the rows matched in the update
     return query
 
 
+def mac_address_range_find_for_lease(context):
+    """Locks the first MAC range with addresses left to hand out.
+
+    Unlike mac_address_range_find_allocation_counts this doesn't count the
+    MACs in every range, so the lock is only held for the one row.
+    """
+    query = context.session.query(models.MacAddressRange)
+    query = query.with_lockmode("update")
+    query = query.filter(models.MacAddressRange.next_auto_assign_mac != -1)
+    query = query.filter(models.MacAddressRange.do_not_use == '0')  # noqa
+    return query.first()
+
+
+def mac_range_update_rewind_next_auto_assign_mac(context, mac_range,
+                                                 expected, rewind_to):
+    query = context.session.query(models.MacAddressRange)
+    query = query.filter(models.MacAddressRange.id == mac_range["id"])
+    query = query.filter(
+        models.MacAddressRange.next_auto_assign_mac == expected)
+    query = query.update({"next_auto_assign_mac": rewind_to},
+                         synchronize_session=False)
+
+    # Returns a count of the rows matched in the update
+    return query
+
+
 def mac_range_update_set_full(context, mac_range):
     query = context.session.query(models.MacAddressRange)
     query = query.filter_by(id=mac_range["id"])
@@ -643,14 +916,16 @@ def network_delete(context, network):
 
 def subnet_find_ordered_by_most_full(context, net_id, lock_subnets=True,
                                      **filters):
-    count = sql_func.count(models.IPAddress.address).label("count")
+    # NOTE: Reads the usage counters maintained by
+    #       subnet_update_usage_counts rather than counting every address
+    #       in the network under the subnet locks.
+    count = (models.Subnet.allocated_count +
+             models.Subnet.deallocated_reusable_count).label("count")
     size = (models.Subnet.last_ip - models.Subnet.first_ip)
     query = context.session.query(models.Subnet, count)
     if lock_subnets:
         query = query.with_lockmode("update")
     query = query.filter_by(do_not_use=False)
-    query = query.outerjoin(models.Subnet.generated_ips)
-    query = query.group_by(models.Subnet.id)
     query = query.order_by(
         asc(models.Subnet.ip_version),
         asc(size - count))
@@ -667,22 +942,115 @@ def subnet_find_ordered_by_most_full(context, net_id, lock_subnets=True,
     return query
 
 
-def subnet_update_next_auto_assign_ip(context, subnet):
+def subnet_update_next_auto_assign_ip(context, subnet, next_ip=None):
+    """Advances the auto assign cursor of a subnet.
+
+    With no next_ip the cursor is bumped by one. Otherwise next_ip is taken
+    to be the address about to be handed out (as found from the subnet's free
+    address index) and the cursor jumps straight past it, skipping any policy
+    excluded addresses in between.
+    """
     query = context.session.query(models.Subnet)
     query = query.filter(models.Subnet.id == subnet["id"])
     query = query.filter(models.Subnet.next_auto_assign_ip != -1)
 
+    if next_ip is None:
+        next_auto_assign_ip = models.Subnet.next_auto_assign_ip + 1
+    else:
+        query = query.filter(models.Subnet.next_auto_assign_ip <= next_ip)
+        next_auto_assign_ip = next_ip + 1
+
     # For details on synchronize_session, see:
     # http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html
     query = query.update(
-        {"next_auto_assign_ip":
-         models.Subnet.next_auto_assign_ip + 1},
+        {"next_auto_assign_ip": next_auto_assign_ip},
         synchronize_session=False)
 
     # Returns a count of the rows matched in the update
     return query
 
 
+def subnet_update_usage_counts(context, subnet_id, allocated=0,
+                               deallocated_reusable=0):
+    """Atomically adjusts the denormalized address counters of a subnet.
+
+    allocated_count and deallocated_reusable_count mirror the number of
+    allocated and deallocated rows in quark_ip_addresses for the subnet.
+    They're bumped in place by SQL rather than read and written back, so
+    concurrent allocations can't lose updates. Anything that drifts is
+    put right by subnet_reconcile_usage_counts.
+
+    ip_availability_used moves with allocated_count. Deallocated addresses
+    stay in use until their reuse window passes, but that's a matter of
+    time rather than of an event, so quark.ip_availability counts those
+    when it's read.
+    """
+    if not subnet_id or not (allocated or deallocated_reusable):
+        return 0
+
+    query = context.session.query(models.Subnet)
+    query = query.filter(models.Subnet.id == subnet_id)
+    counts = {}
+    if allocated:
+        counts["allocated_count"] = (models.Subnet.allocated_count +
+                                     allocated)
+        counts["ip_availability_used"] = (models.Subnet.ip_availability_used +
+                                          allocated)
+    if deallocated_reusable:
+        counts["deallocated_reusable_count"] = (
+            models.Subnet.deallocated_reusable_count + deallocated_reusable)
+
+    # For details on synchronize_session, see:
+    # http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html
+    return query.update(counts, synchronize_session=False)
+
+
+def subnet_reconcile_usage_counts(context, subnet_ids=None):
+    """Recounts subnet addresses and fixes any drifted usage counters.
+
+    The subnet rows are locked before counting so allocations made while
+    this runs can't be lost. Returns a list of
+    (subnet_id, allocated, deallocated_reusable) for every subnet whose
+    counters were corrected.
+    """
+    subnets = context.session.query(models.Subnet.id,
+                                    models.Subnet.allocated_count,
+                                    models.Subnet.deallocated_reusable_count)
+    subnets = subnets.with_lockmode("update")
+    if subnet_ids:
+        subnets = subnets.filter(models.Subnet.id.in_(subnet_ids))
+    subnets = subnets.all()
+    if not subnets:
+        return []
+
+    count = sql_func.count(models.IPAddress.id)
+    deallocated = sql_func.sum(
+        case([(models.IPAddress._deallocated == 1, 1)], else_=0))
+    query = context.session.query(models.IPAddress.subnet_id, count,
+                                  deallocated)
+    if subnet_ids:
+        query = query.filter(models.IPAddress.subnet_id.in_(subnet_ids))
+    query = query.group_by(models.IPAddress.subnet_id)
+    actual = dict((subnet_id, (int(total - (dealloc or 0)),
+                               int(dealloc or 0)))
+                  for subnet_id, total, dealloc in query)
+
+    corrected = []
+    for subnet_id, alloc, dealloc in subnets:
+        counts = actual.get(subnet_id, (0, 0))
+        if (alloc, dealloc) == counts:
+            continue
+        LOG.info("Correcting usage counts of subnet {0} from {1} to "
+                 "{2}".format(subnet_id, (alloc, dealloc), counts))
+        query = context.session.query(models.Subnet)
+        query = query.filter(models.Subnet.id == subnet_id)
+        query.update({"allocated_count": counts[0],
+                      "deallocated_reusable_count": counts[1]},
+                     synchronize_session=False)
+        corrected.append((subnet_id,) + counts)
+    return corrected
+
+
 def subnet_update_set_full(context, subnet):
     query = context.session.query(models.Subnet)
     query = query.filter_by(id=subnet["id"])
@@ -699,9 +1067,20 @@ def subnet_update_set_full(context, subnet):
 
 
 def subnet_update_set_alloc_pool_cache(context, subnet, cache_data=None):
-    if cache_data is not None:
-        cache_data = json.dumps(cache_data)
-    update_kwargs = {"_allocation_pool_cache": cache_data}
+    """Writes the allocation pool cache, stamped with the current version
+    and the revision of the subnet's IP policy.
+
+    Without cache_data the pools are recomputed from the subnet's CIDR and
+    IP policy, so the cache is rewritten rather than merely cleared.
+    """
+    if cache_data is None:
+        cache_data = models.Subnet.compute_allocation_pools(subnet)
+    cache_data = json.dumps(cache_data)
+    update_kwargs = {
+        "_allocation_pool_cache": cache_data,
+        "_allocation_pool_cache_version": models.ALLOCATION_POOL_CACHE_VERSION,
+        "_allocation_pool_cache_policy_revision":
+            models.Subnet.policy_revision(subnet)}
     query = context.session.query(models.Subnet)
     query = query.filter(models.Subnet.id == subnet.id)
     row_count = query.update(update_kwargs,
@@ -711,6 +1090,70 @@ def subnet_update_set_alloc_pool_cache(context, subnet, cache_data=None):
     return subnet
 
 
+def subnet_update_free_address_index(context, subnet):
+    """Rebuilds and persists the free address index for a subnet.
+
+    Callers should invoke this whenever the subnet's CIDR or IP policy
+    changes, inside the same transaction as that change.
+    """
+    index_data = None
+    if subnet.get("ip_version") == 4:
+        index_data = address_index.FreeAddressIndex.from_subnet(
+            subnet).dumps()
+    subnet["_free_address_index"] = index_data
+    return subnet
+
+
+def subnet_update_policy_caches(context, subnet):
+    """Rebuilds everything a subnet derives from its CIDR and IP policy.
+
+    That is the free address index, the allocation pool cache and the
+    materialized availability size. Like subnet_update_free_address_index,
+    call it inside the same transaction as the change so readers never see
+    pools from the old policy.
+    """
+    subnet_update_free_address_index(context, subnet)
+    cache_data, version, revision, size = None, None, None, None
+    if subnet.get("cidr"):
+        cache_data = json.dumps(models.Subnet.compute_allocation_pools(subnet))
+        version = models.ALLOCATION_POOL_CACHE_VERSION
+        revision = models.Subnet.policy_revision(subnet)
+        size = subnet_availability_size(subnet)
+    subnet["_allocation_pool_cache"] = cache_data
+    subnet["_allocation_pool_cache_version"] = version
+    subnet["_allocation_pool_cache_policy_revision"] = revision
+    subnet["ip_availability_size"] = size
+    return subnet
+
+
+def subnet_availability_size(subnet):
+    """Returns how many addresses of the subnet its IP policy leaves."""
+    ip_policy = subnet.get("ip_policy") or {"size": 0}
+    return netaddr.IPNetwork(subnet["cidr"]).size - (ip_policy["size"] or 0)
+
+
+def subnet_find_stale_alloc_pool_cache(context, limit=None):
+    """Returns subnets whose allocation pool cache is missing or stale.
+
+    Stale means written by an older ALLOCATION_POOL_CACHE_VERSION or from
+    another revision of the subnet's IP policy.
+    """
+    cache_revision = models.Subnet._allocation_pool_cache_policy_revision
+    query = context.session.query(models.Subnet)
+    query = query.outerjoin(
+        models.IPPolicy, models.IPPolicy.id == models.Subnet.ip_policy_id)
+    query = query.filter(or_(
+        models.Subnet._allocation_pool_cache_version.is_(None),
+        models.Subnet._allocation_pool_cache_version !=
+        models.ALLOCATION_POOL_CACHE_VERSION,
+        and_(cache_revision.is_(None), models.IPPolicy.revision.isnot(None)),
+        cache_revision != models.IPPolicy.revision))
+    query = query.order_by(models.Subnet.id)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
 @scoped
 def subnet_find(context, limit=None, page_reverse=False, sorts=None,
                 marker_obj=None, fields=None, **filters):
@@ -770,6 +1213,9 @@ def _subnet_find(context, limit, sorts, marker, page_reverse, fields,
     if "join_routes" in filters:
         query = query.options(orm.joinedload(models.Subnet.routes))
 
+    if "join_ip_policy" in filters:
+        query = query.options(orm.joinedload(models.Subnet.ip_policy))
+
     return paginate_query(query, models.Subnet, limit, sorts, marker)
 
 
@@ -790,6 +1236,9 @@ def subnet_create(context, **subnet_dict):
     subnet = models.Subnet()
     subnet.update(subnet_dict)
     subnet["tenant_id"] = context.tenant_id
+    # NOTE: A new subnet has nothing allocated, so its materialized
+    # availability is accurate from the start.
+    subnet["ip_availability_refreshed_at"] = timeutils.utcnow()
     context.session.add(subnet)
     return subnet
 
@@ -907,6 +1356,38 @@ def security_group_rule_delete(context, rule):
     context.session.delete(rule)
 
 
+def security_group_bump_revision(context, group):
+    """Increments the group's revision in the database.
+
+    The increment happens in SQL so concurrent rule changes never share a
+    revision. The revision and rules are expired and reloaded on next use:
+    rules are created and deleted through their own rows, so a rules
+    collection loaded earlier in the session would otherwise still be
+    served, and cached, under the new revision.
+    """
+    query = context.session.query(models.SecurityGroup)
+    query = query.filter(models.SecurityGroup.id == group["id"])
+    query.update({"revision": models.SecurityGroup.revision + 1},
+                 synchronize_session=False)
+    context.session.expire(group, ["revision", "rules"])
+
+
+def security_group_port_batches(context, group_ids, batch_size):
+    """Yields lists of up to batch_size ports in any of group_ids.
+
+    Membership comes from quark_port_security_group_associations. Each
+    batch has the ports' groups and their rules loaded up front, as that
+    is all a rule push needs.
+    """
+    association = models.port_group_association_table
+    model_filters = [models.Port.id.in_(
+        sql.select([association.c.port_id]).where(
+            association.c.group_id.in_(group_ids)))]
+    options = [orm.subqueryload(models.Port.security_groups).subqueryload(
+        models.SecurityGroup.rules)]
+    return _port_keyset_batches(context, batch_size, options, model_filters)
+
+
 def ip_policy_create(context, **ip_policy_dict):
     new_policy = models.IPPolicy()
     exclude = ip_policy_dict.pop("exclude")
@@ -921,6 +1402,7 @@ def ip_policy_create(context, **ip_policy_dict):
     ip_policy_dict["size"] = ip_set.size
     new_policy.update(ip_policy_dict)
     new_policy["tenant_id"] = context.tenant_id
+    new_policy["revision"] = 0
     context.session.add(new_policy)
     return new_policy
 
@@ -948,10 +1430,31 @@ def ip_policy_update(context, ip_policy, **ip_policy_dict):
 
     ip_policy.update(ip_policy_dict)
     context.session.add(ip_policy)
+    if exclude:
+        ip_policy_bump_revision(context, ip_policy)
     return ip_policy
 
 
+def ip_policy_bump_revision(context, ip_policy):
+    """Increments the policy's revision in the database.
+
+    Like security_group_bump_revision the increment happens in SQL, so
+    concurrent updates never share a revision. Cached copies of the
+    policy are invalidated once the transaction ends.
+    """
+    # NOTE: a policy created in this session needs its row first
+    context.session.flush()
+    query = context.session.query(models.IPPolicy)
+    query = query.filter(models.IPPolicy.id == ip_policy["id"])
+    query.update({"revision": models.IPPolicy.revision + 1},
+                 synchronize_session=False)
+    context.session.expire(ip_policy, ["revision"])
+    ip_policy_cache.invalidate_after_commit(context.session, ip_policy["id"])
+
+
 def ip_policy_delete(context, ip_policy):
+    ip_policy_cache.invalidate_after_commit(context.session,
+                                            ip_policy.get("id"))
     context.session.delete(ip_policy)
 
 
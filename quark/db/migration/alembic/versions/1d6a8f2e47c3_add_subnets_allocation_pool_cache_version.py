@@ -0,0 +1,26 @@
+"""Add subnets allocation pool cache version
+
+Revision ID: 1d6a8f2e47c3
+Revises: 3f0c11478a5d
+Create Date: 2016-03-17 11:24:09.513862
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d6a8f2e47c3'
+down_revision = '3f0c11478a5d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # NOTE: existing caches are left unstamped, so they are treated as stale
+    #       until rewritten by backfill_allocation_pool_cache or a GET
+    op.add_column('quark_subnets',
+                  sa.Column('_allocation_pool_cache_version', sa.Integer(),
+                            nullable=True))
+
+
+def downgrade():
+    op.drop_column('quark_subnets', '_allocation_pool_cache_version')
@@ -0,0 +1,24 @@
+"""Add subnets free address index
+
+Revision ID: 2b5a0e3c9d71
+Revises: 374c1bdb4480
+Create Date: 2016-03-02 14:12:08.319724
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b5a0e3c9d71'
+down_revision = '374c1bdb4480'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_subnets', sa.Column('_free_address_index',
+                                             sa.Text(),
+                                             nullable=True))
+
+
+def downgrade():
+    op.drop_column('quark_subnets', '_free_address_index')
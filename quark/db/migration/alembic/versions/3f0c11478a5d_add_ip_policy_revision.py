@@ -0,0 +1,24 @@
+"""Add ip policy revision
+
+Revision ID: 3f0c11478a5d
+Revises: 5b1e6d3f7a28
+Create Date: 2016-03-14 16:02:51.207318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f0c11478a5d'
+down_revision = '5b1e6d3f7a28'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_ip_policy', sa.Column('revision', sa.Integer(),
+                                               nullable=False,
+                                               server_default='0'))
+
+
+def downgrade():
+    op.drop_column('quark_ip_policy', 'revision')
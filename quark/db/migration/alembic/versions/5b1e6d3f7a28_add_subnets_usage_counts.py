@@ -0,0 +1,39 @@
+"""Add subnets usage counts
+
+Revision ID: 5b1e6d3f7a28
+Revises: 2b5a0e3c9d71
+Create Date: 2016-03-09 11:27:43.512606
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b1e6d3f7a28'
+down_revision = '2b5a0e3c9d71'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_subnets', sa.Column('allocated_count',
+                                             sa.BigInteger(),
+                                             nullable=False,
+                                             server_default='0'))
+    op.add_column('quark_subnets', sa.Column('deallocated_reusable_count',
+                                             sa.BigInteger(),
+                                             nullable=False,
+                                             server_default='0'))
+    op.execute("UPDATE quark_subnets SET "
+               "allocated_count = (SELECT COUNT(*) FROM quark_ip_addresses "
+               "WHERE quark_ip_addresses.subnet_id = quark_subnets.id AND "
+               "(quark_ip_addresses._deallocated IS NULL OR "
+               "quark_ip_addresses._deallocated = 0)), "
+               "deallocated_reusable_count = (SELECT COUNT(*) FROM "
+               "quark_ip_addresses WHERE "
+               "quark_ip_addresses.subnet_id = quark_subnets.id AND "
+               "quark_ip_addresses._deallocated = 1)")
+
+
+def downgrade():
+    op.drop_column('quark_subnets', 'deallocated_reusable_count')
+    op.drop_column('quark_subnets', 'allocated_count')
@@ -0,0 +1,24 @@
+"""Add security group revision
+
+Revision ID: 6c3e9b8d2a14
+Revises: 1d6a8f2e47c3
+Create Date: 2016-03-22 10:41:37.880214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6c3e9b8d2a14'
+down_revision = '1d6a8f2e47c3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_security_groups',
+                  sa.Column('revision', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+
+def downgrade():
+    op.drop_column('quark_security_groups', 'revision')
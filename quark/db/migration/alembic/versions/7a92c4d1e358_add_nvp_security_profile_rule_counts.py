@@ -0,0 +1,119 @@
+"""Add NVP security profile rule counts
+
+Revision ID: 7a92c4d1e358
+Revises: 6c3e9b8d2a14
+Create Date: 2016-04-05 14:12:09.518302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a92c4d1e358'
+down_revision = '6c3e9b8d2a14'
+
+from collections import defaultdict
+
+from alembic import op
+from oslo_utils import timeutils
+from oslo_utils import uuidutils
+import sqlalchemy as sa
+from sqlalchemy.sql import column, func, select, table
+
+
+def upgrade():
+    op.add_column('quark_nvp_driver_security_profile',
+                  sa.Column('rule_count', sa.Integer(), nullable=False,
+                            server_default='0'))
+    op.create_table(
+        'quark_nvp_driver_lport_security_profile',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('port_id', sa.String(length=36), nullable=False),
+        sa.Column('profile_id', sa.String(length=36), nullable=False),
+        sa.ForeignKeyConstraint(['profile_id'],
+                                ['quark_nvp_driver_security_profile.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        mysql_engine='InnoDB')
+    op.create_index(
+        op.f('ix_quark_nvp_driver_lport_security_profile_port_id'),
+        'quark_nvp_driver_lport_security_profile',
+        ['port_id'],
+        unique=False)
+    op.create_index(
+        op.f('ix_quark_nvp_driver_lport_security_profile_profile_id'),
+        'quark_nvp_driver_lport_security_profile',
+        ['profile_id'],
+        unique=False)
+    op.create_table(
+        'quark_nvp_driver_lport_rule_count',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('port_id', sa.String(length=36), nullable=False),
+        sa.Column('rule_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        mysql_engine='InnoDB')
+    op.create_index(
+        op.f('ix_quark_nvp_driver_lport_rule_count_port_id'),
+        'quark_nvp_driver_lport_rule_count',
+        ['port_id'],
+        unique=True)
+    _backfill()
+
+
+def _backfill():
+    """Records the rule counts and lports of existing security profiles.
+
+    Counted from the quark tables, as the optimized driver did before.
+    """
+    profiles = table('quark_nvp_driver_security_profile',
+                     column('id', sa.String(length=36)),
+                     column('rule_count', sa.Integer()))
+    rules = table('quark_security_group_rules',
+                  column('group_id', sa.String(length=36)))
+    associations = table('quark_port_security_group_associations',
+                         column('port_id', sa.String(length=36)),
+                         column('group_id', sa.String(length=36)))
+    lport_profiles = table('quark_nvp_driver_lport_security_profile',
+                           column('id', sa.String(length=36)),
+                           column('created_at', sa.DateTime()),
+                           column('port_id', sa.String(length=36)),
+                           column('profile_id', sa.String(length=36)))
+    lport_counts = table('quark_nvp_driver_lport_rule_count',
+                         column('id', sa.String(length=36)),
+                         column('created_at', sa.DateTime()),
+                         column('port_id', sa.String(length=36)),
+                         column('rule_count', sa.Integer()))
+
+    connection = op.get_bind()
+    rule_counts = dict(connection.execute(
+        select([rules.c.group_id, func.count()]).where(
+            rules.c.group_id.in_(select([profiles.c.id]))).group_by(
+            rules.c.group_id)).fetchall())
+    for group_id, rule_count in rule_counts.items():
+        connection.execute(profiles.update().values(
+            rule_count=rule_count).where(profiles.c.id == group_id))
+
+    port_groups = defaultdict(list)
+    for port_id, group_id in connection.execute(
+            select([associations.c.port_id, associations.c.group_id]).where(
+                associations.c.group_id.in_(select([profiles.c.id])))):
+        port_groups[port_id].append(group_id)
+    if not port_groups:
+        return
+
+    now = timeutils.utcnow()
+    connection.execute(lport_profiles.insert(), *[
+        dict(id=uuidutils.generate_uuid(), created_at=now, port_id=port_id,
+             profile_id=group_id)
+        for port_id, group_ids in port_groups.items()
+        for group_id in group_ids])
+    connection.execute(lport_counts.insert(), *[
+        dict(id=uuidutils.generate_uuid(), created_at=now, port_id=port_id,
+             rule_count=sum(rule_counts.get(g, 0) for g in group_ids))
+        for port_id, group_ids in port_groups.items()])
+
+
+def downgrade():
+    op.drop_table('quark_nvp_driver_lport_rule_count')
+    op.drop_table('quark_nvp_driver_lport_security_profile')
+    op.drop_column('quark_nvp_driver_security_profile', 'rule_count')
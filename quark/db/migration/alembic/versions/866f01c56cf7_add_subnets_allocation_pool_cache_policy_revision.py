@@ -0,0 +1,27 @@
+"""Add subnets allocation pool cache policy revision
+
+Revision ID: 866f01c56cf7
+Revises: 8d41f3b7c265
+Create Date: 2016-04-14 16:02:51.370288
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '866f01c56cf7'
+down_revision = '8d41f3b7c265'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # NOTE: existing caches of subnets with a policy carry no revision, so
+    #       they are treated as stale until rewritten by
+    #       backfill_allocation_pool_cache or a GET
+    op.add_column('quark_subnets',
+                  sa.Column('_allocation_pool_cache_policy_revision',
+                            sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('quark_subnets', '_allocation_pool_cache_policy_revision')
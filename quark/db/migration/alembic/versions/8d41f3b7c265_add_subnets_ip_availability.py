@@ -0,0 +1,36 @@
+"""Add subnets materialized IP availability
+
+Revision ID: 8d41f3b7c265
+Revises: 7a92c4d1e358
+Create Date: 2016-04-12 10:41:27.093614
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d41f3b7c265'
+down_revision = '7a92c4d1e358'
+
+from alembic import op
+import sqlalchemy as sa
+
+from quark.db.custom_types import INET
+
+
+def upgrade():
+    # NOTE: Existing subnets are left unrefreshed, and so are counted from
+    # their addresses, until refresh_ip_availability has run.
+    op.add_column('quark_subnets', sa.Column('ip_availability_size', INET(),
+                                             nullable=True))
+    op.add_column('quark_subnets', sa.Column('ip_availability_used',
+                                             sa.BigInteger(),
+                                             nullable=False,
+                                             server_default='0'))
+    op.add_column('quark_subnets', sa.Column('ip_availability_refreshed_at',
+                                             sa.DateTime(),
+                                             nullable=True))
+
+
+def downgrade():
+    op.drop_column('quark_subnets', 'ip_availability_refreshed_at')
+    op.drop_column('quark_subnets', 'ip_availability_used')
+    op.drop_column('quark_subnets', 'ip_availability_size')
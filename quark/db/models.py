@@ -31,6 +31,8 @@ from sqlalchemy import orm
 
 from quark.db import custom_types
 from quark.db import ip_types
+from quark import ip_policy_cache
+from quark import policy_ranges
 # NOTE(mdietz): This is the only way to actually create the quotas table,
 #              regardless if we need it. This is how it's done upstream.
 # NOTE(jhammond): If it isn't obvious quota_driver is unused and that's ok.
@@ -42,6 +44,12 @@ HasId = models.HasId
 LOG = logging.getLogger(__name__)
 TABLE_KWARGS = {"mysql_engine": "InnoDB"}
 
+# Stamped on Subnet._allocation_pool_cache_version alongside every cache
+# write. Bump it whenever the way pools are computed or serialized changes
+# so caches written by older code are recomputed instead of trusted. Policy
+# changes are caught by Subnet._allocation_pool_cache_policy_revision.
+ALLOCATION_POOL_CACHE_VERSION = 1
+
 
 def _default_list_getset(collection_class, proxy):
     attr = proxy.value_attr
@@ -275,28 +283,6 @@ class DNSNameserver(BASEV2, models.HasTenant, models.HasId, IsHazTags):
                                                        ondelete="CASCADE"))
 
 
-def _pools_from_cidr(cidr):
-    cidrs = cidr.iter_cidrs()
-    if len(cidrs) == 0:
-        return []
-    if len(cidrs) == 1:
-        return [dict(start=str(cidrs[0][0]),
-                     end=str(cidrs[0][-1]))]
-
-    pool_start = cidrs[0][0]
-    prev_cidr_end = cidrs[0][-1]
-    pools = []
-    for cidr in cidrs[1:]:
-        cidr_start = cidr[0]
-        if prev_cidr_end + 1 != cidr_start:
-            pools.append(dict(start=str(pool_start),
-                              end=str(prev_cidr_end)))
-            pool_start = cidr_start
-        prev_cidr_end = cidr[-1]
-    pools.append(dict(start=str(pool_start), end=str(prev_cidr_end)))
-    return pools
-
-
 class Subnet(BASEV2, models.HasId, IsHazTags):
     """Upstream model for IPs.
 
@@ -317,6 +303,11 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
     network_id = sa.Column(sa.String(36), sa.ForeignKey('quark_networks.id'))
     _cidr = sa.Column(sa.String(64), nullable=False)
     _allocation_pool_cache = sa.Column(sa.Text(), nullable=True)
+    _allocation_pool_cache_version = sa.Column(sa.Integer(), nullable=True)
+    # IPPolicy.revision of the policy the cache was computed from
+    _allocation_pool_cache_policy_revision = sa.Column(sa.Integer(),
+                                                       nullable=True)
+    _free_address_index = sa.Column(sa.Text(), nullable=True)
     tenant_id = sa.Column(sa.String(255), index=True)
     segment_id = sa.Column(sa.String(255), index=True)
 
@@ -326,16 +317,37 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
 
     @hybrid.hybrid_property
     def allocation_pools(self):
-        _cache = self.get("_allocation_pool_cache")
-        if _cache:
-            pools = json.loads(_cache)
-            return pools
-        else:
-            ip_policy_cidrs = IPPolicy.get_ip_policy_cidrs(self)
-            cidr = netaddr.IPSet([netaddr.IPNetwork(self["cidr"])])
-            allocatable = cidr - ip_policy_cidrs
-            pools = _pools_from_cidr(allocatable)
-            return pools
+        if Subnet.allocation_pool_cache_is_current(self):
+            return json.loads(self["_allocation_pool_cache"])
+        return Subnet.compute_allocation_pools(self)
+
+    @staticmethod
+    def allocation_pool_cache_is_current(subnet):
+        return (bool(subnet.get("_allocation_pool_cache")) and
+                subnet.get("_allocation_pool_cache_version") ==
+                ALLOCATION_POOL_CACHE_VERSION and
+                subnet.get("_allocation_pool_cache_policy_revision") ==
+                Subnet.policy_revision(subnet))
+
+    @staticmethod
+    def policy_revision(subnet):
+        """Returns the revision of the subnet's IP policy, if it has one."""
+        return (subnet.get("ip_policy") or {}).get("revision")
+
+    @staticmethod
+    def compute_allocation_pools(subnet):
+        """Returns the subnet's CIDR less its IP policy, ignoring the cache.
+
+        Works on anything subscriptable with a cidr and ip_policy, so it can
+        be used to rebuild the cache as well as to read through it.
+        """
+        cidr = netaddr.IPNetwork(subnet["cidr"])
+        v6_cidr = cidr.ipv6()
+        policy = IPPolicy.get_ip_policy_ranges(subnet)
+        return [dict(start=str(policy_ranges.from_int(first, cidr.version)),
+                     end=str(policy_ranges.from_int(last, cidr.version)))
+                for first, last in policy.allowed(v6_cidr.first,
+                                                  v6_cidr.last)]
 
     @cidr.setter
     def cidr(self, val):
@@ -355,6 +367,20 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
     last_ip = sa.Column(custom_types.INET())
     ip_version = sa.Column(sa.Integer())
     next_auto_assign_ip = sa.Column(custom_types.INET())
+    # Denormalized from quark_ip_addresses so subnet selection doesn't have
+    # to count every address in the network. See subnet_update_usage_counts
+    allocated_count = sa.Column(sa.BigInteger(), nullable=False, default=0,
+                                server_default="0")
+    deallocated_reusable_count = sa.Column(sa.BigInteger(), nullable=False,
+                                           default=0, server_default="0")
+    # Materialized figures served by quark.ip_availability. The size is the
+    # CIDR less the IP policy, written with the policy caches. Used is moved
+    # along with the usage counters and recounted by refresh_ip_availability,
+    # which stamps ip_availability_refreshed_at.
+    ip_availability_size = sa.Column(custom_types.INET())
+    ip_availability_used = sa.Column(sa.BigInteger(), nullable=False,
+                                     default=0, server_default="0")
+    ip_availability_refreshed_at = sa.Column(sa.DateTime())
 
     allocated_ips = orm.relationship(IPAddress,
                                      primaryjoin='and_(Subnet.id=='
@@ -414,6 +440,10 @@ class SecurityGroup(BASEV2, models.HasId):
                              cascade='delete',
                              primaryjoin=join)
     tenant_id = sa.Column(sa.String(255), index=True)
+    # Bumped whenever a rule is added or removed, see
+    # db_api.security_group_bump_revision
+    revision = sa.Column(sa.Integer(), nullable=False, default=0,
+                         server_default="0")
 
 
 class Port(BASEV2, models.HasTenant, models.HasId, IsHazTags):
@@ -509,14 +539,43 @@ class IPPolicy(BASEV2, models.HasId, models.HasTenant):
     name = sa.Column(sa.String(255), nullable=True)
     description = sa.Column(sa.String(255), nullable=True)
     size = sa.Column(custom_types.INET())
+    # Bumped whenever exclude changes, see quark.ip_policy_cache
+    revision = sa.Column(sa.Integer(), nullable=False, default=0,
+                         server_default="0")
 
     @staticmethod
     def get_ip_policy_cidrs(subnet):
         ip_policy = subnet["ip_policy"] or {}
-        ip_policies = ip_policy.get("exclude", [])
-        ip_policy_cidrs = [ip_policy_cidr.cidr
-                           for ip_policy_cidr in ip_policies]
-        return netaddr.IPSet(ip_policy_cidrs)
+
+        def _build():
+            ip_policies = ip_policy.get("exclude", [])
+            ip_policy_cidrs = [ip_policy_cidr.cidr
+                               for ip_policy_cidr in ip_policies]
+            return netaddr.IPSet(ip_policy_cidrs)
+
+        return ip_policy_cache.IP_POLICY_CACHE.get(
+            IPPolicy._cache_id(ip_policy), ip_policy.get("revision"), _build)
+
+    @staticmethod
+    def get_ip_policy_ranges(subnet):
+        """Like get_ip_policy_cidrs, but as integer PolicyRanges.
+
+        Prefer this on hot paths, it never builds netaddr objects.
+        """
+        ip_policy = subnet.get("ip_policy") or {}
+        return ip_policy_cache.IP_POLICY_CACHE.get(
+            IPPolicy._cache_id(ip_policy), ip_policy.get("revision"),
+            lambda: policy_ranges.PolicyRanges.from_policy(ip_policy),
+            kind="ranges")
+
+    @staticmethod
+    def _cache_id(ip_policy):
+        """The id to cache the policy under, None while it is uncommitted."""
+        policy_id = ip_policy.get("id")
+        if isinstance(ip_policy, IPPolicy) and ip_policy_cache.is_pending(
+                orm.object_session(ip_policy), policy_id):
+            return None
+        return policy_id
 
 
 class IPPolicyCIDR(BASEV2, models.HasId):
@@ -0,0 +1,209 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Health aware selection of NVP controllers
+"""
+
+import collections
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+nvp_pool_opts = [
+    cfg.IntOpt("controller_error_window",
+               default=20,
+               help=_("Number of recent requests to each NVP controller "
+                      "its error rate is computed over")),
+    cfg.IntOpt("controller_error_min_requests",
+               default=5,
+               help=_("Requests a controller must have in its window before "
+                      "its error rate can eject it")),
+    cfg.FloatOpt("controller_error_threshold",
+                 default=0.5,
+                 help=_("Error rate over the window at which an NVP "
+                        "controller is ejected")),
+    cfg.IntOpt("controller_max_consecutive_failures",
+               default=3,
+               help=_("Consecutive failures after which an NVP controller "
+                      "is ejected regardless of its error rate")),
+    cfg.IntOpt("controller_ejection_seconds",
+               default=30,
+               help=_("Seconds an ejected NVP controller is skipped for. "
+                      "Afterwards a single request at a time is let through "
+                      "until one succeeds.")),
+    cfg.FloatOpt("controller_latency_decay",
+                 default=0.3,
+                 help=_("Weight of the newest sample in the moving average "
+                        "of each NVP controller's latency")),
+]
+
+CONF.register_opts(nvp_pool_opts, "NVP")
+
+
+class ControllerHealth(object):
+    def __init__(self):
+        self.outcomes = collections.deque(
+            maxlen=max(CONF.NVP.controller_error_window, 1))
+        self.latency = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    @property
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / float(len(self.outcomes))
+
+    def available(self, now):
+        if self.ejected_until is not None and now < self.ejected_until:
+            return False
+        # NOTE: once the cooldown ends a single request probes the
+        #       controller before it takes its share of traffic again
+        return not (self.probing and self.in_flight)
+
+    def score(self):
+        # NOTE: unmeasured controllers score 0 so each is tried once
+        return (self.latency or 0.0) * (self.in_flight + 1)
+
+
+class ControllerPool(object):
+    """Routes requests to the fastest healthy NVP controller.
+
+    controllers is the driver's list of connection dicts, shared rather
+    than copied so controllers added later are picked up; each dict gets
+    its ControllerHealth under "health". Callers acquire() an index, talk
+    to that controller and release() it with the elapsed time and whether
+    the controller answered. All bookkeeping happens under one lock, which
+    is green when eventlet has monkey patched threading.
+    """
+
+    def __init__(self, controllers):
+        self.controllers = controllers
+        self.start = 0
+        self._lock = threading.Lock()
+
+    def _health(self, index):
+        return self.controllers[index].setdefault("health",
+                                                  ControllerHealth())
+
+    def acquire(self):
+        """Returns the index of the controller to use, None if none exist."""
+        with self._lock:
+            count = len(self.controllers)
+            if not count:
+                return None
+            now = time.time()
+            order = [(self.start + i) % count for i in xrange(count)]
+            available = [i for i in order if self._health(i).available(now)]
+            if available:
+                index = min(available, key=lambda i: self._health(i).score())
+            else:
+                # NOTE: failing open beats refusing every request; the
+                #       controller closest to the end of its cooldown is
+                #       the most likely to have recovered
+                index = min(order,
+                            key=lambda i: self._health(i).ejected_until)
+                LOG.warning("All NVP controllers are ejected, using %s" %
+                            self.controllers[index].get("ip_address"))
+            health = self._health(index)
+            if (health.ejected_until is not None and
+                    now >= health.ejected_until):
+                health.ejected_until = None
+                health.probing = True
+            health.in_flight += 1
+            return index
+
+    def release(self, index, elapsed, healthy):
+        with self._lock:
+            health = self._health(index)
+            health.in_flight = max(health.in_flight - 1, 0)
+            health.requests += 1
+            health.outcomes.append(healthy)
+            if healthy:
+                if health.probing:
+                    # NOTE: the failures that got it ejected say nothing
+                    #       about how fast it is now
+                    health.latency = None
+                    health.probing = False
+                    LOG.info("NVP controller %s is back in rotation" %
+                             self.controllers[index].get("ip_address"))
+                self._sample_latency(health, elapsed)
+                health.consecutive_failures = 0
+                return
+
+            # NOTE: a failure counts as a request that took the whole
+            #       timeout, so a retry goes to another controller rather
+            #       than back to this one until it is ejected
+            self._sample_latency(health, max(
+                elapsed, self.controllers[index].get("http_timeout") or 0))
+            health.failures += 1
+            health.consecutive_failures += 1
+            if health.ejected_until is None and self._should_eject(health):
+                self._eject(index, health)
+
+    def _sample_latency(self, health, elapsed):
+        decay = CONF.NVP.controller_latency_decay
+        if health.latency is None:
+            health.latency = elapsed
+        else:
+            health.latency = decay * elapsed + (1 - decay) * health.latency
+
+    def _should_eject(self, health):
+        if health.probing:
+            return True
+        if (health.consecutive_failures >=
+                CONF.NVP.controller_max_consecutive_failures):
+            return True
+        return (len(health.outcomes) >=
+                CONF.NVP.controller_error_min_requests and
+                health.error_rate >= CONF.NVP.controller_error_threshold)
+
+    def _eject(self, index, health):
+        cooldown = CONF.NVP.controller_ejection_seconds
+        LOG.warning("Ejecting NVP controller %s for %ss after %d "
+                    "consecutive failures, error rate %.2f" % (
+                        self.controllers[index].get("ip_address"), cooldown,
+                        health.consecutive_failures, health.error_rate))
+        health.ejected_until = time.time() + cooldown
+        health.probing = False
+        health.ejections += 1
+        health.outcomes.clear()
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            stats = []
+            for index, conn in enumerate(self.controllers):
+                health = self._health(index)
+                stats.append(dict(ip_address=conn.get("ip_address"),
+                                  available=health.available(now),
+                                  latency=health.latency,
+                                  error_rate=health.error_rate,
+                                  in_flight=health.in_flight,
+                                  requests=health.requests,
+                                  failures=health.failures,
+                                  ejections=health.ejections))
+            return stats
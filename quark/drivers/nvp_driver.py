@@ -19,16 +19,21 @@ NVP client driver for Quark
 
 import contextlib
 import random
+import time
 
 import aiclib
 from neutron.extensions import securitygroup as sg_ext
 from oslo_config import cfg
 from oslo_log import log as logging
+import sqlalchemy as sa
 
+from quark.db import models
 from quark.drivers import base
+from quark.drivers import nvp_controller_pool
 from quark.drivers import security_groups as sg_driver
 from quark.environment import Capabilities
 from quark import exceptions
+from quark import lru_cache
 from quark import utils
 
 LOG = logging.getLogger(__name__)
@@ -58,21 +63,25 @@ nvp_opts = [
                help=_('Base seconds for exponential backoff')),
     cfg.BoolOpt("random_initial_controller",
                 default=False,
-                help=_("Whether or not to use a random controller or the "
-                       "first controller when neutron starts up")),
-    cfg.IntOpt("connection_switching_threshold",
-               default=0,
-               help=_("Number of times to use a connection before forcing "
-                      "the next connection in the list to be used. A value "
-                      "of 0 means only switch on Exceptions.")),
-    cfg.BoolOpt("connection_switching_random",
-                default=False,
-                help=_("Determines whether connections are switched randomly "
-                       "or using the default round-robin.")),
+                help=_("Whether or not to prefer a random controller or the "
+                       "first controller while controllers' latencies are "
+                       "equal, e.g. when neutron starts up")),
     cfg.IntOpt("operation_retries",
                default=3,
                help=_("Number of times to attempt to perform operations in "
                       "NVP.")),
+    cfg.IntOpt("lswitch_port_cache_size",
+               default=10000,
+               help=_("Number of lport to lswitch mappings each API worker "
+                      "remembers, sparing a wildcard lport query in NVP when "
+                      "ports are updated or deleted. 0 disables the "
+                      "cache.")),
+    cfg.FloatOpt("lswitch_precreate_threshold",
+                 default=0.9,
+                 help=_("Fraction of a network's lswitch capacity in use at "
+                        "which the optimized driver creates another lswitch "
+                        "in the background, ahead of demand. Only applies "
+                        "when max_ports_per_switch is set. 0 disables it.")),
 ]
 
 physical_net_type_map = {
@@ -95,10 +104,39 @@ def _tag_unroll(tags):
     return dict((t['scope'], t['tag']) for t in tags)
 
 
+def _controller_responded(e):
+    code = getattr(e, "code", None)
+    return (isinstance(e, aiclib.core.AICException) and
+            isinstance(code, int) and code < 500)
+
+
+class LSwitchPortCache(lru_cache.LRUCache):
+    """Bounded LRU of NVP lport uuid to the uuid of its lswitch.
+
+    An lport never moves between lswitches, so entries only go stale when
+    the lport is deleted behind our back; callers invalidate an entry when
+    NVP answers 404 for it.
+    """
+
+    size_opt = ("NVP", "lswitch_port_cache_size")
+
+    def get(self, port_id):
+        return self.lookup(port_id)
+
+    def set(self, port_id, lswitch_uuid):
+        if port_id and lswitch_uuid:
+            self.store(port_id, lswitch_uuid)
+
+    def invalidate(self, port_id):
+        self.discard(port_id)
+
+
 class NVPDriver(base.BaseDriver):
     def __init__(self):
         self.nvp_connections = []
-        self.conn_index = 0
+        self.lswitch_port_cache = LSwitchPortCache()
+        self.controller_pool = nvp_controller_pool.ControllerPool(
+            self.nvp_connections)
         self.limits = {'max_ports_per_switch': 0,
                        'max_rules_per_group': 0,
                        'max_rules_per_port': 0}
@@ -140,39 +178,28 @@ class NVPDriver(base.BaseDriver):
                                         retries=int(retries),
                                         redirects=redirects,
                                         default_tz=default_tz,
-                                        backoff=backoff,
-                                        usages=0))
+                                        backoff=backoff))
 
         if connections:
             if CONF.NVP.random_initial_controller:
-                self.conn_index = self._new_random_index(-1, len(connections))
+                self.controller_pool.start = random.randint(
+                    0, len(connections) - 1)
 
             LOG.info("NVP Driver config loaded. Starting with controller %s" %
-                     self.nvp_connections[self.conn_index]["ip_address"])
+                     self.nvp_connections[
+                         self.controller_pool.start]["ip_address"])
         else:
             LOG.critical("No NVP connection configurations found!")
 
-    def _new_random_index(self, current, index_range):
-        new_index = current
-        while new_index == current:
-            new_index = random.randint(0, index_range - 1)
-        return new_index
-
-    def _connection(self):
+    def _connection(self, index=None):
         if len(self.nvp_connections) == 0:
             raise exceptions.NoBackendConnectionsDefined(
                 msg="No NVP connections defined cannot continue")
 
-        conn = self.nvp_connections[self.conn_index]
-
-        if CONF.NVP.connection_switching_threshold > 0:
-            # NOTE(mdietz): This is racy. See get_connection below.
-            conn["usages"] += 1
-            if conn["usages"] >= CONF.NVP.connection_switching_threshold:
-                conn["usages"] = 0
-                self._next_connection()
-                conn = self.nvp_connections[self.conn_index]
+        conn = self.nvp_connections[index or 0]
 
+        # NOTE: two greenthreads may both build a connection here, the
+        #       loser's is simply dropped
         if "connection" not in conn:
             scheme = conn["port"] == "443" and "https" or "http"
             uri = "%s://%s:%s" % (scheme, conn["ip_address"], conn["port"])
@@ -189,40 +216,28 @@ class NVPDriver(base.BaseDriver):
                                                        backoff=backoff)
         return conn["connection"]
 
-    def _next_connection(self):
-        # TODO(anyone): Do we want to drop and create new connections at some
-        #               point? What about recycling them after a certain
-        #               number of usages or time, proactively?
-        LOG.info("Switching NVP connections...")
-        conn_len = len(self.nvp_connections)
-        if conn_len and conn_len > 1:
-            if CONF.NVP.connection_switching_random:
-                self.conn_index = self._new_random_index(self.conn_index,
-                                                         conn_len)
-                LOG.info("New connection chosen at random is %s" %
-                         self.nvp_connections[self.conn_index]["ip_address"])
-            else:
-                self.conn_index = (self.conn_index + 1) % conn_len
-                LOG.info("New connection chosen round-robin is %s" %
-                         self.nvp_connections[self.conn_index]["ip_address"])
-        else:
-            LOG.info("No other connections to choose from")
-
     @contextlib.contextmanager
     def get_connection(self):
+        """Yields a connection to the fastest healthy controller.
+
+        How long the block took and whether it failed are fed back to the
+        controller pool, which ejects controllers that keep failing. An
+        error the controller itself answered with, such as a 404, counts
+        as the controller being healthy.
+        """
+        index = self.controller_pool.acquire()
+        healthy = False
+        start = time.time()
         try:
-            yield self._connection()
-        except Exception:
-            # This is racy. A pile-up of failures could occur on one
-            # controller, causing them to rapidly switch and fail back
-            # to the original failing controller. However, we can't be in
-            # the business of implementing a load balancer inside the code.
-            # TODO(anyone): Investigate whether NVP is now giving us sequence
-            #               IDs. If so, rapid round-robining becomes plausible,
-            #               though we don't have an easy path to dropping bad
-            #               controllers.
-            self._next_connection()
+            yield self._connection(index)
+            healthy = True
+        except Exception as e:
+            healthy = _controller_responded(e)
             raise
+        finally:
+            if index is not None:
+                self.controller_pool.release(index, time.time() - start,
+                                             healthy)
 
     def create_network(self, context, network_name, tags=None,
                        network_id=None, **kwargs):
@@ -277,7 +292,13 @@ class NVPDriver(base.BaseDriver):
                     security_groups=None, device_id="", **kwargs):
         security_groups = security_groups or []
         tenant_id = context.tenant_id
-        lswitch = self._create_or_choose_lswitch(context, network_id)
+        lswitch = kwargs.get('lswitch_uuid')
+        if not lswitch:
+            lswitch = self._create_or_choose_lswitch(context, network_id)
+        profiles = []
+        if not self.sg_driver:
+            profiles = self._security_profiles_for_port(context,
+                                                        security_groups)
 
         @utils.retry_loop(CONF.NVP.operation_retries)
         def _create_lswitch_port():
@@ -285,9 +306,7 @@ class NVPDriver(base.BaseDriver):
                 port = connection.lswitch_port(lswitch)
                 port.admin_status_enabled(status)
                 if not self.sg_driver:
-                    nvp_group_ids = self._get_security_groups_for_port(
-                        context, security_groups)
-                    port.security_profiles(nvp_group_ids)
+                    port.security_profiles([p.nvp_id for p in profiles])
                 tags = [dict(tag=network_id, scope="neutron_net_id"),
                         dict(tag=port_id, scope="neutron_port_id"),
                         dict(tag=tenant_id, scope="os_tid"),
@@ -302,6 +321,9 @@ class NVPDriver(base.BaseDriver):
                 except TypeError:
                     LOG.exception("Unexpected return from NVP: %s" % res)
                     raise
+                self.lswitch_port_cache.set(res["uuid"], lswitch)
+                if profiles:
+                    self._lport_profiles_set(context, res["uuid"], profiles)
                 port = connection.lswitch_port(lswitch)
                 port.uuid = res["uuid"]
                 port.attachment_vif(port_id)
@@ -322,24 +344,51 @@ class NVPDriver(base.BaseDriver):
                 self.sg_driver.update_port(**kwargs)
             lswitch_id = self._lswitch_from_port(context, port_id)
             port = connection.lswitch_port(lswitch_id, port_id)
+            profiles = []
             if not self.sg_driver:
-                nvp_group_ids = self._get_security_groups_for_port(
-                    context, security_groups)
-                if nvp_group_ids:
-                    port.security_profiles(nvp_group_ids)
+                profiles = self._security_profiles_for_port(context,
+                                                            security_groups)
+                if profiles:
+                    port.security_profiles([p.nvp_id for p in profiles])
             port.admin_status_enabled(status)
-            return port.update()
+            try:
+                res = port.update()
+            except aiclib.core.AICException as ae:
+                if ae.code == 404:
+                    # NOTE: the retry looks the lswitch up in NVP again
+                    self.lswitch_port_cache.invalidate(port_id)
+                raise
+            if profiles:
+                self._lport_profiles_set(context, port_id, profiles)
+            return res
 
     @utils.retry_loop(CONF.NVP.operation_retries)
     def delete_port(self, context, port_id, **kwargs):
+        if not self.sg_driver:
+            # NOTE: the port is going away whatever NVP answers below
+            self._lport_profiles_clear(context, port_id)
         with self.get_connection() as connection:
             lswitch_uuid = kwargs.get('lswitch_uuid', None)
             try:
                 if not lswitch_uuid:
-                    lswitch_uuid = self._lswitch_from_port(context, port_id)
+                    lswitch_uuid = self._lswitch_from_deleted_port(context,
+                                                                   port_id)
                 LOG.debug("Deleting port %s from lswitch %s"
                           % (port_id, lswitch_uuid))
-                connection.lswitch_port(lswitch_uuid, port_id).delete()
+                try:
+                    connection.lswitch_port(lswitch_uuid, port_id).delete()
+                except aiclib.core.AICException as ae:
+                    if ae.code != 404 or kwargs.get('lswitch_uuid'):
+                        raise
+                    # NOTE: the mapping may have been stale, make sure the
+                    #       lport is really gone before ignoring the 404
+                    self.lswitch_port_cache.invalidate(port_id)
+                    actual_uuid = self._lswitch_query_by_port(context,
+                                                              port_id)
+                    if actual_uuid is None or actual_uuid == lswitch_uuid:
+                        raise
+                    connection.lswitch_port(actual_uuid, port_id).delete()
+                self.lswitch_port_cache.invalidate(port_id)
                 if self.sg_driver:
                     self.sg_driver.delete_port(**kwargs)
             except aiclib.core.AICException as ae:
@@ -454,13 +503,23 @@ class NVPDriver(base.BaseDriver):
                     dict(tag=tenant_id, scope="os_tid")]
             LOG.debug("Creating security profile %s" % group_name)
             profile.tags(tags)
-            return profile.create()
+            nvp_group = profile.create()
+        context.session.add(SecurityProfile(
+            id=group_id, nvp_id=nvp_group['uuid'],
+            rule_count=len(ingress_rules) + len(egress_rules)))
+        return nvp_group
 
     def delete_security_group(self, context, group_id, **kwargs):
-        guuid = self._get_security_group_id(context, group_id)
+        profile = self._query_security_group(context, group_id)
+        if profile:
+            guuid = profile.nvp_id
+        else:
+            guuid = self._security_group_query(context, group_id)['uuid']
         with self.get_connection() as connection:
             LOG.debug("Deleting security profile %s" % group_id)
             connection.securityprofile(guuid).delete()
+        if profile:
+            context.session.delete(profile)
 
     def update_security_group(self, context, group_id, **group):
         query = self._get_security_group(context, group_id)
@@ -482,7 +541,10 @@ class NVPDriver(base.BaseDriver):
                 profile.port_ingress_rules(ingress_rules)
             if group.get('port_egress_rules', None) is not None:
                 profile.port_egress_rules(egress_rules)
-            return profile.update()
+            res = profile.update()
+        self._security_profile_rules_counted(
+            context, group_id, len(ingress_rules) + len(egress_rules))
+        return res
 
     def _update_security_group_rules(self, context, group_id, rule, operation,
                                      checks):
@@ -638,6 +700,25 @@ class NVPDriver(base.BaseDriver):
             return query
 
     def _lswitch_from_port(self, context, port_id):
+        lswitch_uuid = self.lswitch_port_cache.get(port_id)
+        if lswitch_uuid is not None:
+            return lswitch_uuid
+        lswitch_uuid = self._lswitch_query_by_port(context, port_id)
+        if lswitch_uuid is None:
+            raise Exception("No lswitch found for port %s" % port_id)
+        self.lswitch_port_cache.set(port_id, lswitch_uuid)
+        return lswitch_uuid
+
+    def _lswitch_from_deleted_port(self, context, port_id):
+        """Like _lswitch_from_port, for a port that is being deleted."""
+        return self._lswitch_from_port(context, port_id)
+
+    def _lswitch_query_by_port(self, context, port_id):
+        """Asks NVP which lswitch the lport is on, None if it is on none.
+
+        This is a wildcard query across every lswitch in NVP, only made
+        when the lswitch isn't known locally.
+        """
         with self.get_connection() as connection:
             query = connection.lswitch_port("*").query()
             query.relations("LogicalSwitchConfig")
@@ -647,11 +728,19 @@ class NVPDriver(base.BaseDriver):
                 raise Exception("Could not identify lswitch for port %s" %
                                 port_id)
             if port['result_count'] < 1:
-                raise Exception("No lswitch found for port %s" % port_id)
+                return None
             cfg = port['results'][0]["_relations"]["LogicalSwitchConfig"]
             return cfg["uuid"]
 
     def _get_security_group(self, context, group_id):
+        guuid = self._get_security_group_id(context, group_id)
+        with self.get_connection() as connection:
+            return connection.securityprofile(guuid).read()
+
+    def _get_security_group_id(self, context, group_id):
+        return self._security_profile(context, group_id).nvp_id
+
+    def _security_group_query(self, context, group_id):
         with self.get_connection() as connection:
             query = connection.securityprofile().query()
             query.tagscopes(['os_tid', 'neutron_group_id'])
@@ -661,8 +750,34 @@ class NVPDriver(base.BaseDriver):
                 raise sg_ext.SecurityGroupNotFound(id=group_id)
             return query['results'][0]
 
-    def _get_security_group_id(self, context, group_id):
-        return self._get_security_group(context, group_id)['uuid']
+    def _query_security_group(self, context, group_id):
+        return context.session.query(SecurityProfile).filter(
+            SecurityProfile.id == group_id).first()
+
+    def _security_profile(self, context, group_id):
+        """Returns the local record of a group's NVP security profile.
+
+        Groups created before the driver kept these records are searched
+        for in NVP by their tags once, then recorded.
+        """
+        profile = self._query_security_group(context, group_id)
+        if profile is None:
+            nvp_group = self._security_group_query(context, group_id)
+            profile = SecurityProfile(
+                id=group_id, nvp_id=nvp_group['uuid'],
+                rule_count=self._check_rule_count_for_groups(
+                    context, [nvp_group]))
+            context.session.add(profile)
+        return profile
+
+    def _security_profile_rules_counted(self, context, group_id, rule_count):
+        profile = self._query_security_group(context, group_id)
+        if profile is None:
+            return
+        delta = rule_count - (profile.rule_count or 0)
+        profile.rule_count = rule_count
+        if delta:
+            self._lport_rule_counts_shift(context, group_id, delta)
 
     def _get_security_group_rule_object(self, context, rule):
         ethertype = rule.get('ethertype', None)
@@ -688,6 +803,11 @@ class NVPDriver(base.BaseDriver):
             return (direction, secrule)
 
     def _check_rule_count_per_port(self, context, group_id):
+        count = self._lport_rule_count_max(context, group_id)
+        if count is not None:
+            return count
+        # NOTE: Ports the driver has no records of are counted in NVP, which
+        #       is also what a group that is on no ports costs.
         with self.get_connection() as connection:
             ports = connection.lswitch_port("*").query().security_profile_uuid(
                 '=', self._get_security_group_id(
@@ -703,12 +823,69 @@ class NVPDriver(base.BaseDriver):
                    len(group['logical_port_egress_rules'])
                    for group in groups)
 
-    def _get_security_groups_for_port(self, context, groups):
-        if (self._check_rule_count_for_groups(
-                context,
-                (self._get_security_group(context, g) for g in groups))
-                > self.limits['max_rules_per_port']):
+    def _security_profiles_for_port(self, context, groups):
+        profiles = [self._security_profile(context, g) for g in groups]
+        if (sum(p.rule_count or 0 for p in profiles) >
+                self.limits['max_rules_per_port']):
             raise exceptions.DriverLimitReached(limit="rules per port")
+        return profiles
 
-        return [self._get_security_group(context, group)['uuid']
-                for group in groups]
+    def _get_security_groups_for_port(self, context, groups):
+        return [p.nvp_id
+                for p in self._security_profiles_for_port(context, groups)]
+
+    def _lport_ids_for_group(self, context, group_id):
+        return context.session.query(LPortSecurityProfile.port_id).filter(
+            LPortSecurityProfile.profile_id == group_id).subquery()
+
+    def _lport_profiles_set(self, context, port_id, profiles):
+        self._lport_profiles_clear(context, port_id)
+        for profile in profiles:
+            context.session.add(LPortSecurityProfile(port_id=port_id,
+                                                     profile_id=profile.id))
+        context.session.add(LPortRuleCount(
+            port_id=port_id,
+            rule_count=sum(p.rule_count or 0 for p in profiles)))
+
+    def _lport_profiles_clear(self, context, port_id):
+        for model in (LPortSecurityProfile, LPortRuleCount):
+            context.session.query(model).filter(
+                model.port_id == port_id).delete(synchronize_session=False)
+
+    def _lport_rule_counts_shift(self, context, group_id, delta):
+        context.session.query(LPortRuleCount).filter(
+            LPortRuleCount.port_id.in_(
+                self._lport_ids_for_group(context, group_id))).update(
+            {LPortRuleCount.rule_count: LPortRuleCount.rule_count + delta},
+            synchronize_session=False)
+
+    def _lport_rule_count_max(self, context, group_id):
+        """Most rules on any lport the group is on, None if it is on none."""
+        return context.session.query(
+            sa.func.max(LPortRuleCount.rule_count)).filter(
+            LPortRuleCount.port_id.in_(
+                self._lport_ids_for_group(context, group_id))).scalar()
+
+
+class SecurityProfile(models.BASEV2, models.HasId):
+    __tablename__ = "quark_nvp_driver_security_profile"
+    nvp_id = sa.Column(sa.String(36), nullable=False, index=True)
+    rule_count = sa.Column(sa.Integer(), nullable=False, default=0,
+                           server_default="0")
+
+
+class LPortSecurityProfile(models.BASEV2, models.HasId):
+    __tablename__ = "quark_nvp_driver_lport_security_profile"
+    port_id = sa.Column(sa.String(36), nullable=False, index=True)
+    profile_id = sa.Column(sa.String(36),
+                           sa.ForeignKey(
+                               "quark_nvp_driver_security_profile.id",
+                               ondelete="CASCADE"),
+                           nullable=False, index=True)
+
+
+class LPortRuleCount(models.BASEV2, models.HasId):
+    __tablename__ = "quark_nvp_driver_lport_rule_count"
+    port_id = sa.Column(sa.String(36), nullable=False, index=True,
+                        unique=True)
+    rule_count = sa.Column(sa.Integer(), nullable=False, default=0)
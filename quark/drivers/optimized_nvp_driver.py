@@ -17,21 +17,32 @@
 Optimized NVP client for Quark
 """
 
+import random
+import threading
+
 import aiclib
+from neutron import context as neutron_context
+from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 
 from quark.db import models
 from quark.drivers.nvp_driver import NVPDriver
+from quark import exceptions
 
 import sqlalchemy as sa
 from sqlalchemy import orm
 
 LOG = logging.getLogger(__name__)
 
+CONF = cfg.CONF
+
 
 class OptimizedNVPDriver(NVPDriver):
     def __init__(self):
         super(OptimizedNVPDriver, self).__init__()
+        self._precreating = set()
+        self._precreate_lock = threading.Lock()
 
     @classmethod
     def get_name(klass):
@@ -70,22 +81,20 @@ class OptimizedNVPDriver(NVPDriver):
                     status=True, security_groups=None,
                     device_id="", **kwargs):
         security_groups = security_groups or []
-        nvp_port = super(OptimizedNVPDriver, self).create_port(
-            context, network_id, port_id, status=status,
-            security_groups=security_groups, device_id=device_id)
-        switch_nvp_id = nvp_port["lswitch"]
-
-        # slightly inefficient for the sake of brevity. Lets the
-        # parent class do its thing then finds the switch that
-        # the port was created on for creating the association. Switch should
-        # be in the query cache so the subsequent lookup should be minimal,
-        # but this could be an easy optimization later if we're looking.
-        switch = self._lswitch_select_by_nvp_id(context, switch_nvp_id)
+        switch = self._lswitch_reserve(context, network_id)
+        try:
+            nvp_port = super(OptimizedNVPDriver, self).create_port(
+                context, network_id, port_id, status=status,
+                security_groups=security_groups, device_id=device_id,
+                lswitch_uuid=switch.nvp_id)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._lswitch_port_count_add(context, switch, -1)
 
         new_port = LSwitchPort(port_id=nvp_port["uuid"],
                                switch_id=switch.id)
         context.session.add(new_port)
-        switch.port_count = switch.port_count + 1
+        self._lswitch_precreate_check(context, network_id)
         return nvp_port
 
     def update_port(self, context, port_id, status=True,
@@ -97,10 +106,18 @@ class OptimizedNVPDriver(NVPDriver):
             context, port_id, mac_address=mac_address, device_id=device_id,
             status=status, security_groups=security_groups)
         port = self._lport_select_by_id(context, port_id)
-        port.update(nvp_port)
+        if port:
+            port.update(nvp_port)
 
     def delete_port(self, context, port_id, **kwargs):
         port = self._lport_select_by_id(context, port_id)
+        if not port:
+            # NOTE: nothing to account for locally, the parent finds the
+            #       lswitch in NVP
+            LOG.info("LSwitchPort/Port %s not found in database, deleting"
+                     " it from NVP directly" % port_id)
+            return super(OptimizedNVPDriver, self).delete_port(
+                context, port_id, **kwargs)
         switch = port.switch
         try:
             self._lport_delete(context, port_id, switch)
@@ -124,7 +141,7 @@ class OptimizedNVPDriver(NVPDriver):
         LOG.info("Deleting LSwitchPort/Port %s from original"
                  " table." % port_id)
         context.session.delete(port)
-        switch.port_count = switch.port_count - 1
+        self._lswitch_port_count_add(context, switch, -1)
         if switch.port_count == 0:
             switches = self._lswitches_for_network(
                 context, switch.network_id)
@@ -138,19 +155,6 @@ class OptimizedNVPDriver(NVPDriver):
         super(OptimizedNVPDriver, self).delete_port(
             context, port_id, lswitch_uuid=switch.nvp_id)
 
-    def create_security_group(self, context, group_name, **group):
-        nvp_group = super(OptimizedNVPDriver, self).create_security_group(
-            context, group_name, **group)
-        group_id = group.get('group_id')
-        profile = SecurityProfile(id=group_id, nvp_id=nvp_group['uuid'])
-        context.session.add(profile)
-
-    def delete_security_group(self, context, group_id, **kwargs):
-        super(OptimizedNVPDriver, self).delete_security_group(
-            context, group_id)
-        group = self._query_security_group(context, group_id)
-        context.session.delete(group)
-
     def _lport_select_by_id(self, context, port_id):
         query = context.session.query(LSwitchPort)
         query = query.filter(LSwitchPort.port_id == port_id)
@@ -177,8 +181,7 @@ class OptimizedNVPDriver(NVPDriver):
         query = query.filter(LSwitch.port_count <
                              self.limits['max_ports_per_switch'])
         query = query.filter(LSwitch.network_id == network_id)
-        switch = query.order_by(LSwitch.port_count).first()
-        return switch
+        return query.all()
 
     def _lswitch_status_query(self, context, network_id):
         """Child implementation of lswitch_status_query.
@@ -192,11 +195,118 @@ class OptimizedNVPDriver(NVPDriver):
         if self.limits['max_ports_per_switch'] == 0:
             switch = self._lswitch_select_first(context, network_id)
         else:
-            switch = self._lswitch_select_free(context, network_id)
+            switches = self._lswitch_select_free(context, network_id)
+            switch = switches and random.choice(switches)
         if switch:
             return switch.nvp_id
         LOG.debug("Could not find optimized switch")
 
+    def _lswitch_reserve(self, context, network_id):
+        """Takes a port slot on one of the network's lswitches.
+
+        Candidates are tried in random order so concurrent creates spread
+        across switches instead of all racing for the emptiest one. An
+        lswitch is only created here when every switch is full, which the
+        background precreation should make rare.
+        """
+        max_ports = self.limits['max_ports_per_switch']
+        if max_ports == 0:
+            switches = [self._lswitch_select_first(context, network_id)]
+        else:
+            switches = self._lswitch_select_free(context, network_id) or []
+            random.shuffle(switches)
+        for switch in switches:
+            if switch and self._lswitch_port_count_add(context, switch, 1,
+                                                       max_ports):
+                return switch
+
+        LOG.debug("Could not reserve a port on an optimized switch for "
+                  "network %s, creating one" % network_id)
+        switch = self._lswitch_create_for_network(context, network_id)
+        # NOTE: no one else can see the new switch until it is flushed, which
+        #       also lets a failed create give the slot back like any other
+        switch.port_count = 1
+        context.session.flush()
+        return switch
+
+    def _lswitch_port_count_add(self, context, switch, delta, max_ports=0):
+        """Atomically moves a switch's port_count by delta.
+
+        With max_ports the count is only moved while it is below it.
+        Returns whether the count was moved.
+        """
+        query = context.session.query(LSwitch)
+        query = query.filter(LSwitch.id == switch.id)
+        if max_ports:
+            query = query.filter(LSwitch.port_count < max_ports)
+        updated = query.update(
+            {LSwitch.port_count: LSwitch.port_count + delta},
+            synchronize_session=False)
+        if updated == 1:
+            context.session.expire(switch, ["port_count"])
+            return True
+        return False
+
+    def _lswitch_usage(self, context, network_id):
+        """Returns the ports in use and the capacity of a network."""
+        used, switch_count = context.session.query(
+            sa.func.sum(LSwitch.port_count), sa.func.count(LSwitch.id)).filter(
+            LSwitch.network_id == network_id).one()
+        return (used or 0,
+                switch_count * self.limits['max_ports_per_switch'])
+
+    def _lswitch_precreate_check(self, context, network_id):
+        threshold = CONF.NVP.lswitch_precreate_threshold
+        if not threshold or self.limits['max_ports_per_switch'] == 0:
+            return
+        used, capacity = self._lswitch_usage(context, network_id)
+        if capacity and used >= threshold * capacity:
+            self._lswitch_precreate(context, network_id)
+
+    def _lswitch_precreate(self, context, network_id):
+        """Creates an lswitch for a filling network in the background.
+
+        The switch is created with a context of its own, after checking
+        again that the network still needs it. Each API worker creates at
+        most one switch per network at a time.
+        """
+        with self._precreate_lock:
+            if network_id in self._precreating:
+                return
+            self._precreating.add(network_id)
+        details = self._get_network_details(context, network_id, None)
+        if not details:
+            self._precreate_done(network_id)
+            return
+        user_id, tenant_id = context.user_id, context.tenant_id
+
+        def _precreate():
+            try:
+                ctx = neutron_context.Context(user_id, tenant_id)
+                with ctx.session.begin():
+                    used, capacity = self._lswitch_usage(ctx, network_id)
+                    if used < (CONF.NVP.lswitch_precreate_threshold *
+                               capacity):
+                        return
+                    LOG.info("Creating an lswitch for network %s ahead of "
+                             "demand, %s of %s ports in use"
+                             % (network_id, used, capacity))
+                    self._lswitch_create_switch(ctx, network_id=network_id,
+                                                **details)
+            except Exception:
+                LOG.exception("Failed to create an lswitch ahead of demand "
+                              "for network %s" % network_id)
+            finally:
+                self._precreate_done(network_id)
+
+        thread = threading.Thread(target=_precreate)
+        thread.daemon = True
+        thread.start()
+
+    def _precreate_done(self, network_id):
+        with self._precreate_lock:
+            self._precreating.discard(network_id)
+
     def _get_network_details(self, context, network_id, switches):
         name, phys_net, phys_type, segment_id = None, None, None, None
         switch = self._lswitch_select_first(context, network_id)
@@ -210,10 +320,22 @@ class OptimizedNVPDriver(NVPDriver):
 
     def _lswitch_create(self, context, network_name=None, tags=None,
                         network_id=None, **kwargs):
+        return self._lswitch_create_switch(context, network_name, tags,
+                                           network_id, **kwargs).nvp_id
+
+    def _lswitch_create_switch(self, context, network_name=None, tags=None,
+                               network_id=None, **kwargs):
         nvp_id = super(OptimizedNVPDriver, self)._lswitch_create(
             context, network_name, tags, network_id, **kwargs)
         return self._lswitch_create_optimized(context, network_name, nvp_id,
-                                              network_id, **kwargs).nvp_id
+                                              network_id, **kwargs)
+
+    def _lswitch_create_for_network(self, context, network_id):
+        details = self._get_network_details(context, network_id, None)
+        if not details:
+            raise exceptions.BadNVPState(net_id=network_id)
+        return self._lswitch_create_switch(context, network_id=network_id,
+                                           **details)
 
     def _lswitch_create_optimized(self, context, network_name, nvp_id,
                                   network_id, phys_net=None, phys_type=None,
@@ -233,11 +355,29 @@ class OptimizedNVPDriver(NVPDriver):
 
     def _lswitch_from_port(self, context, port_id):
         port = self._lport_select_by_id(context, port_id)
-        return port.switch.nvp_id
+        if port:
+            return port.switch.nvp_id
 
-    def _query_security_group(self, context, group_id):
-        return context.session.query(SecurityProfile).filter(
-            SecurityProfile.id == group_id).first()
+        # NOTE: ports created before the driver kept LSwitchPort rows fall
+        #       back to NVP, and are recorded if their lswitch is known
+        lswitch_uuid = super(OptimizedNVPDriver, self)._lswitch_from_port(
+            context, port_id)
+        switch = self._lswitch_select_by_nvp_id(context, lswitch_uuid)
+        if switch:
+            LOG.info("Recording LSwitchPort/Port %s on LSwitch %s found in"
+                     " NVP" % (port_id, lswitch_uuid))
+            context.session.add(LSwitchPort(port_id=port_id,
+                                            switch_id=switch.id))
+            # NOTE: keeps port_count in step with the rows, which delete_port
+            #       decrements it by
+            self._lswitch_port_count_add(context, switch, 1)
+        return lswitch_uuid
+
+    def _lswitch_from_deleted_port(self, context, port_id):
+        # NOTE: not recorded like _lswitch_from_port does, nothing would
+        #       remove the row once the lport is gone
+        return super(OptimizedNVPDriver, self)._lswitch_from_port(context,
+                                                                  port_id)
 
     def _make_security_rule_dict(self, rule):
         res = {"port_range_min": rule.get("port_range_min"),
@@ -258,19 +398,10 @@ class OptimizedNVPDriver(NVPDriver):
         for rule in group.rules:
             rulelist[rule.direction].append(
                 self._make_security_rule_dict(rule))
-        return {'uuid': self._query_security_group(context, group_id).nvp_id,
+        return {'uuid': self._get_security_group_id(context, group_id),
                 'logical_port_ingress_rules': rulelist['ingress'],
                 'logical_port_egress_rules': rulelist['egress']}
 
-    def _check_rule_count_per_port(self, context, group_id):
-        ports = context.session.query(models.SecurityGroup).filter(
-            models.SecurityGroup.id == group_id).first().get('ports', [])
-        groups = (set(group.id for group in port.get('security_groups', []))
-                  for port in ports)
-        return max(self._check_rule_count_for_groups(
-            context, (self._get_security_group(context, id) for id in g))
-            for g in groups)
-
 
 class LSwitchPort(models.BASEV2, models.HasId):
     __tablename__ = "quark_nvp_driver_lswitchport"
@@ -299,11 +430,6 @@ class QOS(models.BASEV2, models.HasId):
     min_bandwidth_rate = sa.Column(sa.Integer(), nullable=False)
 
 
-class SecurityProfile(models.BASEV2, models.HasId):
-    __tablename__ = "quark_nvp_driver_security_profile"
-    nvp_id = sa.Column(sa.String(36), nullable=False, index=True)
-
-
 class OrphanedLSwitch(models.BASEV2, models.HasId):
     __tablename__ = "quark_nvp_orphaned_lswitches"
     nvp_id = sa.Column(sa.String(36), nullable=False, index=True)
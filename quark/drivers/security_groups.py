@@ -13,13 +13,26 @@
 #    License for the specific language governing permissions and limitations
 #
 
+from oslo_config import cfg
 from oslo_log import log as logging
 
 from quark.cache import security_groups_client as sg_client
+from quark.db import api as db_api
 from quark import environment as env
+from quark import exceptions as q_exc
 
+CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+quark_opts = [
+    cfg.IntOpt("security_group_fanout_batch_size",
+               default=200,
+               help=_("Number of ports whose rules are written to redis in "
+                      "one pipeline when a security group's rules change"))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
 
 class SecurityGroupDriver(object):
     @env.has_capability(env.Capabilities.SECURITY_GROUPS)
@@ -50,3 +63,42 @@ class SecurityGroupDriver(object):
             client.delete_vif(device_id, mac_address)
         except Exception:
             LOG.exception("Failed to reach the security groups backend")
+
+    @env.has_capability(env.Capabilities.SECURITY_GROUPS)
+    def update_group_rules(self, context, group_ids):
+        """Pushes current rules to every port in any of group_ids.
+
+        Member ports are read in batches of
+        QUARK.security_group_fanout_batch_size, each written to redis in a
+        single pipeline. Group payloads come from the serialized group
+        cache, so each group is serialized once per revision however many
+        ports share it.
+
+        Returns a dict with the number of member ports found, the number
+        written and the ids of the ports whose batch failed to write.
+        """
+        client = sg_client.SecurityGroupsClient()
+        result = dict(ports=0, written=0, failed=[])
+        batches = db_api.security_group_port_batches(
+            context, group_ids, CONF.QUARK.security_group_fanout_batch_size)
+        for ports in batches:
+            vifs = []
+            for port in ports:
+                if not port["device_id"] or not port["mac_address"]:
+                    continue
+                rules = client.serialize_groups(port.security_groups)
+                vifs.append((port["device_id"], port["mac_address"], rules))
+
+            result["ports"] += len(ports)
+            try:
+                client.apply_rules_many(vifs)
+                result["written"] += len(vifs)
+            except q_exc.RedisConnectionFailure:
+                LOG.exception("Failed to write security group rules for "
+                              "ports %s" % [port["id"] for port in ports])
+                result["failed"].extend(port["id"] for port in ports)
+            LOG.info("Security group(s) %s: wrote rules for %d of %d "
+                     "member port(s) so far, %d failed" %
+                     (group_ids, result["written"], result["ports"],
+                      len(result["failed"])))
+        return result
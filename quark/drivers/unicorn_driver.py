@@ -18,7 +18,10 @@ Unicorn driver for Quark
 """
 
 import json
+import threading
+
 import requests
+from requests.packages.urllib3.util import retry as urllib3_retry
 
 from oslo_config import cfg
 from oslo_log import log as logging
@@ -32,32 +35,120 @@ LOG = logging.getLogger(__name__)
 quark_router_opts = [
     cfg.StrOpt('floating_ip_base_url',
                default='http://localhost:8080/v1.0/floating_ips',
-               help=_('floating ips base url'))
+               help=_('floating ips base url')),
+    cfg.FloatOpt('floating_ip_connect_timeout',
+                 default=3.0,
+                 help=_('Seconds to wait for a connection to the unicorn '
+                        'API')),
+    cfg.FloatOpt('floating_ip_read_timeout',
+                 default=10.0,
+                 help=_('Seconds to wait for the unicorn API to respond')),
+    cfg.IntOpt('floating_ip_retries',
+               default=3,
+               help=_('Times a request to the unicorn API is retried. '
+                      'Connection failures are retried for every request, '
+                      'read failures and 502/503/504 responses only for the '
+                      'idempotent PUT and DELETE.')),
+    cfg.FloatOpt('floating_ip_retry_backoff',
+                 default=0.5,
+                 help=_('Backoff factor between retries to the unicorn API; '
+                        'the Nth retry sleeps factor * 2 ** (N - 1) '
+                        'seconds')),
+    cfg.IntOpt('floating_ip_pool_size',
+               default=10,
+               help=_('Keep-alive connections to the unicorn API each API '
+                      'worker holds open')),
+    cfg.IntOpt('floating_ip_bulk_concurrency',
+               default=8,
+               help=_('Requests in flight at once when re-registering '
+                      'floating ips in bulk'))
 ]
 
 CONF.register_opts(quark_router_opts, "QUARK")
 
 
+RETRY_STATUSES = (502, 503, 504)
+
+
 class UnicornDriver(object):
     def __init__(self):
-        pass
+        self._session = None
+        self._session_lock = threading.Lock()
 
     @classmethod
     def get_name(cls):
         return "Unicorn"
 
+    @property
+    def session(self):
+        """A requests.Session whose connections to unicorn are kept alive.
+
+        It is created on first use, so the options are read after the
+        configuration is loaded, and shared by every thread of the worker.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    @staticmethod
+    def _build_session():
+        retries = CONF.QUARK.floating_ip_retries
+        # NOTE: a POST that reached unicorn may have been applied, so only
+        #       connection failures are retried for it. Running out of
+        #       retries on a status raises requests.exceptions.RetryError.
+        max_retries = urllib3_retry.Retry(
+            total=retries, connect=retries, read=retries,
+            backoff_factor=CONF.QUARK.floating_ip_retry_backoff,
+            status_forcelist=RETRY_STATUSES,
+            method_whitelist=frozenset(["PUT", "DELETE"]))
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=CONF.QUARK.floating_ip_pool_size,
+            max_retries=max_retries)
+        session = requests.Session()
+        session.headers["Content-Type"] = "application/json"
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def reset_session(self):
+        with self._session_lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    def _request(self, method, url, **kwargs):
+        kwargs["timeout"] = (CONF.QUARK.floating_ip_connect_timeout,
+                             CONF.QUARK.floating_ip_read_timeout)
+        return self.session.request(method, url, **kwargs)
+
+    @staticmethod
+    def _error_message(r):
+        try:
+            message = r.json()
+        except ValueError:
+            message = r.text
+        return "Unexpected status from unicorn API: Status Code %s, " \
+               "Message: %s" % (r.status_code, message)
+
     def register_floating_ip(self, floating_ip, port, fixed_ip):
-        url = CONF.QUARK.floating_ip_base_url
         req = self._build_request_body(floating_ip, port, fixed_ip)
+        self._post_floating_ip(floating_ip["id"], req)
+
+    def _post_floating_ip(self, floating_ip_id, req):
+        url = CONF.QUARK.floating_ip_base_url
 
         LOG.info("Calling unicorn to register floating ip: %s %s" % (url, req))
-        r = requests.post(url, data=json.dumps(req))
+        try:
+            r = self._request("POST", url, data=json.dumps(req))
+        except requests.RequestException as e:
+            LOG.error("register_floating_ip: %s" % e)
+            raise ex.RegisterFloatingIpFailure(id=floating_ip_id)
 
         if r.status_code != 200 and r.status_code != 201:
-            msg = "Unexpected status from unicorn API: Status Code %s, " \
-                  "Message: %s" % (r.status_code, r.json())
-            LOG.error("register_floating_ip: %s" % msg)
-            raise ex.RegisterFloatingIpFailure(id=floating_ip.id)
+            LOG.error("register_floating_ip: %s" % self._error_message(r))
+            raise ex.RegisterFloatingIpFailure(id=floating_ip_id)
 
     def update_floating_ip(self, floating_ip, port, fixed_ip):
         url = "%s/%s" % (CONF.QUARK.floating_ip_base_url,
@@ -65,12 +156,14 @@ class UnicornDriver(object):
         req = self._build_request_body(floating_ip, port, fixed_ip)
 
         LOG.info("Calling unicorn to register floating ip: %s %s" % (url, req))
-        r = requests.put(url, data=json.dumps(req))
+        try:
+            r = self._request("PUT", url, data=json.dumps(req))
+        except requests.RequestException as e:
+            LOG.error("register_floating_ip: %s" % e)
+            raise ex.RegisterFloatingIpFailure(id=floating_ip.id)
 
         if r.status_code != 200 and r.status_code != 201:
-            msg = "Unexpected status from unicorn API: Status Code %s, " \
-                  "Message: %s" % (r.status_code, r.json())
-            LOG.error("register_floating_ip: %s" % msg)
+            LOG.error("register_floating_ip: %s" % self._error_message(r))
             raise ex.RegisterFloatingIpFailure(id=floating_ip.id)
 
     def remove_floating_ip(self, floating_ip):
@@ -78,17 +171,73 @@ class UnicornDriver(object):
                          floating_ip.address_readable)
 
         LOG.info("Calling unicorn to remove floating ip: %s" % url)
-        r = requests.delete(url)
+        try:
+            r = self._request("DELETE", url)
+        except requests.RequestException as e:
+            LOG.error("remove_floating_ip: %s" % e)
+            raise ex.RemoveFloatingIpFailure(id=floating_ip.id)
 
         if r.status_code == 404:
             LOG.warn("The floating IP %s does not exist in the unicorn system."
                      % floating_ip.address_readable)
         elif r.status_code != 204:
-            msg = "Unexpected status from unicorn API: Status Code %s, " \
-                  "Message: %s" % (r.status_code, r.json())
-            LOG.error("remove_floating_ip: %s" % msg)
+            LOG.error("remove_floating_ip: %s" % self._error_message(r))
             raise ex.RemoveFloatingIpFailure(id=floating_ip.id)
 
+    def register_floating_ips(self, registrations, concurrency=None):
+        """Registers many floating ips, e.g. after unicorn is restarted.
+
+        registrations is an iterable of (floating_ip, port, fixed_ip) as
+        taken by register_floating_ip. Every request body is built on the
+        calling thread before any request is sent, so the database session
+        behind the models is never touched by the workers. At most
+        concurrency requests, by default floating_ip_bulk_concurrency, are
+        in flight at once, sharing the session's keep-alive connections.
+
+        Returns the number registered and the ids of those that failed.
+        """
+        concurrency = concurrency or CONF.QUARK.floating_ip_bulk_concurrency
+        result = dict(registered=0, failed=[])
+        requests_ = []
+        for floating_ip, port, fixed_ip in registrations:
+            try:
+                req = self._build_request_body(floating_ip, port, fixed_ip)
+            except Exception:
+                LOG.exception("Failed to build the request for floating ip "
+                              "%s" % floating_ip["id"])
+                result["failed"].append(floating_ip["id"])
+            else:
+                requests_.append((floating_ip["id"], req))
+        requests_ = iter(requests_)
+        lock = threading.Lock()
+
+        def _worker():
+            while True:
+                with lock:
+                    request = next(requests_, None)
+                if request is None:
+                    return
+                floating_ip_id, req = request
+                try:
+                    self._post_floating_ip(floating_ip_id, req)
+                except Exception:
+                    LOG.exception("Failed to register floating ip %s" %
+                                  floating_ip_id)
+                    with lock:
+                        result["failed"].append(floating_ip_id)
+                else:
+                    with lock:
+                        result["registered"] += 1
+
+        workers = [threading.Thread(target=_worker)
+                   for _ in xrange(max(concurrency, 1))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return result
+
     @staticmethod
     def _build_request_body(floating_ip, port, fixed_ip):
         fixed_ips = [{"ip_address": ip.address_readable,
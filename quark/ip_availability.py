@@ -26,6 +26,7 @@ from oslo_log import log as logging
 from oslo_utils import timeutils
 from sqlalchemy import and_, or_, func, not_
 
+from quark.db import api as db_api
 from quark.db import models
 
 LOG = logging.getLogger(__name__)
@@ -46,13 +47,104 @@ def main():
 
 
 def get_ip_availability(**kwargs):
+    """Returns used and unused IP counts per segment_id.
+
+    The counts are read from the availability materialized on each subnet,
+    see get_materialized_ips. Subnets that have never been refreshed are
+    counted from the addresses instead. age is the number of seconds since
+    the least recently refreshed subnet was recounted, or None when nothing
+    was served from the materialized counts.
+    """
     LOG.debug("Begin querying %s" % kwargs)
-    used_ips = get_used_ips(neutron_db_api.get_session(use_slave=True),
-                            **kwargs)
-    unused_ips = get_unused_ips(neutron_db_api.get_session(use_slave=True),
-                                used_ips, **kwargs)
+    session = neutron_db_api.get_session(use_slave=True)
+    used_ips, unused_ips, refreshed_at, unrefreshed = get_materialized_ips(
+        session, **kwargs)
+    if unrefreshed:
+        LOG.debug("Counting %d unrefreshed subnet(s)" % len(unrefreshed))
+        kwargs["subnet_id"] = unrefreshed
+        counted_used = get_used_ips(session, **kwargs)
+        counted_unused = get_unused_ips(session, counted_used, **kwargs)
+        for segment_id, count in counted_used.iteritems():
+            used_ips[segment_id] += count
+        for segment_id, count in counted_unused.iteritems():
+            unused_ips[segment_id] += count
     LOG.debug("End querying")
-    return dict(used=used_ips, unused=unused_ips)
+
+    age = None
+    if refreshed_at is not None:
+        age = int(timeutils.delta_seconds(refreshed_at, timeutils.utcnow()))
+    return dict(used=used_ips, unused=unused_ips, age=age)
+
+
+def get_materialized_ips(session, **kwargs):
+    """Sums the materialized availability of subnets per segment_id.
+
+    Returns (used, unused, refreshed_at, unrefreshed) where refreshed_at is
+    the oldest refresh among the summed subnets and unrefreshed lists the
+    ids of subnets without materialized counts, which are left out of the
+    sums. Deallocated addresses still inside their reuse window aren't
+    materialized, as they expire with time rather than with an event. They
+    are counted here instead, which only reads recent deallocations.
+    """
+    LOG.debug("Getting materialized IPs...")
+    with session.begin():
+        query = session.query(
+            models.Subnet.id,
+            models.Subnet.segment_id,
+            models.Subnet.ip_availability_size,
+            models.Subnet.ip_availability_used,
+            models.Subnet.ip_availability_refreshed_at)
+        query = _filter(query, **kwargs)
+
+        used_ips, unused_ips = defaultdict(int), defaultdict(int)
+        oldest, unrefreshed = None, []
+        for subnet_id, segment_id, size, used, refreshed_at in query.all():
+            if size is None or refreshed_at is None:
+                unrefreshed.append(subnet_id)
+                continue
+            used_ips[segment_id] += used
+            unused_ips[segment_id] += size - used
+            if oldest is None or refreshed_at < oldest:
+                oldest = refreshed_at
+
+        if oldest is not None:
+            query = _reusable_ips_query(session)
+            query = query.filter(
+                models.Subnet.ip_availability_size.isnot(None),
+                models.Subnet.ip_availability_refreshed_at.isnot(None))
+            query = _filter(query, **kwargs)
+            for segment_id, address_count in query.all():
+                used_ips[segment_id] += address_count
+                unused_ips[segment_id] -= address_count
+        return used_ips, unused_ips, oldest, unrefreshed
+
+
+def refresh_ip_availability(session, subnet_ids):
+    """Recounts the materialized availability of the given subnets.
+
+    Allocations move ip_availability_used as they happen, so this only
+    corrects drift, such as locks taken on deallocated addresses. The
+    subnet rows are locked first so allocations made meanwhile can't be
+    lost. Returns the number of subnets refreshed.
+    """
+    with session.begin():
+        query = session.query(models.Subnet)
+        query = query.filter(models.Subnet.id.in_(subnet_ids))
+        subnets = query.with_lockmode("update").all()
+        if not subnets:
+            return 0
+
+        query = _used_ips_query(session, models.Subnet.id, reusable=False)
+        query = query.filter(models.Subnet.id.in_(subnet_ids))
+        used_ips = dict(query.all())
+
+        now = timeutils.utcnow()
+        for subnet in subnets:
+            subnet["ip_availability_size"] = db_api.subnet_availability_size(
+                subnet)
+            subnet["ip_availability_used"] = used_ips.get(subnet["id"], 0)
+            subnet["ip_availability_refreshed_at"] = now
+        return len(subnets)
 
 
 def _convert_kwargs_values_into_tuples(f):
@@ -95,42 +187,75 @@ def get_used_ips(session, **kwargs):
     """
     LOG.debug("Getting used IPs...")
     with session.begin():
-        query = session.query(
-            models.Subnet.segment_id,
-            func.count(models.IPAddress.address))
-        query = query.group_by(models.Subnet.segment_id)
+        query = _used_ips_query(session, models.Subnet.segment_id)
         query = _filter(query, **kwargs)
 
-        reuse_window = timeutils.utcnow() - datetime.timedelta(
-            seconds=cfg.CONF.QUARK.ipam_reuse_after)
-        # NOTE(asadoughi): This is an outer join instead of a regular join
-        # to include subnets with zero IP addresses in the database.
-        query = query.outerjoin(
-            models.IPAddress,
-            and_(models.Subnet.id == models.IPAddress.subnet_id,
-                 or_(not_(models.IPAddress.lock_id.is_(None)),
-                     models.IPAddress._deallocated.is_(None),
-                     models.IPAddress._deallocated == 0,
-                     models.IPAddress.deallocated_at > reuse_window)))
-
-        query = query.outerjoin(
-            models.IPPolicyCIDR,
-            and_(
-                models.Subnet.ip_policy_id == models.IPPolicyCIDR.ip_policy_id,
-                models.IPAddress.address >= models.IPPolicyCIDR.first_ip,
-                models.IPAddress.address <= models.IPPolicyCIDR.last_ip))
-        # NOTE(asadoughi): (address is allocated) OR
-        # (address is deallocated and not inside subnet's IP policy)
-        query = query.filter(or_(
-            models.IPAddress._deallocated.is_(None),
-            models.IPAddress._deallocated == 0,
-            models.IPPolicyCIDR.id.is_(None)))
-
         ret = ((segment_id, address_count)
                for segment_id, address_count in query.all())
         return dict(ret)
 
 
+def _reuse_window():
+    return timeutils.utcnow() - datetime.timedelta(
+        seconds=cfg.CONF.QUARK.ipam_reuse_after)
+
+
+def _outerjoin_policy_cidrs(query):
+    return query.outerjoin(
+        models.IPPolicyCIDR,
+        and_(
+            models.Subnet.ip_policy_id == models.IPPolicyCIDR.ip_policy_id,
+            models.IPAddress.address >= models.IPPolicyCIDR.first_ip,
+            models.IPAddress.address <= models.IPPolicyCIDR.last_ip))
+
+
+def _used_ips_query(session, group_by, reusable=True):
+    """Counts the used IPs of subnets grouped by a Subnet column.
+
+    Without reusable, deallocated addresses still inside their reuse
+    window are left out, see _reusable_ips_query.
+    """
+    query = session.query(group_by, func.count(models.IPAddress.address))
+    query = query.group_by(group_by)
+
+    used = [not_(models.IPAddress.lock_id.is_(None)),
+            models.IPAddress._deallocated.is_(None),
+            models.IPAddress._deallocated == 0]
+    if reusable:
+        used.append(models.IPAddress.deallocated_at > _reuse_window())
+    # NOTE(asadoughi): This is an outer join instead of a regular join
+    # to include subnets with zero IP addresses in the database.
+    query = query.outerjoin(
+        models.IPAddress,
+        and_(models.Subnet.id == models.IPAddress.subnet_id, or_(*used)))
+
+    query = _outerjoin_policy_cidrs(query)
+    # NOTE(asadoughi): (address is allocated) OR
+    # (address is deallocated and not inside subnet's IP policy)
+    return query.filter(or_(
+        models.IPAddress._deallocated.is_(None),
+        models.IPAddress._deallocated == 0,
+        models.IPPolicyCIDR.id.is_(None)))
+
+
+def _reusable_ips_query(session):
+    """Counts unlocked deallocated IPs inside their reuse window by segment.
+
+    These are the used IPs _used_ips_query leaves out without reusable.
+    The range on deallocated_at keeps this to recent deallocations.
+    """
+    query = session.query(models.Subnet.segment_id,
+                          func.count(models.IPAddress.address))
+    query = query.group_by(models.Subnet.segment_id)
+    query = query.join(models.IPAddress,
+                       models.Subnet.id == models.IPAddress.subnet_id)
+    query = query.filter(models.IPAddress._deallocated == 1,
+                         models.IPAddress.lock_id.is_(None),
+                         models.IPAddress.deallocated_at > _reuse_window())
+    query = _outerjoin_policy_cidrs(query)
+    return query.filter(models.IPPolicyCIDR.id.is_(None))
+
+
 def get_unused_ips(session, used_ips_counts, **kwargs):
     """Returns dictionary with key segment_id, and value unused IPs count.
 
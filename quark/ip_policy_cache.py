@@ -0,0 +1,90 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In process LRU cache of compiled IP policy IPSets
+"""
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from sqlalchemy import event
+
+from quark import lru_cache
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.IntOpt("ip_policy_cache_size",
+               default=1024,
+               help=_("Number of compiled IP policy sets each API worker "
+                      "keeps in memory. 0 disables the cache."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+class IPPolicyCache(lru_cache.LRUCache):
+    """Bounded LRU of compiled policies keyed by (policy id, revision).
+
+    A policy may be cached in more than one form (a netaddr.IPSet or a
+    quark.policy_ranges.PolicyRanges), told apart by kind.
+
+    The revision is bumped in the database whenever a policy's excludes
+    change, so other workers' stale entries are simply never looked up
+    again and age out. Local changes are invalidated once their
+    transaction ends, see invalidate_after_commit. Cached sets are shared
+    between callers and must not be mutated.
+    """
+
+    size_opt = ("QUARK", "ip_policy_cache_size")
+
+    def get(self, policy_id, revision, build, kind="ipset"):
+        """Returns the cached policy, calling build() on a miss."""
+        if policy_id is None:
+            return build()
+        return self.get_or_build((policy_id, revision or 0, kind), build)
+
+    def invalidate(self, policy_id):
+        self.discard_where(lambda key: key[0] == policy_id)
+
+
+IP_POLICY_CACHE = IPPolicyCache()
+
+_PENDING = "quark_ip_policy_cache_pending"
+
+
+def invalidate_after_commit(session, policy_id):
+    """Invalidates a policy changed in session once its transaction ends.
+
+    Until then the policy isn't cached from session at all, see
+    is_pending. Its new revision would be reused for other excludes if
+    the transaction rolled back.
+    """
+    session.info.setdefault(_PENDING, set()).add(policy_id)
+    if not event.contains(session, "after_commit", _invalidate_pending):
+        event.listen(session, "after_commit", _invalidate_pending)
+        event.listen(session, "after_rollback", _invalidate_pending)
+
+
+def is_pending(session, policy_id):
+    """Whether session has uncommitted changes to the policy."""
+    return session is not None and policy_id in session.info.get(_PENDING,
+                                                                 ())
+
+
+def _invalidate_pending(session):
+    for policy_id in session.info.pop(_PENDING, ()):
+        IP_POLICY_CACHE.invalidate(policy_id)
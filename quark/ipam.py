@@ -32,11 +32,13 @@ from oslo_db import exception as db_exception
 from oslo_log import log as logging
 from oslo_utils import timeutils
 
+from quark import address_index
 from quark.db import api as db_api
 from quark.db import ip_types
 from quark.db import models
 from quark.drivers import floating_ip_registry as registry
 from quark import exceptions as q_exc
+from quark import mac_address_leases
 from quark import network_strategy
 from quark import utils
 
@@ -262,6 +264,12 @@ class QuarkIpam(object):
                 LOG.exception("Error in mac reallocate...")
                 continue
 
+        if (CONF.QUARK.mac_address_lease_block_size and
+                mac_address is None and not use_forbidden_mac_range):
+            address = self._allocate_leased_mac(context, port_id)
+            if address:
+                return address
+
         LOG.info("Couldn't find a suitable deallocated MAC, attempting "
                  "to create a new one")
 
@@ -334,6 +342,131 @@ class QuarkIpam(object):
 
         raise exceptions.MacAddressGenerationFailure(net_id=net_id)
 
+    def _allocate_leased_mac(self, context, port_id):
+        for retry in xrange(CONF.QUARK.mac_address_retry_max):
+            leased = mac_address_leases.MAC_LEASES.next_address(context)
+            if not leased:
+                LOG.info("Couldn't lease a block of MACs")
+                return
+
+            next_address, mac_range_id = leased
+            mac_readable = str(netaddr.EUI(next_address))
+            LOG.info("Attempting to create leased MAC {0}, attempt {1} of "
+                     "{2}".format(mac_readable, retry + 1,
+                                  CONF.QUARK.mac_address_retry_max))
+            try:
+                with context.session.begin():
+                    address = db_api.mac_address_create(
+                        context, address=next_address,
+                        mac_address_range_id=mac_range_id)
+                LOG.info("MAC assignment for port ID {0} completed with "
+                         "address {1}".format(port_id, mac_readable))
+                return address
+            except Exception:
+                # NOTE: Most likely the MAC was explicitly chosen at some
+                #       point, so move on to the next one in the lease
+                LOG.exception("Error in creating leased MAC {0}".format(
+                    mac_readable))
+
+    def allocate_mac_addresses(self, context, new_macs, net_id, port_ids,
+                               reuse_after, use_forbidden_mac_range=False):
+        """Allocates one MAC address per port in port_ids.
+
+        Deallocated MACs are reclaimed with a single UPDATE, and whatever
+        remains is carved out of a MAC range as one contiguous block, so a
+        batch of ports costs a handful of round trips rather than several
+        per port. Allocated MACs are appended to new_macs in port order, and
+        anything that can't be done in bulk falls back to
+        allocate_mac_address.
+        """
+        count = len(port_ids)
+        LOG.info("Attempting to allocate {0} MAC addresses in bulk "
+                 "[{1}]".format(count, utils.pretty_kwargs(
+                     network_id=net_id,
+                     use_forbidden_mac_range=use_forbidden_mac_range)))
+
+        new_macs.extend(self._reallocate_macs(context, count, reuse_after))
+
+        while len(new_macs) < count:
+            block = self._create_mac_block(context, count - len(new_macs),
+                                           use_forbidden_mac_range)
+            if not block:
+                break
+            new_macs.extend(block)
+
+        for port_id in port_ids[len(new_macs):]:
+            new_macs.append(self.allocate_mac_address(
+                context, net_id, port_id, reuse_after,
+                use_forbidden_mac_range=use_forbidden_mac_range))
+        return new_macs
+
+    @synchronized(named("allocate_mac_address"))
+    def _reallocate_macs(self, context, count, reuse_after):
+        try:
+            with context.session.begin():
+                transaction = db_api.transaction_create(context)
+            update_kwargs = {
+                "deallocated": False,
+                "deallocated_at": None,
+                "transaction_id": transaction.id
+            }
+            filter_kwargs = {"deallocated": True}
+            if reuse_after is not None:
+                filter_kwargs["reuse_after"] = reuse_after
+            elevated = context.elevated()
+            result = db_api.mac_address_reallocate_many(
+                elevated, update_kwargs, count, **filter_kwargs)
+            if not result:
+                return []
+            macs = db_api.mac_address_reallocate_find_many(elevated,
+                                                           transaction.id)
+            LOG.info("Reallocated {0} deallocated MACs".format(len(macs)))
+            return macs
+        except Exception:
+            LOG.exception("Error in bulk mac reallocate...")
+        return []
+
+    @synchronized(named("allocate_mac_address"))
+    def _create_mac_block(self, context, count, use_forbidden_mac_range):
+        try:
+            with context.session.begin():
+                fn = db_api.mac_address_range_find_allocation_counts
+                mac_range = fn(context,
+                               use_forbidden_mac_range=use_forbidden_mac_range)
+                if not mac_range:
+                    LOG.info("No MAC ranges could be found given "
+                             "the criteria")
+                    return []
+
+                rng, addr_count = mac_range
+                first = rng["next_auto_assign_mac"]
+                last = min(first + count - 1, rng["last_address"])
+                if (rng["last_address"] - rng["first_address"] + 1 <=
+                        addr_count or first > last):
+                    db_api.mac_range_update_set_full(context, rng)
+                    LOG.info("MAC range {0} is full".format(rng["cidr"]))
+                    return []
+
+                if last == rng["last_address"]:
+                    db_api.mac_range_update_set_full(context, rng)
+                else:
+                    db_api.mac_range_update_next_auto_assign_mac(
+                        context, rng, count=last - first + 1)
+
+                macs = [db_api.mac_address_create(
+                    context, address=address, mac_address_range_id=rng["id"])
+                    for address in xrange(first, last + 1)]
+            LOG.info("Created MACs {0} through {1} in range {2}".format(
+                str(netaddr.EUI(first)), str(netaddr.EUI(last)),
+                rng["cidr"]))
+            return macs
+        except Exception:
+            # NOTE: Most likely a MAC in the block was explicitly chosen at
+            #       some point. Let the caller fall back to allocating one
+            #       at a time.
+            LOG.exception("Error in creating a block of MACs")
+        return []
+
     @synchronized(named("reallocate_ip"))
     def attempt_to_reallocate_ip(self, context, net_id, port_id, reuse_after,
                                  version=None, ip_address=None,
@@ -421,7 +554,8 @@ class QuarkIpam(object):
                     break
 
                 updated_address = db_api.ip_address_reallocate_find(
-                    elevated, transaction.id)
+                    elevated, transaction.id,
+                    deallocated=result != db_api.CLAIMED_ALLOCATED)
                 if not updated_address:
                     if attempt:
                         attempt.failed()
@@ -451,7 +585,7 @@ class QuarkIpam(object):
                                                  port_id=port_id,
                                                  ip_address=ip_address)))
 
-        ip_policy_cidrs = models.IPPolicy.get_ip_policy_cidrs(subnet)
+        ip_policy_ranges = models.IPPolicy.get_ip_policy_ranges(subnet)
         next_ip = ip_address
         if not next_ip:
             if subnet["next_auto_assign_ip"] != -1:
@@ -462,7 +596,7 @@ class QuarkIpam(object):
                 next_ip = next_ip.ipv4()
 
         LOG.info("Next IP is {0}".format(str(next_ip)))
-        if ip_policy_cidrs and next_ip in ip_policy_cidrs and not ip_address:
+        if not ip_address and next_ip in ip_policy_ranges:
             LOG.info("Next IP {0} violates policy".format(str(next_ip)))
             raise q_exc.IPAddressPolicyRetryableFailure(ip_addr=next_ip,
                                                         net_id=net_id)
@@ -518,7 +652,7 @@ class QuarkIpam(object):
             if mac:
                 mac = kwargs["mac_address"].get("address")
 
-            ip_policy_cidrs = models.IPPolicy.get_ip_policy_cidrs(subnet)
+            ip_policy_ranges = models.IPPolicy.get_ip_policy_ranges(subnet)
             for tries, ip_address in enumerate(
                     generate_v6(mac, port_id, subnet["cidr"])):
 
@@ -533,8 +667,7 @@ class QuarkIpam(object):
                 LOG.info("Generated a new v6 address {0}".format(
                     str(ip_address)))
 
-                if (ip_policy_cidrs is not None and
-                        ip_address in ip_policy_cidrs):
+                if ip_address in ip_policy_ranges:
                     LOG.info("Address {0} excluded by policy".format(
                         str(ip_address)))
                     continue
@@ -703,10 +836,166 @@ class QuarkIpam(object):
 
         raise ip_address_failure(net_id)
 
+    @ipam_logged
+    def allocate_ip_addresses(self, context, net_id, port_ids, reuse_after,
+                              segment_id=None, mac_addresses=None, **kwargs):
+        """Allocates addresses for several ports at once.
+
+        The v4 address for every port is reclaimed or created in bulk, with
+        one reallocate UPDATE and a single subnet lock cycle for the
+        remainder. Anything else a port needs to satisfy the strategy (its
+        v6 address, or everything if the bulk path came up short) is then
+        filled in per port. Returns a list of address lists in port_ids
+        order.
+        """
+        count = len(port_ids)
+        mac_addresses = mac_addresses or [None] * count
+        # NOTE: Any per port fallback below gets its own IPAM log
+        kwargs.pop('ipam_log', None)
+
+        LOG.info("Starting a bulk IP address allocation of {0} ports. "
+                 "Strategy is {1} - [{2}]".format(
+                     count, self.get_name(),
+                     utils.pretty_kwargs(network_id=net_id,
+                                         segment_id=segment_id)))
+
+        v4_addresses = self._reallocate_ips(context, net_id, count,
+                                            reuse_after, segment_id,
+                                            **kwargs)
+        if len(v4_addresses) < count:
+            v4_addresses.extend(self._allocate_ips(
+                context, net_id, count - len(v4_addresses), segment_id,
+                **kwargs))
+        self._notify_new_addresses(context, v4_addresses)
+
+        port_addresses = []
+        for i, port_id in enumerate(port_ids):
+            addresses = v4_addresses[i:i + 1]
+            mac = mac_addresses[i]
+            if not addresses:
+                self.allocate_ip_address(context, addresses, net_id, port_id,
+                                         reuse_after, segment_id=segment_id,
+                                         mac_address=mac, **kwargs)
+            elif not self.is_strategy_satisfied(addresses):
+                self._complete_strategy(context, addresses, net_id, port_id,
+                                        reuse_after, segment_id, mac,
+                                        **kwargs)
+            port_addresses.append(addresses)
+        return port_addresses
+
+    def _complete_strategy(self, context, addresses, net_id, port_id,
+                           reuse_after, segment_id, mac, **kwargs):
+        subnets = self._choose_available_subnet(
+            context.elevated(), net_id, segment_id=segment_id,
+            reallocated_ips=addresses)
+        new_addresses = self._allocate_ips_from_subnets(
+            context, [], net_id, subnets, port_id, reuse_after,
+            mac_address=mac, **kwargs)
+        addresses.extend(new_addresses)
+        if not self.is_strategy_satisfied(addresses, allocate_complete=True):
+            raise ip_address_failure(net_id)
+        self._notify_new_addresses(context, new_addresses)
+
+    @synchronized(named("reallocate_ip"))
+    def _reallocate_ips(self, context, net_id, count, reuse_after,
+                        segment_id=None, **kwargs):
+        elevated = context.elevated()
+        ip_kwargs = {
+            "network_id": net_id,
+            "deallocated": True,
+            "version": 4,
+            "lock_id": None,
+        }
+        if reuse_after is not None:
+            ip_kwargs["reuse_after"] = reuse_after
+        if segment_id:
+            subnets = db_api.subnet_find(elevated, network_id=net_id,
+                                         segment_id=segment_id)
+            ip_kwargs["subnet_id"] = [s["id"] for s in subnets]
+            if not ip_kwargs["subnet_id"]:
+                return []
+
+        try:
+            with context.session.begin():
+                transaction = db_api.transaction_create(context)
+            m = models.IPAddress
+            update_kwargs = {
+                m.transaction_id: transaction.id,
+                m.address_type: kwargs.get("address_type", ip_types.FIXED),
+                m.deallocated: False,
+                m.deallocated_at: None,
+                m.used_by_tenant_id: context.tenant_id,
+                m.allocated_at: timeutils.utcnow(),
+            }
+            result = db_api.ip_address_reallocate_many(
+                elevated, update_kwargs, count, **ip_kwargs)
+            if not result:
+                LOG.info("Couldn't update any reallocatable addresses "
+                         "given the criteria")
+                return []
+
+            addresses = db_api.ip_address_reallocate_find_many(
+                elevated, transaction.id)
+            LOG.info("Reallocated {0} addresses".format(len(addresses)))
+            return addresses
+        except Exception:
+            LOG.exception("Error in bulk reallocate ip...")
+        return []
+
+    def _allocate_ips(self, context, net_id, count, segment_id=None,
+                      **kwargs):
+        new_addresses = []
+        try:
+            with context.session.begin():
+                for subnet, ips_in_subnet in self._select_subnet(
+                        context, net_id, None, segment_id, None,
+                        ip_version=4):
+                    ipnet = netaddr.IPNetwork(subnet["cidr"])
+                    if self._should_mark_subnet_full(context, subnet, ipnet,
+                                                     None, ips_in_subnet):
+                        db_api.subnet_update_set_full(context, subnet)
+                        continue
+
+                    index = address_index.FreeAddressIndex.for_subnet(subnet)
+                    free = index.take(subnet["next_auto_assign_ip"],
+                                      count - len(new_addresses))
+                    if not free:
+                        db_api.subnet_update_set_full(context, subnet)
+                        continue
+
+                    updated = db_api.subnet_update_next_auto_assign_ip(
+                        context, subnet, next_ip=free[-1])
+                    if not updated:
+                        continue
+
+                    LOG.info("Creating {0} addresses in subnet {1} - "
+                             "{2}".format(len(free), subnet["id"],
+                                          subnet["_cidr"]))
+                    for ip in free:
+                        new_addresses.append(db_api.ip_address_create(
+                            context, address=netaddr.IPAddress(ip).ipv4(),
+                            subnet_id=subnet["id"], deallocated=0,
+                            version=subnet["ip_version"], network_id=net_id,
+                            address_type=kwargs.get('address_type',
+                                                    ip_types.FIXED)))
+                    if len(new_addresses) == count:
+                        break
+        except Exception:
+            # NOTE: Most likely one of the addresses was explicitly assigned
+            #       already. The whole block is rolled back and the caller
+            #       falls back to per port allocation.
+            LOG.exception("Error in creating addresses in bulk")
+            return []
+        return new_addresses
+
     def deallocate_ip_address(self, context, address):
         if address["version"] == 6:
             db_api.ip_address_delete(context, address)
         else:
+            if not address["_deallocated"]:
+                db_api.subnet_update_usage_counts(
+                    context, address["subnet_id"], allocated=-1,
+                    deallocated_reusable=1)
             address["deallocated"] = 1
             address["address_type"] = None
 
@@ -881,8 +1170,22 @@ class QuarkIpam(object):
                     continue
 
                 if not ip_address and subnet["ip_version"] == 4:
+                    # NOTE: Jump the cursor straight to the next address
+                    #       outside of the IP policy so we never burn a
+                    #       retry on a policy hole
+                    index = address_index.FreeAddressIndex.for_subnet(subnet)
+                    next_ip = index.next_free(subnet["next_auto_assign_ip"])
+                    if next_ip is None:
+                        LOG.info("Marking subnet {0} as full, no addresses "
+                                 "left outside of policy".format(subnet["id"]))
+                        updated = db_api.subnet_update_set_full(context,
+                                                                subnet)
+                        if updated:
+                            context.session.refresh(subnet)
+                        continue
+
                     auto_inc = db_api.subnet_update_next_auto_assign_ip
-                    updated = auto_inc(context, subnet)
+                    updated = auto_inc(context, subnet, next_ip=next_ip)
 
                     if updated:
                         context.session.refresh(subnet)
@@ -0,0 +1,102 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Bounded, thread safe, in process LRU shared by quark's memoizing caches
+"""
+
+import collections
+import threading
+
+from oslo_config import cfg
+
+CONF = cfg.CONF
+
+
+class LRUCache(object):
+    """Bounded LRU keeping hit, miss and eviction counts.
+
+    The bound is max_size if given, otherwise the option named by
+    size_opt as (group, name), read on every store so it can be changed
+    at runtime. A bound of 0 disables the cache. None is never cached.
+    """
+
+    size_opt = None
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        group, name = self.size_opt
+        return getattr(getattr(CONF, group), name)
+
+    def lookup(self, key):
+        """Returns the cached value for key, or None."""
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def store(self, key, value):
+        max_size = self.max_size
+        if not max_size or value is None:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key, build):
+        """Returns the cached value for key, calling build() on a miss."""
+        if not self.max_size:
+            return build()
+        value = self.lookup(key)
+        if value is None:
+            value = build()
+            self.store(key, value)
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._entries), max_size=self.max_size,
+                        hits=self.hits, misses=self.misses,
+                        evictions=self.evictions)
@@ -0,0 +1,174 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per worker leases on blocks of MAC addresses
+"""
+
+import atexit
+import datetime
+import os
+import threading
+import time
+
+import netaddr
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+from quark.db import api as db_api
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.IntOpt("mac_address_lease_block_size",
+               default=0,
+               help=_("Number of MAC addresses each API worker leases from a"
+                      " MAC range at once and hands out from memory. 0"
+                      " disables leasing, and every MAC is carved out of a"
+                      " range individually.")),
+    cfg.IntOpt("mac_address_lease_ttl",
+               default=3600,
+               help=_("Seconds after which an API worker gives back what's"
+                      " left of a leased MAC block and leases a fresh one."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+class MacAddressLease(object):
+    def __init__(self, mac_range_id, first, last, filled_range=False):
+        self.mac_range_id = mac_range_id
+        self.next_address = first
+        self.last_address = last
+        self.filled_range = filled_range
+        self.leased_at = time.time()
+        self.pid = os.getpid()
+
+    def __len__(self):
+        return max(self.last_address - self.next_address + 1, 0)
+
+    def expired(self, ttl):
+        return time.time() - self.leased_at > ttl
+
+    def pop(self):
+        address = self.next_address
+        self.next_address += 1
+        return address
+
+
+class MacAddressLeasePool(object):
+    """Serves MAC addresses out of blocks leased from MAC ranges.
+
+    Leasing a block advances the range's next_auto_assign_mac past it in a
+    single locked update, so only one in every block_size allocations has
+    to touch the range at all. Unused addresses are handed back when a
+    lease expires or the worker shuts down.
+    """
+
+    def __init__(self):
+        self._lease = None
+        self._lock = threading.Lock()
+
+    def next_address(self, context):
+        """Returns (address, mac_range_id), or None if nothing is leasable."""
+        with self._lock:
+            lease = self._current_lease(context)
+            if not lease:
+                return None
+            return lease.pop(), lease.mac_range_id
+
+    def release(self, context):
+        with self._lock:
+            lease, self._lease = self._lease, None
+            if lease and lease.pid == os.getpid():
+                self._return_lease(context, lease)
+
+    def _current_lease(self, context):
+        lease = self._lease
+        if lease and lease.pid != os.getpid():
+            # NOTE: Inherited across a fork. The parent still owns it, so
+            #       just forget about it rather than hand out duplicates.
+            lease = None
+        elif lease and lease.expired(CONF.QUARK.mac_address_lease_ttl):
+            self._return_lease(context, lease)
+            lease = None
+
+        if not lease or not len(lease):
+            lease = self._lease_block(context)
+        self._lease = lease
+        return lease
+
+    def _lease_block(self, context):
+        block_size = CONF.QUARK.mac_address_lease_block_size
+        with context.session.begin():
+            rng = db_api.mac_address_range_find_for_lease(context)
+            if not rng:
+                LOG.info("No MAC ranges available to lease from")
+                return None
+
+            first = rng["next_auto_assign_mac"]
+            last = min(first + block_size - 1, rng["last_address"])
+            filled_range = last >= rng["last_address"]
+            if filled_range:
+                db_api.mac_range_update_set_full(context, rng)
+            else:
+                db_api.mac_range_update_next_auto_assign_mac(
+                    context, rng, count=last - first + 1)
+
+        LOG.info("Leased MACs {0} through {1} from range {2}".format(
+            str(netaddr.EUI(first)), str(netaddr.EUI(last)), rng["cidr"]))
+        return MacAddressLease(rng["id"], first, last,
+                               filled_range=filled_range)
+
+    def _return_lease(self, context, lease):
+        if not len(lease):
+            return
+
+        first, last = lease.next_address, lease.last_address
+        LOG.info("Returning unused leased MACs {0} through {1}".format(
+            str(netaddr.EUI(first)), str(netaddr.EUI(last))))
+        expected = -1 if lease.filled_range else last + 1
+        try:
+            with context.session.begin():
+                rewound = db_api.mac_range_update_rewind_next_auto_assign_mac(
+                    context, dict(id=lease.mac_range_id), expected, first)
+                if rewound:
+                    return
+
+                # Someone else has leased past us, so make the leftovers
+                # available to the deallocated MAC reuse path instead.
+                reusable_at = timeutils.utcnow() - datetime.timedelta(
+                    seconds=CONF.QUARK.ipam_reuse_after)
+                for address in xrange(first, last + 1):
+                    mac = db_api.mac_address_create(
+                        context, address=address,
+                        mac_address_range_id=lease.mac_range_id)
+                    db_api.mac_address_update(context, mac, deallocated=True,
+                                              deallocated_at=reusable_at)
+        except Exception:
+            LOG.exception("Couldn't return leased MACs {0} through "
+                          "{1}".format(str(netaddr.EUI(first)),
+                                       str(netaddr.EUI(last))))
+
+
+MAC_LEASES = MacAddressLeasePool()
+
+
+@atexit.register
+def _release_mac_leases():
+    MAC_LEASES.release(neutron_context.get_admin_context())
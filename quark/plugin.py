@@ -23,6 +23,7 @@ from neutron.quota import resource as qres
 from neutron.quota import resource_registry as qres_reg
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 import webob.exc
 
 from quark.api import extensions
@@ -105,6 +106,8 @@ def append_quark_extensions(conf):
 append_quark_extensions(CONF)
 
 
+_ports_module = ports
+
 CONF.register_opts(quark_quota_opts, "QUOTAS")
 qres_reg.ResourceRegistry.get_instance().register_resources(quark_resources)
 
@@ -131,9 +134,34 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
                                    "ip_availabilities", "ports_quark",
                                    "floatingip"]
 
+    __native_bulk_support = True
+
     def __init__(self):
         LOG.info("Starting quark plugin")
 
+    def _emulate_bulk_create(self, create, delete, context, collection,
+                             resource, body):
+        """Creates each item of a bulk request, undoing them all on error.
+
+        Native bulk support is switched on plugin wide for the sake of ports,
+        so the other resources that allow bulk creation, and ports that can't
+        be allocated in bulk, go through this to keep the behavior neutron
+        would give them.
+        """
+        created = []
+        try:
+            for item in body[collection]:
+                created.append(create(context, {resource: item[resource]}))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for obj in created:
+                    try:
+                        delete(context, obj["id"])
+                    except Exception:
+                        LOG.exception("Unable to undo bulk create of "
+                                      "%s %s" % (resource, obj["id"]))
+        return created
+
     def _fix_missing_tenant_id(self, context, resource):
         """Will add the tenant_id to the context from body.
 
@@ -169,6 +197,17 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, security_group["security_group"])
         return security_groups.create_security_group(context, security_group)
 
+    def create_security_group_bulk(self, context, security_groups):
+        return self._emulate_bulk_create(
+            self.create_security_group, self.delete_security_group, context,
+            "security_groups", "security_group", security_groups)
+
+    def create_security_group_rule_bulk(self, context, security_group_rules):
+        return self._emulate_bulk_create(
+            self.create_security_group_rule, self.delete_security_group_rule,
+            context, "security_group_rules", "security_group_rule",
+            security_group_rules)
+
     @sessioned
     def create_security_group_rule(self, context, security_group_rule):
         self._fix_missing_tenant_id(context,
@@ -260,6 +299,18 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, port["port"])
         return ports.create_port(context, port)
 
+    @sessioned
+    def create_port_bulk(self, context, ports):
+        # NOTE: neutron hands us the body as the "ports" kwarg, which
+        #       shadows the ports plugin module in here
+        for port in ports["ports"]:
+            self._fix_missing_tenant_id(context, port["port"])
+        if not _ports_module.can_create_in_bulk(context, ports["ports"]):
+            return self._emulate_bulk_create(
+                self.create_port, self.delete_port, context, "ports", "port",
+                ports)
+        return _ports_module.create_port_bulk(context, ports)
+
     @sessioned
     def get_port(self, context, id, fields=None):
         return ports.get_port(context, id, fields)
@@ -329,6 +380,11 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, subnet["subnet"])
         return subnets.create_subnet(context, subnet)
 
+    def create_subnet_bulk(self, context, subnets):
+        return self._emulate_bulk_create(
+            self.create_subnet, self.delete_subnet, context, "subnets",
+            "subnet", subnets)
+
     @sessioned
     def update_subnet(self, context, id, subnet):
         return subnets.update_subnet(context, id, subnet)
@@ -360,6 +416,11 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         self._fix_missing_tenant_id(context, network["network"])
         return networks.create_network(context, network)
 
+    def create_network_bulk(self, context, networks):
+        return self._emulate_bulk_create(
+            self.create_network, self.delete_network, context, "networks",
+            "network", networks)
+
     @sessioned
     def update_network(self, context, id, network):
         return networks.update_network(context, id, network)
@@ -66,6 +66,7 @@ def create_ip_policy(context, ip_policy):
             msg="network_ids or subnet_ids not specified")
 
     with context.session.begin():
+        subnets = []
         if subnet_ids:
             subnets = db_api.subnet_find(
                 context, id=subnet_ids, scope=db_api.ALL)
@@ -91,6 +92,7 @@ def create_ip_policy(context, ip_policy):
             ipp["networks"] = nets
 
         ip_policy = db_api.ip_policy_create(context, **ipp)
+        _update_policy_caches(context, subnets)
     return v._make_ip_policy_dict(ip_policy)
 
 
@@ -139,6 +141,7 @@ def update_ip_policy(context, id, ip_policy):
 
         models = []
         all_subnets = []
+        prior_subnets = list(ipp_db.get("subnets") or [])
         if subnet_ids:
             for subnet in ipp_db["subnets"]:
                 subnet["ip_policy"] = None
@@ -181,9 +184,22 @@ def update_ip_policy(context, id, ip_policy):
         if ip_policy_cidrs:
             _validate_policy_with_routes(context, ip_policy_cidrs, all_subnets)
         ipp_db = db_api.ip_policy_update(context, ipp_db, **ipp)
+        _update_policy_caches(
+            context, prior_subnets + list(ipp_db.get("subnets") or []))
     return v._make_ip_policy_dict(ipp_db)
 
 
+def _update_policy_caches(context, subnets):
+    # NOTE: the session's identity map hands back the same object for the
+    #       same row, so identity is enough to skip duplicates
+    seen = set()
+    for subnet in subnets:
+        if id(subnet) in seen:
+            continue
+        seen.add(id(subnet))
+        db_api.subnet_update_policy_caches(context, subnet)
+
+
 def delete_ip_policy(context, id):
     LOG.info("delete_ip_policy %s for tenant %s" % (id, context.tenant_id))
     with context.session.begin():
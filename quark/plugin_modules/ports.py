@@ -36,6 +36,15 @@ LOG = logging.getLogger(__name__)
 PORT_TAG_REGISTRY = tags.PORT_TAG_REGISTRY
 STRATEGY = network_strategy.STRATEGY
 
+quark_port_opts = [
+    cfg.IntOpt('port_list_batch_size',
+               default=500,
+               help=_('Number of ports fetched per query when listing '
+                      'ports without API pagination'))
+]
+
+CONF.register_opts(quark_port_opts, "QUARK")
+
 
 # HACK(amir): RM9305: do not allow a tenant to associate a network to a port
 # that does not belong to them unless it is publicnet or servicenet
@@ -295,6 +304,197 @@ def create_port(context, port):
     return v._make_port_dict(new_port)
 
 
+def can_create_in_bulk(context, ports):
+    """Whether create_port_bulk can allocate for all of ports at once."""
+    if len(ports) < 2:
+        return False
+
+    first = ports[0]["port"]
+    for port in ports:
+        port_attrs = port["port"]
+        for key in ("mac_address", "fixed_ips", "security_groups",
+                    "network_plugin"):
+            value = port_attrs.get(key)
+            if value and utils.attr_specified(value):
+                return False
+        if (port_attrs.get("network_id") != first.get("network_id") or
+                port_attrs.get("segment_id") != first.get("segment_id") or
+                port_attrs.get("use_forbidden_mac_range") !=
+                first.get("use_forbidden_mac_range")):
+            return False
+    return True
+
+
+def create_port_bulk(context, ports):
+    """Create several ports at once
+
+    When every port is on the same network and asks for nothing port
+    specific (fixed IPs, MAC, security groups or network plugin) the
+    MACs and IPs for all of them are allocated in bulk, which saves
+    several database round trips per port. Check can_create_in_bulk
+    first; anything else has to be created port by port.
+    : param context: neutron api request context
+    : param ports: dictionary with a "ports" key holding a list of port
+        dictionaries as described in create_port.
+    """
+    port_list = ports["ports"]
+    LOG.info("create_port_bulk of %d ports for tenant %s" %
+             (len(port_list), context.tenant_id))
+
+    admin_only = ["mac_address", "device_owner", "bridge", "admin_state_up",
+                  "use_forbidden_mac_range", "network_plugin"]
+    all_port_attrs = []
+    for port in port_list:
+        utils.filter_body(context, port["port"], admin_only=admin_only)
+        all_port_attrs.append(port["port"])
+
+    first = all_port_attrs[0]
+    use_forbidden_mac_range = first.get("use_forbidden_mac_range", False)
+    segment_id = first.get("segment_id")
+    net_id = first["network_id"]
+    for port_attrs in all_port_attrs:
+        for key in ("mac_address", "use_forbidden_mac_range", "segment_id",
+                    "fixed_ips", "security_groups"):
+            utils.pop_param(port_attrs, key)
+        if "device_id" not in port_attrs:
+            port_attrs["device_id"] = ""
+
+    port_ids = [uuidutils.generate_uuid() for _ in all_port_attrs]
+
+    net = db_api.network_find(context, None, None, None, False, id=net_id,
+                              scope=db_api.ONE)
+    if not net:
+        raise exceptions.NetworkNotFound(net_id=net_id)
+    _raise_if_unauthorized(context.tenant_id, net)
+
+    device_ids = [p["device_id"] for p in all_port_attrs if p["device_id"]]
+    if device_ids:
+        if len(set(device_ids)) != len(device_ids):
+            raise exceptions.BadRequest(
+                resource="port", msg="Multiple ports requested for the same "
+                "device on the requested network")
+        existing_ports = db_api.port_find(context, network_id=net_id,
+                                          device_id=device_ids,
+                                          scope=db_api.ALL)
+        if existing_ports:
+            raise exceptions.BadRequest(
+                resource="port", msg="This device is already connected to the "
+                "requested network via another port")
+
+    if not STRATEGY.is_provider_network(net_id):
+        segment_id = None
+        port_count = db_api.port_count_all(context, network_id=[net_id],
+                                           tenant_id=[context.tenant_id])
+        quota.QUOTAS.limit_check(
+            context, context.tenant_id,
+            ports_per_network=port_count + len(all_port_attrs))
+    else:
+        if not segment_id:
+            raise q_exc.AmbiguousNetworkId(net_id=net_id)
+
+    ipam_driver = ipam.IPAM_REGISTRY.get_strategy(net["ipam_strategy"])
+    net_driver = _get_net_driver(net)
+
+    macs = []
+    port_addresses = []
+    backend_ports = []
+
+    with utils.CommandManager().execute() as cmd_mgr:
+        @cmd_mgr.do
+        def _allocate_macs(net, port_ids):
+            return ipam_driver.allocate_mac_addresses(
+                context, macs, net["id"], port_ids,
+                CONF.QUARK.ipam_reuse_after,
+                use_forbidden_mac_range=use_forbidden_mac_range)
+
+        @cmd_mgr.undo
+        def _allocate_macs_undo(result):
+            LOG.info("Rolling back MAC addresses...")
+            for mac in macs:
+                try:
+                    with context.session.begin():
+                        ipam_driver.deallocate_mac_address(context,
+                                                           mac["address"])
+                except Exception:
+                    LOG.exception("Couldn't release MAC %s" % mac)
+
+        @cmd_mgr.do
+        def _allocate_ips(net, port_ids, macs):
+            port_addresses.extend(ipam_driver.allocate_ip_addresses(
+                context, net["id"], port_ids, CONF.QUARK.ipam_reuse_after,
+                segment_id=segment_id, mac_addresses=macs))
+            return port_addresses
+
+        @cmd_mgr.undo
+        def _allocate_ips_undo(result):
+            LOG.info("Rolling back IP addresses...")
+            for addresses in port_addresses:
+                for address in addresses:
+                    try:
+                        with context.session.begin():
+                            ipam_driver.deallocate_ip_address(context,
+                                                              address)
+                    except Exception:
+                        LOG.exception("Couldn't release IP %s" % address)
+
+        @cmd_mgr.do
+        def _allocate_backend_ports(net, port_ids):
+            for port_id, port_attrs in zip(port_ids, all_port_attrs):
+                backend_port = net_driver.create_port(
+                    context, net["id"], port_id=port_id, security_groups=[],
+                    device_id=port_attrs["device_id"])
+                _filter_backend_port(backend_port)
+                backend_ports.append(backend_port)
+            return backend_ports
+
+        @cmd_mgr.undo
+        def _allocate_backend_ports_undo(result):
+            LOG.info("Rolling back backend ports...")
+            for backend_port in backend_ports:
+                try:
+                    net_driver.delete_port(context, backend_port["uuid"])
+                except Exception:
+                    LOG.exception(
+                        "Couldn't rollback backend port %s" % backend_port)
+
+        @cmd_mgr.do
+        def _allocate_db_ports(port_ids, macs, port_addresses, backend_ports):
+            new_ports = []
+            with context.session.begin():
+                for port_id, port_attrs, mac, addresses, backend_port in zip(
+                        port_ids, all_port_attrs, macs, port_addresses,
+                        backend_ports):
+                    port_attrs["network_id"] = net["id"]
+                    port_attrs["id"] = port_id
+                    port_attrs["security_groups"] = []
+                    port_attrs.update(backend_port)
+                    new_ports.append(db_api.port_create(
+                        context, addresses=addresses,
+                        mac_address=mac["address"],
+                        backend_key=backend_port["uuid"], **port_attrs))
+            return new_ports
+
+        @cmd_mgr.undo
+        def _allocate_db_ports_undo(new_ports):
+            LOG.info("Rolling back database ports...")
+            if not new_ports:
+                return
+            try:
+                with context.session.begin():
+                    for new_port in new_ports:
+                        db_api.port_delete(context, new_port)
+            except Exception:
+                LOG.exception("Couldn't rollback db ports")
+
+        _allocate_macs(net, port_ids)
+        _allocate_ips(net, port_ids, macs)
+        _allocate_backend_ports(net, port_ids)
+        new_ports = _allocate_db_ports(port_ids, macs, port_addresses,
+                                       backend_ports)
+
+    return [v._make_port_dict(new_port) for new_port in new_ports]
+
+
 def update_port(context, id, port):
     """Update values of a port.
 
@@ -501,13 +701,33 @@ def get_ports(context, limit=None, sorts=None, marker=None, page_reverse=False,
         ports = []
         for ip in query:
             ports.extend(ip.ports)
+    elif limit is None and marker is None and not sorts:
+        # NOTE: neutron's controller takes len() of and re-walks what
+        #       this returns, so a list is built here. The ports are still
+        #       read in batches, in the order port_find would give them.
+        ports = db_api.port_find_batches(context,
+                                         CONF.QUARK.port_list_batch_size,
+                                         fields=fields, keyset=False,
+                                         **filters)
     else:
         ports = db_api.port_find(context, limit, sorts, marker,
                                  fields=fields, join_security_groups=True,
-                                 **filters)
+                                 join_tags=True, **filters)
     return v._make_ports_list(ports, fields)
 
 
+def iter_ports(context, filters=None, fields=None):
+    """Yields port dicts for every port matching filters.
+
+    Ports are read QUARK.port_list_batch_size at a time, so a listing
+    costs a fixed number of queries per batch however many ports match.
+    """
+    ports = db_api.port_find_batches(context,
+                                     CONF.QUARK.port_list_batch_size,
+                                     fields=fields, **(filters or {}))
+    return v._iter_ports_list(ports, fields)
+
+
 def get_ports_count(context, filters=None):
     """Return the number of ports.
 
@@ -573,8 +793,12 @@ def diagnose_port(context, id, fields):
         raise exceptions.NotAuthorized()
 
     if id == "*":
-        return {'ports': [_diag_port(context, port, fields) for
-                port in db_api.port_find(context).all()]}
+        # NOTE: the response is serialized as JSON, which needs a list.
+        ports = db_api.port_find_batches(context,
+                                         CONF.QUARK.port_list_batch_size,
+                                         keyset=False)
+        return {'ports': [_diag_port(context, port, fields)
+                          for port in ports]}
     db_port = db_api.port_find(context, id=id, scope=db_api.ONE)
     if not db_port:
         raise exceptions.PortNotFound(port_id=id, net_id='')
@@ -21,6 +21,7 @@ from oslo_log import log as logging
 from oslo_utils import uuidutils
 
 from quark.db import api as db_api
+from quark.drivers import security_groups as sg_driver
 from quark.environment import Capabilities
 from quark import exceptions as q_exc
 from quark import plugin_views as v
@@ -31,6 +32,7 @@ LOG = logging.getLogger(__name__)
 DEFAULT_SG_UUID = "00000000-0000-0000-0000-000000000000"
 GROUP_NAME_MAX_LENGTH = 255
 GROUP_DESCRIPTION_MAX_LENGTH = 255
+SG_DRIVER = sg_driver.SecurityGroupDriver()
 
 
 def _validate_security_group_rule(context, rule):
@@ -119,6 +121,8 @@ def create_security_group_rule(context, security_group_rule):
             security_rules_per_group=len(group.get("rules", [])) + 1)
 
         new_rule = db_api.security_group_rule_create(context, **rule)
+        db_api.security_group_bump_revision(context, group)
+    _update_group_rules(context, group_id)
     return v._make_security_group_rule_dict(new_rule)
 
 
@@ -155,6 +159,17 @@ def delete_security_group_rule(context, id):
 
         rule["id"] = id
         db_api.security_group_rule_delete(context, rule)
+        db_api.security_group_bump_revision(context, group)
+    _update_group_rules(context, group["id"])
+
+
+def _update_group_rules(context, group_id):
+    # NOTE: the rule change is committed by now. A failed push is logged and
+    #       left for the next port update or redis_sg_tool write-groups
+    try:
+        SG_DRIVER.update_group_rules(context, [group_id])
+    except Exception:
+        LOG.exception("Failed to push rules of security group %s" % group_id)
 
 
 def get_security_group(context, id, fields=None):
@@ -181,6 +181,7 @@ def create_subnet(context, subnet):
         ip_policies.ensure_default_policy(cidrs, [new_subnet])
         new_subnet["ip_policy"] = db_api.ip_policy_create(context,
                                                           exclude=cidrs)
+        db_api.subnet_update_policy_caches(context, new_subnet)
 
         quota.QUOTAS.limit_check(context, context.tenant_id,
                                  routes_per_subnet=len(host_routes))
@@ -263,7 +264,7 @@ def update_subnet(context, id, subnet):
                     msg="Allocation pools cannot be updated.")
             alloc_pools = allocation_pool.AllocationPools(
                 subnet_db["cidr"],
-                policies=models.IPPolicy.get_ip_policy_cidrs(subnet_db))
+                policies=models.IPPolicy.get_ip_policy_ranges(subnet_db))
         else:
             alloc_pools = allocation_pool.AllocationPools(subnet_db["cidr"],
                                                           allocation_pools)
@@ -317,8 +318,8 @@ def update_subnet(context, id, subnet):
                 ip_policies.ensure_default_policy(cidrs, [subnet_db])
                 subnet_db["ip_policy"] = db_api.ip_policy_update(
                     context, subnet_db["ip_policy"], exclude=cidrs)
-                # invalidate the cache
-                db_api.subnet_update_set_alloc_pool_cache(context, subnet_db)
+                # rewrite the caches from the new policy
+                db_api.subnet_update_policy_caches(context, subnet_db)
         subnet = db_api.subnet_update(context, subnet_db, **s)
     return v._make_subnet_dict(subnet)
 
@@ -337,12 +338,11 @@ def get_subnet(context, id, fields=None):
              (id, context.tenant_id, fields))
     subnet = db_api.subnet_find(context, None, None, None, False, id=id,
                                 join_dns=True, join_routes=True,
-                                scope=db_api.ONE)
+                                join_ip_policy=True, scope=db_api.ONE)
     if not subnet:
         raise exceptions.SubnetNotFound(subnet_id=id)
 
-    cache = subnet.get("_allocation_pool_cache")
-    if not cache:
+    if not models.Subnet.allocation_pool_cache_is_current(subnet):
         new_cache = subnet.allocation_pools
         db_api.subnet_update_set_alloc_pool_cache(context, subnet, new_cache)
     return v._make_subnet_dict(subnet)
@@ -374,10 +374,10 @@ def get_subnets(context, limit=None, page_reverse=False, sorts=None,
     subnets = db_api.subnet_find(context, limit=limit,
                                  page_reverse=page_reverse, sorts=sorts,
                                  marker_obj=marker,
-                                 join_dns=True, join_routes=True, **filters)
+                                 join_dns=True, join_routes=True,
+                                 join_ip_policy=True, **filters)
     for subnet in subnets:
-        cache = subnet.get("_allocation_pool_cache")
-        if not cache:
+        if not models.Subnet.allocation_pool_cache_is_current(subnet):
             db_api.subnet_update_set_alloc_pool_cache(
                 context, subnet, subnet.allocation_pools)
     return v._make_subnets_list(subnets, fields=fields)
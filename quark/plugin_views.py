@@ -186,10 +186,8 @@ def _port_dict(port, fields=None):
     if port.get("bridge"):
         res["bridge"] = port["bridge"]
 
-    # NOTE(ClifHouck): This causes another trip to the DB since tags are
-    # are not eager loaded. According to mdietz this be a small impact on
-    # performance, but if the tag system gets used more on ports, we may
-    # want to eager load the tags.
+    # NOTE: listings load tags in bulk (see db_api.port_find_batches and
+    # join_tags), single port views still load them lazily.
     try:
         t = PORT_TAG_REGISTRY.get_all(port)
         res.update(t)
@@ -248,14 +246,16 @@ def _make_ip_ports_list(ip, query, fields=None):
 
 
 def _make_ports_list(query, fields=None):
-    ports = []
+    return list(_iter_ports_list(query, fields))
+
+
+def _iter_ports_list(query, fields=None):
     for port in query:
         port_dict = _port_dict(port, fields)
         port_dict["fixed_ips"] = [_make_port_address_dict(ip, port, fields)
                                   for ip in port.ip_addresses if
                                   _ip_is_fixed(port, ip)]
-        ports.append(port_dict)
-    return ports
+        yield port_dict
 
 
 def _make_subnets_list(query, fields=None):
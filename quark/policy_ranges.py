@@ -0,0 +1,145 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Integer interval matcher for IP policy exclusions
+"""
+
+import bisect
+
+import netaddr
+
+# Offset of the IPv4 mapped block (::ffff:0:0/96) that v4 addresses are
+# stored in throughout quark
+V4_MAPPED_OFFSET = 0xffff00000000
+
+
+def to_int(ip):
+    """Returns ip as an integer in the (v6 mapped) space quark stores."""
+    if isinstance(ip, basestring):
+        ip = netaddr.IPAddress(ip)
+    if isinstance(ip, netaddr.IPAddress):
+        if ip.version == 4:
+            return ip.value + V4_MAPPED_OFFSET
+        return ip.value
+    return int(ip)
+
+
+def from_int(value, version):
+    if version == 4:
+        return netaddr.IPAddress(value - V4_MAPPED_OFFSET, version=4)
+    return netaddr.IPAddress(value, version=6)
+
+
+class PolicyRanges(object):
+    """Sorted, merged [first, last] integer ranges excluded by an IP policy.
+
+    Built straight from the first_ip/last_ip columns of IPPolicyCIDR, so
+    membership, next allowed address and excluded size are answered with a
+    bisect over two integer lists rather than through netaddr.IPSet.
+    Addresses may be given as integers in quark's v6 mapped space or as
+    netaddr.IPAddress objects of either version.
+    """
+
+    def __init__(self, ranges=None):
+        self._firsts = []
+        self._lasts = []
+        for first, last in sorted((int(lo), int(hi))
+                                  for lo, hi in ranges or []):
+            if self._lasts and first <= self._lasts[-1] + 1:
+                self._lasts[-1] = max(self._lasts[-1], last)
+            else:
+                self._firsts.append(first)
+                self._lasts.append(last)
+
+    @classmethod
+    def from_policy(cls, ip_policy):
+        ranges = []
+        for policy_cidr in (ip_policy or {}).get("exclude", []):
+            first = policy_cidr.get("first_ip")
+            last = policy_cidr.get("last_ip")
+            if first is None or last is None:
+                # NOTE: older policy rows may not carry the integer bounds
+                cidr = netaddr.IPNetwork(policy_cidr["cidr"]).ipv6()
+                first, last = cidr.first, cidr.last
+            ranges.append((first, last))
+        return cls(ranges)
+
+    def ranges(self):
+        return [[first, last] for first, last in zip(self._firsts,
+                                                     self._lasts)]
+
+    def _index(self, value):
+        idx = bisect.bisect_right(self._firsts, value) - 1
+        if idx >= 0 and value <= self._lasts[idx]:
+            return idx
+        return None
+
+    def __contains__(self, ip):
+        return self._index(to_int(ip)) is not None
+
+    def next_allowed(self, ip):
+        """Returns the lowest address >= ip not excluded, as an integer."""
+        value = to_int(ip)
+        idx = self._index(value)
+        if idx is None:
+            return value
+        return self._lasts[idx] + 1
+
+    def allowed(self, first, last):
+        """Returns the [first, last] ranges left after removing exclusions."""
+        first, last = to_int(first), to_int(last)
+        allowed = []
+        idx = max(bisect.bisect_right(self._firsts, first) - 1, 0)
+        start = first
+        while idx < len(self._firsts) and self._firsts[idx] <= last:
+            ex_first, ex_last = self._firsts[idx], self._lasts[idx]
+            idx += 1
+            if ex_last < start:
+                continue
+            if ex_first > start:
+                allowed.append([start, ex_first - 1])
+            start = ex_last + 1
+            if start > last:
+                return allowed
+        allowed.append([start, last])
+        return allowed
+
+    def excluded_within(self, first, last):
+        """Returns the number of excluded addresses in [first, last]."""
+        first, last = to_int(first), to_int(last)
+        return (last - first + 1) - sum(
+            hi - lo + 1 for lo, hi in self.allowed(first, last))
+
+    def ip_ranges(self, version):
+        """Returns the exclusions as netaddr.IPRanges of the given version."""
+        ip_ranges = []
+        for first, last in zip(self._firsts, self._lasts):
+            if version == 4:
+                first = max(first, V4_MAPPED_OFFSET)
+                last = min(last, V4_MAPPED_OFFSET + 0xffffffff)
+                if first > last:
+                    continue
+            ip_ranges.append(netaddr.IPRange(from_int(first, version),
+                                             from_int(last, version)))
+        return ip_ranges
+
+    @property
+    def size(self):
+        return sum(last - first + 1
+                   for first, last in zip(self._firsts, self._lasts))
+
+    def __len__(self):
+        return len(self._firsts)
@@ -13,8 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+
 from neutron.common import exceptions
 
+# Attribute a model's TagIndex is cached under
+TAG_INDEX_ATTR = "_quark_tag_index"
+
 
 class TagValidationError(Exception):
     def __init__(self, value, message):
@@ -22,6 +27,60 @@ class TagValidationError(Exception):
         self.message = message
 
 
+class TagIndex(object):
+    """A model's tags grouped by prefix, parsed once.
+
+    Validated values are memoized per tag type the first time they are
+    asked for, so repeated reads neither scan the tag strings nor validate
+    them again.
+    """
+
+    def __init__(self, tags):
+        self._raw = collections.defaultdict(list)
+        for tag in tags:
+            prefix, sep, value = tag.partition(":")
+            if sep:
+                self._raw[prefix + sep].append(value)
+        self._values = {}
+
+    def has(self, tag):
+        return tag.get_prefix() in self._raw
+
+    def value(self, tag):
+        """Returns the first valid value for tag, or None."""
+        prefix = tag.get_prefix()
+        if prefix not in self._values:
+            self._values[prefix] = None
+            for value in self._raw.get(prefix, []):
+                try:
+                    tag.validate(value)
+                except TagValidationError:
+                    continue
+                self._values[prefix] = value
+                break
+        return self._values[prefix]
+
+
+def get_index(model):
+    """Returns the model's TagIndex, building and caching it if needed."""
+    index = getattr(model, TAG_INDEX_ATTR, None)
+    if index is None:
+        index = TagIndex(model.tags)
+        try:
+            setattr(model, TAG_INDEX_ATTR, index)
+        except AttributeError:
+            # NOTE: plain dicts and the like can't carry the cache
+            pass
+    return index
+
+
+def invalidate_index(model):
+    try:
+        delattr(model, TAG_INDEX_ATTR)
+    except AttributeError:
+        pass
+
+
 class Tag(object):
 
     @classmethod
@@ -56,18 +115,11 @@ class Tag(object):
         self._pop(model)
         value = self.serialize(value)
         model.tags.append(value)
+        invalidate_index(model)
 
     def get(self, model):
         """Get a matching valid tag off the model."""
-        for tag in model.tags:
-            if self.is_tag(tag):
-                value = self.deserialize(tag)
-                try:
-                    self.validate(value)
-                    return value
-                except TagValidationError:
-                    continue
-        return None
+        return get_index(model).value(self)
 
     def _pop(self, model):
         """Pop all matching tags off the model and return them."""
@@ -82,6 +134,7 @@ class Tag(object):
         if tags:
             for tag in tags:
                 model.tags.remove(tag)
+            invalidate_index(model)
 
         return tags
 
@@ -103,10 +156,7 @@ class Tag(object):
 
     def has_tag(self, model):
         """Does the given port have this tag?"""
-        for tag in model.tags:
-            if self.is_tag(tag):
-                return True
-        return False
+        return get_index(model).has(self)
 
 
 class VlanTag(Tag):
@@ -144,11 +194,11 @@ class TagRegistry(object):
 
         Returns a dict of {<tag_name>:<tag_value>}.
         """
+        index = get_index(model)
         tags = {}
         for name, tag in self.tags.items():
-            for mtag in model.tags:
-                if tag.is_tag(mtag):
-                    tags[name] = tag.get(model)
+            if index.has(tag):
+                tags[name] = index.value(tag)
         return tags
 
     def set_all(self, model, **tags):
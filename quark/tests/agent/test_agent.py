@@ -14,8 +14,10 @@
 #
 
 import mock
+from oslo_config import cfg
 
 from quark.agent import agent
+from quark.agent import stats
 from quark.agent import xapi
 from quark.tests import test_base
 
@@ -50,3 +52,168 @@ class TestAgentPartitionVifs(test_base.TestBase):
         self.assertEqual(added, [interfaces[0], interfaces[4]])
         self.assertEqual(updated, [interfaces[1]])
         self.assertEqual(removed, [interfaces[2]])
+
+
+class TestAgentPublishHostVifs(test_base.TestBase):
+    def setUp(self):
+        super(TestAgentPublishHostVifs, self).setUp()
+        self.client = mock.MagicMock()
+        self.client.vif_key.side_effect = lambda device_id, mac: "%s.%s" % (
+            device_id, mac)
+        self.interfaces = [
+            xapi.VIF("device1", {"MAC": "mac1", "other_config": {}}, "ref1"),
+            xapi.VIF("device2", {"MAC": "mac2", "other_config": {}}, "ref2")]
+
+    def test_publish_host_vifs(self):
+        published = agent.publish_host_vifs(self.client, "host",
+                                            self.interfaces, None)
+        self.assertEqual(published, set(["device1.mac1", "device2.mac2"]))
+        self.client.set_host_vifs.assert_called_once_with("host", published)
+
+    def test_publish_host_vifs_unchanged(self):
+        published = set(["device1.mac1", "device2.mac2"])
+        agent.publish_host_vifs(self.client, "host", self.interfaces,
+                                published)
+        self.assertFalse(self.client.set_host_vifs.called)
+
+
+class TestAgentChangeListener(test_base.TestBase):
+    def setUp(self):
+        super(TestAgentChangeListener, self).setUp()
+        self.groups_client = mock.MagicMock()
+        self.groups_client.vif_key.side_effect = (
+            lambda device_id, mac: "%s.%s" % (device_id, mac))
+        self.groups_client.get_vif_changes.return_value = set()
+        self.groups_client.update_vif_subscriptions.side_effect = (
+            lambda pubsub, subscribed, vif_keys: set(vif_keys))
+        self.xapi_client = mock.MagicMock()
+        self.vifs = [
+            xapi.VIF("device%d" % i, {"MAC": "mac%d" % i,
+                                      "other_config": {}}, "ref%d" % i)
+            for i in xrange(3)]
+        self.xapi_client.get_interface_changes.return_value = (
+            set(self.vifs[:2]), set(self.vifs[:2]))
+        self.listener = agent.ChangeListener(self.groups_client,
+                                             self.xapi_client)
+        apply_patch = mock.patch("quark.agent.agent.apply_changes")
+        self.apply_changes = apply_patch.start()
+        self.addCleanup(apply_patch.stop)
+        time_patch = mock.patch("time.time")
+        self.time = time_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.time.return_value = 1000
+
+    def _checked(self):
+        return self.apply_changes.call_args[0][2]
+
+    def test_first_pass_reconciles(self):
+        self.listener.run_once()
+        self.assertEqual(self.groups_client.subscribe_vif_changes.call_count,
+                         1)
+        self.assertEqual(self._checked(), set(self.vifs[:2]))
+        self.groups_client.set_host_vifs.assert_called_once_with(
+            self.xapi_client.host_uuid, set(["device0.mac0",
+                                             "device1.mac1"]))
+
+    def test_subscribes_to_host_vifs(self):
+        self.listener.run_once()
+        self.groups_client.subscribe_vif_changes.assert_called_once_with({})
+        pubsub = self.groups_client.subscribe_vif_changes.return_value
+        self.groups_client.update_vif_subscriptions.assert_called_once_with(
+            pubsub, set(), mock.ANY)
+        self.assertEqual(self.listener._subscribed,
+                         set(["device0.mac0", "device1.mac1"]))
+
+        self.time.return_value = 1000 + cfg.CONF.AGENT.polling_interval + 3
+        self.xapi_client.get_interface_changes.return_value = (
+            set(self.vifs[1:]), set([self.vifs[2]]))
+        self.listener.run_once()
+        self.assertEqual(self.listener._subscribed,
+                         set(["device1.mac1", "device2.mac2"]))
+
+    def test_only_changed_vifs_checked(self):
+        self.listener.run_once()
+        self.apply_changes.reset_mock()
+        self.time.return_value = 1001
+        self.groups_client.get_vif_changes.return_value = set(
+            ["device1.mac1", "other.host"])
+        self.listener.run_once()
+        self.assertEqual(self._checked(), set([self.vifs[1]]))
+        self.assertEqual(
+            self.xapi_client.get_interface_changes.call_count, 1)
+
+    def test_no_changes_nothing_applied(self):
+        self.listener.run_once()
+        self.apply_changes.reset_mock()
+        self.time.return_value = 1001
+        self.listener.run_once()
+        self.assertFalse(self.apply_changes.called)
+
+    def test_new_vifs_checked_on_poll(self):
+        self.listener.run_once()
+        self.apply_changes.reset_mock()
+        self.time.return_value = 1000 + cfg.CONF.AGENT.polling_interval + 3
+        self.xapi_client.get_interface_changes.return_value = (
+            set(self.vifs), set([self.vifs[2]]))
+        self.listener.run_once()
+        self.assertEqual(self._checked(), set([self.vifs[2]]))
+
+    def test_failed_pass_reconciles_next(self):
+        self.listener.run_once()
+        self.time.return_value = 1001
+        self.groups_client.get_vif_changes.return_value = set(
+            ["device1.mac1"])
+        self.apply_changes.side_effect = Exception
+        self.assertRaises(Exception, self.listener.run_once)
+
+        self.apply_changes.side_effect = None
+        self.groups_client.get_vif_changes.return_value = set()
+        self.listener.run_once()
+        self.assertEqual(self._checked(), set(self.vifs[:2]))
+
+    def test_lost_subscription_resubscribes(self):
+        self.listener.run_once()
+        self.groups_client.get_vif_changes.side_effect = Exception
+        self.assertRaises(Exception, self.listener.run_once)
+        self.groups_client.get_vif_changes.side_effect = None
+        self.apply_changes.reset_mock()
+        self.time.return_value = 1001
+        self.listener.run_once()
+        self.assertEqual(self.groups_client.subscribe_vif_changes.call_count,
+                         2)
+        self.assertEqual(
+            set(self.groups_client.subscribe_vif_changes.call_args[0][0]),
+            set(["device0.mac0", "device1.mac1"]))
+        self.assertEqual(self._checked(), set(self.vifs[:2]))
+
+
+class TestAgentApplyChanges(test_base.TestBase):
+    @mock.patch("time.time")
+    def test_apply_changes(self, time_mock):
+        time_mock.return_value = 1000
+        groups_client = mock.MagicMock()
+        xapi_client = mock.MagicMock()
+        added = xapi.VIF("added", {"MAC": 1, "other_config": {}}, "ref1")
+        healed = xapi.VIF("healed", {"MAC": 2, "other_config": {}}, "ref2")
+        added.succeed()
+        healed.succeed()
+        groups_client.get_security_group_states.return_value = {
+            added: False, healed: True}
+        groups_client.get_rules_written_at.return_value = ["998.5"]
+        agent_stats = stats.AgentStats()
+        agent_stats.start_cycle()
+
+        agent.apply_changes(groups_client, xapi_client, [added, healed],
+                            agent_stats)
+
+        xapi_client.update_interfaces.assert_called_once_with(
+            [added, healed], [], [])
+        groups_client.update_group_states_for_vifs.assert_called_once_with(
+            [added, healed], True)
+        groups_client.get_rules_written_at.assert_called_once_with([added])
+        self.assertEqual(agent_stats.latency_count, 1)
+        self.assertEqual(agent_stats.latency_sum, 1.5)
+        agent_stats.end_cycle()
+        self.assertEqual(agent_stats.last_changes["added"], 2)
+        self.assertEqual(set(agent_stats.last_cycle),
+                         set(["states", "partition", "apply", "ack"]))
@@ -0,0 +1,78 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+from oslo_config import cfg
+
+from quark.agent import stats
+from quark.tests import test_base
+
+
+class TestAgentStats(test_base.TestBase):
+    def setUp(self):
+        super(TestAgentStats, self).setUp()
+        self.stats = stats.AgentStats()
+
+    def test_phase_failures_counted(self):
+        self.stats.start_cycle()
+        with self.stats.phase("xapi"):
+            pass
+        with self.assertRaises(ValueError):
+            with self.stats.phase("apply"):
+                raise ValueError()
+        self.stats.end_cycle()
+        self.assertEqual(self.stats.cycles, 1)
+        self.assertEqual(self.stats.failures["apply"], 1)
+        self.assertEqual(self.stats.failures["xapi"], 0)
+        self.assertIn("apply", self.stats.last_cycle)
+
+    def test_render(self):
+        self.stats.start_cycle()
+        self.stats.count_changes([1, 2], [3], [])
+        self.stats.observe_latency(0.2)
+        self.stats.observe_latency(7)
+        self.stats.observe_latency(1000)
+        self.stats.end_cycle()
+        text = self.stats.render()
+        self.assertIn("quark_agent_cycles_total 1\n", text)
+        self.assertIn('quark_agent_last_cycle_vifs{change="added"} 2\n',
+                      text)
+        self.assertIn('quark_agent_vifs_total{change="updated"} 1\n', text)
+        self.assertIn(
+            'quark_agent_rule_propagation_seconds_bucket{le="0.25"} 1\n',
+            text)
+        self.assertIn(
+            'quark_agent_rule_propagation_seconds_bucket{le="10.0"} 2\n',
+            text)
+        self.assertIn(
+            'quark_agent_rule_propagation_seconds_bucket{le="+Inf"} 3\n',
+            text)
+        self.assertIn("quark_agent_rule_propagation_seconds_count 3\n", text)
+
+    def test_end_cycle_writes_stats_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "quark_agent.prom")
+        cfg.CONF.set_override("stats_file", path, "AGENT")
+        self.addCleanup(cfg.CONF.clear_override, "stats_file", "AGENT")
+
+        self.stats.start_cycle()
+        self.stats.end_cycle()
+        with open(path) as f:
+            self.assertEqual(f.read(), self.stats.render())
+        self.assertFalse(os.path.exists(path + ".tmp"))
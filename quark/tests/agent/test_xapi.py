@@ -1,3 +1,4 @@
+from oslo_config import cfg
 import XenAPI
 
 from quark.agent import xapi
@@ -59,22 +60,85 @@ class TestXapiClient(test_base.TestBase):
                      dom_id="1", vifs=["opaque_vif1", "opaque_vif2"])
         self.assertEqual(instances, {"opaque1": vm})
 
-    @mock.patch("quark.agent.xapi.XapiClient.get_instances")
-    def test_get_interfaces(self, get_instances):
-        instances = {"opaque1": xapi.VM(uuid="device_id1",
-                                        ref="opaque1",
-                                        vifs=["opaque_vif1"],
-                                        dom_id="1")}
-        get_instances.return_value = instances
-        self.session.xenapi.VIF.get_all_records.return_value = {
-            "opaque_vif1": {"VM": "opaque1", "MAC": "00:11:22:33:44:55"},
-            "opaque_vif2": {"VM": "opaque2", "MAC": "55:44:33:22:11:00"},
-        }
+    def _vm_rec(self, uuid, vifs, power_state="running"):
+        return {"other_config": {"nova_uuid": uuid},
+                "power_state": power_state, "is_a_template": False,
+                "is_control_domain": False, "name_label": "instance-1",
+                "VIFs": vifs, "domid": "1"}
+
+    def _event(self, cls, ref, snapshot=None, operation="add"):
+        event = {"class": cls, "ref": ref, "operation": operation}
+        if snapshot is not None:
+            event["snapshot"] = snapshot
+        return event
+
+    def _event_from(self, *batches):
+        event_from = getattr(self.session.xenapi.event, "from")
+        event_from.side_effect = [
+            {"events": events, "token": "token%d" % i}
+            for i, events in enumerate(batches)]
+        return event_from
+
+    def test_get_interfaces(self):
+        vif1 = {"VM": "opaque1", "MAC": "00:11:22:33:44:55"}
+        vif2 = {"VM": "opaque2", "MAC": "55:44:33:22:11:00"}
+        self._event_from([
+            self._event("vm", "opaque1",
+                        self._vm_rec("device_id1", ["opaque_vif1"])),
+            self._event("vif", "opaque_vif1", vif1),
+            self._event("vif", "opaque_vif2", vif2)])
         interfaces = self.xclient.get_interfaces()
-        rec = {"MAC": "00:11:22:33:44:55", "VM": "opaque1"}
-        expected = set([xapi.VIF("device_id1", rec, "opaque_vif1")])
+        expected = set([xapi.VIF("device_id1", vif1, "opaque_vif1")])
         self.assertEqual(interfaces, expected)
 
+    def test_get_interface_changes_incremental(self):
+        vif1 = {"VM": "opaque1", "MAC": "00:11:22:33:44:55"}
+        vif2 = {"VM": "opaque1", "MAC": "55:44:33:22:11:00"}
+        vm = self._vm_rec("device_id1", ["opaque_vif1", "opaque_vif2"])
+        event_from = self._event_from(
+            [self._event("vm", "opaque1", vm),
+             self._event("vif", "opaque_vif1", vif1)],
+            [self._event("vif", "opaque_vif2", vif2)],
+            [],
+            [self._event("vif", "opaque_vif1", operation="del")],
+            [self._event("vm", "opaque1", dict(vm, power_state="Halted"),
+                         operation="mod")])
+        iface1 = xapi.VIF("device_id1", vif1, "opaque_vif1")
+        iface2 = xapi.VIF("device_id1", vif2, "opaque_vif2")
+
+        self.assertEqual(self.xclient.get_interface_changes(),
+                         (set([iface1]), set([iface1])))
+        event_from.assert_called_with(xapi.EVENT_CLASSES, "", 0.0)
+        self.assertEqual(self.xclient.get_interface_changes(),
+                         (set([iface1, iface2]), set([iface2])))
+        event_from.assert_called_with(xapi.EVENT_CLASSES, "token0", 0.0)
+        self.assertEqual(self.xclient.get_interface_changes(),
+                         (set([iface1, iface2]), set()))
+        self.assertEqual(self.xclient.get_interface_changes(),
+                         (set([iface2]), set()))
+        self.assertEqual(self.xclient.get_interface_changes(),
+                         (set(), set()))
+        self.assertEqual(self.session.login_with_password.call_count, 1)
+        self.assertFalse(self.session.xenapi.session.logout.called)
+
+    def test_get_interfaces_failure_reloads(self):
+        vif1 = {"VM": "opaque1", "MAC": "00:11:22:33:44:55"}
+        events = [self._event("vm", "opaque1",
+                              self._vm_rec("device_id1", ["opaque_vif1"])),
+                  self._event("vif", "opaque_vif1", vif1)]
+        event_from = self._event_from(events)
+        self.xclient.get_interfaces()
+
+        event_from.side_effect = XenAPI.Failure("EVENTS_LOST")
+        self.assertRaises(XenAPI.Failure, self.xclient.get_interfaces)
+        self.assertEqual(self.session.xenapi.session.logout.call_count, 1)
+
+        event_from.side_effect = None
+        event_from.return_value = {"events": events, "token": "token1"}
+        self.assertEqual(len(self.xclient.get_interfaces()), 1)
+        event_from.assert_called_with(xapi.EVENT_CLASSES, "", 0.0)
+        self.assertEqual(self.session.login_with_password.call_count, 2)
+
     @mock.patch("quark.agent.xapi.XapiClient.get_instances")
     def test_update_interfaces_added(self, get_instances):
         instances = {"opaque1": xapi.VM(uuid="device_id1",
@@ -239,6 +303,61 @@ class TestXapiClient(test_base.TestBase):
             "neutron_vif_flow", "online_instance_flows",
             expected_args)
 
+    def _cached_vifs(self, count):
+        vm = self._vm_rec("device_id1", ["opaque_vif%d" % i
+                                         for i in xrange(count)])
+        vm["domid"] = "7"
+        events = [self._event("vm", "opaque1", vm)]
+        for i in xrange(count):
+            events.append(self._event(
+                "vif", "opaque_vif%d" % i,
+                {"VM": "opaque1", "MAC": "00:11:22:33:44:5%d" % i,
+                 "device": str(i), "other_config": {}}))
+        self._event_from(events)
+        return sorted(self.xclient.get_interfaces(), key=lambda v: v.ref)
+
+    def test_update_interfaces_parallel(self):
+        cfg.CONF.set_override("xapi_flow_workers", 2, "AGENT")
+        self.addCleanup(cfg.CONF.clear_override, "xapi_flow_workers",
+                        "AGENT")
+        interfaces = self._cached_vifs(3)
+
+        self.xclient.update_interfaces(interfaces[:1], interfaces[1:2],
+                                       interfaces[2:])
+
+        xenapi = self.session.xenapi
+        self.assertEqual(xenapi.VIF.get_record.call_count, 0)
+        self.assertEqual(xenapi.VM.get_record.call_count, 0)
+        xenapi.VIF.add_to_other_config.assert_called_once_with(
+            "opaque_vif0", "security_groups", "enabled")
+        xenapi.VIF.remove_from_other_config.assert_called_once_with(
+            "opaque_vif2", "security_groups")
+        self.assertEqual(xenapi.host.call_plugin.call_count, 3)
+        for i in xrange(3):
+            xenapi.host.call_plugin.assert_any_call(
+                xenapi.session.get_this_host.return_value,
+                "neutron_vif_flow", "online_instance_flows",
+                dict(dom_id="7", vif_index=str(i)))
+        self.assertTrue(all(vif.success for vif in interfaces))
+        # The main session plus one per worker
+        self.assertEqual(self.session.login_with_password.call_count, 3)
+
+        stats = self.xclient.last_update_stats
+        self.assertEqual(stats["vifs"], 3)
+        self.assertEqual(stats["refreshed"], 3)
+        self.assertEqual(stats["workers"], 2)
+
+        self.xclient.update_interfaces([], interfaces, [])
+        self.assertEqual(self.session.login_with_password.call_count, 3)
+
+    def test_update_interfaces_plugin_failure_not_succeeded(self):
+        interfaces = self._cached_vifs(1)
+        self.session.xenapi.host.call_plugin.side_effect = XenAPI.Failure(
+            "PLUGIN_FAILED")
+        self.xclient.update_interfaces([], interfaces, [])
+        self.assertFalse(interfaces[0].success)
+        self.assertEqual(self.xclient.last_update_stats["refreshed"], 0)
+
 
 class TestXapiSession(test_base.TestBase):
     def setUp(self):
@@ -36,6 +36,7 @@ class TestRedisSecurityGroupsClient(test_base.TestBase):
         super(TestRedisSecurityGroupsClient, self).setUp()
         # Forces the connection pool to be recreated on every test
         sg_client.SecurityGroupsClient.connection_pool = None
+        sg_client.SERIALIZED_GROUP_CACHE.clear()
         temp_envcaps = [Capabilities.SECURITY_GROUPS, Capabilities.EGRESS]
         CONF.set_override('environment_capabilities', temp_envcaps, 'QUARK')
 
@@ -51,18 +52,207 @@ class TestRedisSecurityGroupsClient(test_base.TestBase):
 
         mac_address = netaddr.EUI("AA:BB:CC:DD:EE:FF")
         client.apply_rules(device_id, mac_address.value, [])
-        self.assertTrue(client._client.master.hset.called)
+        pipe = client._client.master.pipeline.return_value.__enter__()
+        self.assertEqual(pipe.execute.call_count, 1)
 
         redis_key = client.vif_key(device_id, mac_address.value)
 
         rule_dict = {"rules": []}
 
-        client._client.master.hset.assert_any_call(
+        pipe.hset.assert_any_call(
             redis_key, sg_client.SECURITY_GROUP_HASH_ATTR,
             json.dumps(rule_dict))
 
-        client._client.master.hset.assert_any_call(
+        pipe.hset.assert_any_call(
             redis_key, sg_client.SECURITY_GROUP_ACK, False)
+        pipe.hset.assert_any_call(
+            redis_key, sg_client.SECURITY_GROUP_WRITTEN_AT, mock.ANY)
+        pipe.sadd.assert_called_once_with(sg_client.VIF_INDEX_KEY, redis_key)
+        pipe.publish.assert_called_once_with(
+            sg_client.VIF_CHANGES_CHANNEL % redis_key, redis_key)
+        self.assertFalse(client._client.master.disconnect.called)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_apply_rules_many(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        macs = [netaddr.EUI("AA:BB:CC:DD:EE:0%d" % i).value
+                for i in xrange(3)]
+        client.apply_rules_many([("device%d" % i, mac, [{"rule": i}])
+                                 for i, mac in enumerate(macs)])
+        pipe = client._client.master.pipeline.return_value.__enter__()
+        self.assertEqual(client._client.master.pipeline.call_count, 1)
+        self.assertEqual(pipe.execute.call_count, 1)
+        self.assertEqual(pipe.hset.call_count, 9)
+        self.assertEqual(pipe.sadd.call_count, 3)
+        pipe.hset.assert_any_call(
+            client.vif_key("device2", macs[2]),
+            sg_client.SECURITY_GROUP_HASH_ATTR,
+            json.dumps({"rules": [{"rule": 2}]}))
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_apply_rules_many_empty(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        client.apply_rules_many([])
+        pipe = client._client.master.pipeline.return_value.__enter__()
+        self.assertFalse(pipe.execute.called)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_clients_share_connection_pool(self, strict_redis):
+        first = sg_client.SecurityGroupsClient()
+        second = sg_client.SecurityGroupsClient()
+        self.assertIs(first._client, second._client)
+        self.assertEqual(strict_redis.call_count, 1)
+
+    @mock.patch("os.getpid")
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_connection_pool_recreated_after_fork(self, strict_redis, getpid):
+        strict_redis.side_effect = lambda **kwargs: mock.Mock()
+        getpid.return_value = 100
+        client = sg_client.SecurityGroupsClient()
+        parent = client._client
+        getpid.return_value = 101
+        child = client._client
+        self.assertIsNot(parent, child)
+        self.assertIs(client._client, child)
+        self.assertEqual(strict_redis.call_count, 2)
+        self.assertFalse(parent.master.disconnect.called)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_delete_vif_rules(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        mac_address = netaddr.EUI("AA:BB:CC:DD:EE:FF")
+        client.delete_vif_rules("device", mac_address.value)
+        redis_key = client.vif_key("device", mac_address.value)
+        pipe = client._client.master.pipeline.return_value.__enter__()
+        pipe.hdel.assert_called_once_with(
+            redis_key, sg_client.SECURITY_GROUP_HASH_ATTR,
+            sg_client.SECURITY_GROUP_ACK, sg_client.SECURITY_GROUP_WRITTEN_AT)
+        pipe.srem.assert_called_once_with(sg_client.VIF_INDEX_KEY, redis_key)
+        pipe.publish.assert_called_once_with(
+            sg_client.VIF_CHANGES_CHANNEL % redis_key, redis_key)
+        self.assertEqual(pipe.execute.call_count, 1)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_get_vif_changes(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        pubsub = client.subscribe_vif_changes(["a.1", "b.2"])
+        self.assertEqual(
+            sorted(pubsub.subscribe.call_args[0]),
+            [sg_client.VIF_CHANGES_CHANNEL % "a.1",
+             sg_client.VIF_CHANGES_CHANNEL % "b.2"])
+        pubsub.get_message.side_effect = [
+            {"type": "message", "data": "a.1"},
+            {"type": "subscribe", "data": 1},
+            {"type": "message", "data": "b.2"},
+            {"type": "message", "data": "a.1"},
+            None]
+        self.assertEqual(client.get_vif_changes(pubsub, 5),
+                         set(["a.1", "b.2"]))
+        pubsub.get_message.assert_any_call(timeout=5)
+        self.assertEqual(pubsub.get_message.call_count, 5)
+
+    @mock.patch("time.sleep")
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_get_vif_changes_unsubscribed(self, strict_redis, sleep):
+        client = sg_client.SecurityGroupsClient()
+        pubsub = client.subscribe_vif_changes()
+        self.assertFalse(pubsub.subscribe.called)
+        pubsub.subscribed = False
+        self.assertEqual(client.get_vif_changes(pubsub, 5), set())
+        sleep.assert_called_once_with(5)
+        self.assertFalse(pubsub.get_message.called)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_update_vif_subscriptions(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        pubsub = mock.Mock()
+        subscribed = client.update_vif_subscriptions(
+            pubsub, set(["a.1", "b.2"]), ["b.2", "c.3"])
+        self.assertEqual(subscribed, set(["b.2", "c.3"]))
+        pubsub.subscribe.assert_called_once_with(
+            sg_client.VIF_CHANGES_CHANNEL % "c.3")
+        pubsub.unsubscribe.assert_called_once_with(
+            sg_client.VIF_CHANGES_CHANNEL % "a.1")
+
+        pubsub.reset_mock()
+        client.update_vif_subscriptions(pubsub, subscribed, subscribed)
+        self.assertFalse(pubsub.subscribe.called)
+        self.assertFalse(pubsub.unsubscribe.called)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_indexed_vif_count(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        client._client.slave.scard.return_value = 3
+        self.assertEqual(client.indexed_vif_count(), 3)
+        client._client.slave.scard.assert_called_with(
+            sg_client.VIF_INDEX_KEY)
+        client.indexed_vif_count(host="host")
+        client._client.slave.scard.assert_called_with(
+            sg_client.HOST_VIF_INDEX_KEY % "host")
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_iter_indexed_vif_keys(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        slave = client._client.slave
+        slave.sscan.side_effect = [(4, ["a.1"]), (0, ["b.2"])]
+        self.assertEqual(list(client.iter_indexed_vif_keys(count=1)),
+                         ["a.1", "b.2"])
+        slave.sscan.assert_any_call(sg_client.VIF_INDEX_KEY, 0, count=1)
+        slave.sscan.assert_any_call(sg_client.VIF_INDEX_KEY, 4, count=1)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_set_host_vifs(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        client.set_host_vifs("host", ["a.1", "b.2"])
+        pipe = client._client.master.pipeline.return_value.__enter__()
+        index_key = sg_client.HOST_VIF_INDEX_KEY % "host"
+        pipe.delete.assert_called_once_with(index_key)
+        pipe.sadd.assert_called_once_with(index_key, "a.1", "b.2")
+        self.assertEqual(pipe.execute.call_count, 1)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_rebuild_vif_index(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        with mock.patch.object(client, "iter_vif_keys") as iter_vif_keys:
+            iter_vif_keys.return_value = iter(["a.1", "b.2"])
+            self.assertEqual(client.rebuild_vif_index(), 2)
+            iter_vif_keys.assert_called_once_with(
+                field=sg_client.SECURITY_GROUP_HASH_ATTR)
+        client._client.master.sadd.assert_called_once_with(
+            sg_client.VIF_INDEX_KEY, "a.1", "b.2")
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_vif_keys_scans(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        slave = client._client.slave
+        slave.scan.side_effect = [(7, ["a.aabbccddeeff"]),
+                                  (0, ["b.aabbccddeeff", "c.aabbccddeeff"])]
+        self.assertEqual(client.vif_keys(), ["a.aabbccddeeff",
+                                             "b.aabbccddeeff",
+                                             "c.aabbccddeeff"])
+        slave.scan.assert_any_call(0, match="*.????????????",
+                                   count=CONF.QUARK.redis_scan_count)
+        slave.scan.assert_any_call(7, match="*.????????????",
+                                   count=CONF.QUARK.redis_scan_count)
+        self.assertFalse(slave.keys.called)
+        self.assertFalse(slave.pipeline.called)
+
+    @mock.patch("quark.cache.redis_base.TwiceRedis")
+    def test_iter_vif_keys_with_field(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        slave = client._client.slave
+        slave.scan.side_effect = [(3, ["a.1", "b.2"]), (0, [])]
+        pipe = slave.pipeline.return_value.__enter__()
+        pipe.execute.return_value = [False, True]
+
+        keys = client.iter_vif_keys(field=sg_client.SECURITY_GROUP_HASH_ATTR,
+                                    count=2)
+        self.assertEqual(next(keys), "b.2")
+        self.assertEqual(slave.scan.call_count, 1)
+        self.assertEqual(list(keys), [])
+        self.assertEqual(pipe.execute.call_count, 1)
+        pipe.hexists.assert_any_call("a.1", sg_client.SECURITY_GROUP_HASH_ATTR)
+        slave.scan.assert_called_with(3, match="*.????????????", count=2)
 
     @mock.patch("uuid.uuid4")
     @mock.patch("quark.cache.redis_base.TwiceRedis")
@@ -74,7 +264,9 @@ class TestRedisSecurityGroupsClient(test_base.TestBase):
 
         redis_key = client.vif_key(device_id, mac_address.value)
         client.delete_vif(device_id, mac_address)
-        client._client.master.delete.assert_called_with(redis_key)
+        pipe = client._client.master.pipeline.return_value.__enter__()
+        pipe.delete.assert_called_with(redis_key)
+        pipe.srem.assert_called_with(sg_client.VIF_INDEX_KEY, redis_key)
 
     def test_apply_rules_set_fails_gracefully(self):
         port_id = 1
@@ -98,6 +290,42 @@ class TestRedisSecurityGroupsClient(test_base.TestBase):
         payload = client.serialize_groups([group])
         self.assertEqual([], payload)
 
+    @mock.patch(
+        "quark.cache.security_groups_client.redis_base.TwiceRedis")
+    def test_serialize_groups_cached_by_revision(self, strict_redis):
+        client = sg_client.SecurityGroupsClient()
+        group = models.SecurityGroup(id="sg1", revision=0)
+        rule = models.SecurityGroupRule()
+        rule.update({"ethertype": 0x800, "protocol": 6, "port_range_min": 80,
+                     "port_range_max": 443, "direction": "ingress"})
+        group.rules.append(rule)
+
+        with mock.patch.object(client, "serialize_rules",
+                               wraps=client.serialize_rules) as serialize:
+            first = client.serialize_groups([group, group])
+            self.assertEqual(len(first), 2)
+            self.assertEqual(client.serialize_groups([group])[0], first[0])
+            self.assertEqual(serialize.call_count, 1)
+
+            group["revision"] = 1
+            client.serialize_groups([group])
+            self.assertEqual(serialize.call_count, 2)
+
+            unsaved = models.SecurityGroup(id="sg2")
+            client.serialize_groups([unsaved])
+            client.serialize_groups([unsaved])
+            self.assertEqual(serialize.call_count, 4)
+        self.assertEqual(sg_client.SERIALIZED_GROUP_CACHE.stats()["size"], 2)
+
+    def test_serialized_group_cache_evicts_least_recently_used(self):
+        cache = sg_client.SerializedGroupCache(max_size=1)
+        build = mock.Mock(side_effect=lambda: [])
+        cache.get(dict(id="a", revision=0), build)
+        cache.get(dict(id="b", revision=0), build)
+        cache.get(dict(id="a", revision=0), build)
+        self.assertEqual(build.call_count, 3)
+        self.assertEqual(cache.stats()["evictions"], 2)
+
     @mock.patch(
         "quark.cache.security_groups_client.redis_base.TwiceRedis")
     def test_serialize_group_with_rules(self, strict_redis):
@@ -260,6 +488,7 @@ class TestRedisForAgent(test_base.TestBase):
     def setUp(self):
         super(TestRedisForAgent, self).setUp()
 
+        sg_client.SecurityGroupsClient.connection_pool = None
         patch = mock.patch("quark.cache.security_groups_client.redis_base."
                            "TwiceRedis")
         self.MockSentinel = patch.start()
@@ -14,12 +14,14 @@
 # limitations under the License.
 
 import contextlib
+import json
 
 import mock
 import netaddr
 from neutron.common import rpc
 
 from quark.db import api as db_api
+from quark.db import models as db_models
 import quark.ipam
 from quark.tests.functional.base import BaseFunctionalTest
 
@@ -188,6 +190,89 @@ class QuarkFindSubnetAllocationCount(QuarkIpamBaseFunctionalTest):
                     netaddr.IPAddress(subnet["next_auto_assign_ip"]).ipv4(),
                     net4[1])
 
+    def test_subnet_usage_counts_follow_address_lifecycle(self):
+        cidr4 = "0.0.0.0/30"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4[0])
+        ]) as net:
+            self._create_ip_address("0.0.0.1", 4, cidr4, net["id"])
+            self._create_ip_address("0.0.0.2", 4, cidr4, net["id"])
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ALL)[0]
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 2)
+            self.assertEqual(subnet["deallocated_reusable_count"], 0)
+            self.assertEqual(subnet["ip_availability_used"], 2)
+
+            address = db_api.ip_address_find(self.context, address="0.0.0.1",
+                                             scope=db_api.ONE)
+            with self.context.session.begin():
+                db_api.ip_address_deallocate(self.context, address)
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 1)
+            self.assertEqual(subnet["deallocated_reusable_count"], 1)
+            self.assertEqual(subnet["ip_availability_used"], 1)
+
+            with self.context.session.begin():
+                db_api.ip_address_delete(self.context, address)
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 1)
+            self.assertEqual(subnet["deallocated_reusable_count"], 0)
+            self.assertEqual(subnet["ip_availability_used"], 1)
+
+    def test_subnet_reconcile_usage_counts(self):
+        cidr4 = "0.0.0.0/30"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4[0])
+        ]) as net:
+            self._create_ip_address("0.0.0.1", 4, cidr4, net["id"])
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ALL)[0]
+            with self.context.session.begin():
+                db_api.subnet_update_usage_counts(
+                    self.context, subnet["id"], allocated=4,
+                    deallocated_reusable=2)
+                corrected = db_api.subnet_reconcile_usage_counts(
+                    self.context)
+            self.assertEqual(corrected, [(subnet["id"], 1, 0)])
+            self.context.session.refresh(subnet)
+            self.assertEqual(subnet["allocated_count"], 1)
+            self.assertEqual(subnet["deallocated_reusable_count"], 0)
+
+            with self.context.session.begin():
+                self.assertEqual(
+                    db_api.subnet_reconcile_usage_counts(self.context), [])
+
+    def test_subnet_update_set_alloc_pool_cache_computes_pools(self):
+        cidr4 = "0.0.0.0/29"
+        net4 = netaddr.IPNetwork(cidr4)
+        with self._fixtures([
+            self._create_models(cidr4, 4, net4[0])
+        ]):
+            stale = db_api.subnet_find_stale_alloc_pool_cache(self.context)
+            self.assertEqual([s["cidr"] for s in stale], [cidr4])
+
+            with self.context.session.begin():
+                db_api.subnet_update_set_alloc_pool_cache(self.context,
+                                                          stale[0])
+            self.context.session.refresh(stale[0])
+            self.assertEqual(json.loads(stale[0]["_allocation_pool_cache"]),
+                             [dict(start="0.0.0.1", end="0.0.0.6")])
+            self.assertEqual(stale[0]["_allocation_pool_cache_version"],
+                             db_models.ALLOCATION_POOL_CACHE_VERSION)
+            self.assertEqual(
+                db_api.subnet_find_stale_alloc_pool_cache(self.context), [])
+
+            with self.context.session.begin():
+                db_api.ip_policy_bump_revision(self.context,
+                                               stale[0]["ip_policy"])
+            stale = db_api.subnet_find_stale_alloc_pool_cache(self.context)
+            self.assertEqual([s["cidr"] for s in stale], [cidr4])
+            self.assertFalse(
+                db_models.Subnet.allocation_pool_cache_is_current(stale[0]))
+
 
 class QuarkFindMacAddressRangeAllocationCount(QuarkIpamBaseFunctionalTest):
     @contextlib.contextmanager
@@ -219,7 +219,7 @@ class QuarkIPReallocateFindTest(MySqlBaseFunctionalTest, IPReallocateMixin):
             self.context,
             {"transaction_id": self.transaction.id},
             **ip_kwargs)
-        self.assertTrue(reallocated)
+        self.assertFalse(reallocated)
 
         updated_address = db_api.ip_address_reallocate_find(
             self.context, self.transaction.id)
@@ -243,7 +243,7 @@ class QuarkIPReallocateFindTest(MySqlBaseFunctionalTest, IPReallocateMixin):
             self.context,
             {"transaction_id": self.transaction.id},
             **ip_kwargs)
-        self.assertTrue(reallocated)
+        self.assertFalse(reallocated)
 
         updated_address = db_api.ip_address_reallocate_find(
             self.context, self.transaction.id)
@@ -299,13 +299,124 @@ class QuarkIPReallocateFindTest(MySqlBaseFunctionalTest, IPReallocateMixin):
             self.context,
             {"transaction_id": self.transaction.id},
             **ip_kwargs)
-        self.assertTrue(reallocated)
+        self.assertFalse(reallocated)
 
         updated_address = db_api.ip_address_reallocate_find(
             self.context, self.transaction.id)
         self.assertIsNone(updated_address)
 
+        self.assertEqual(
+            db_api.ip_address_purge_unreallocatable(self.context), 1)
+        self.context.session.flush()
+        self.assertIsNone(db_api.ip_address_find(self.context,
+                                                 id=ip_address_db.id,
+                                                 scope=db_api.ONE))
+
+    def test_policy_violation_never_claimed(self):
+        self.network_db = self.insert_network()
+        self.subnet_v4_db = self.insert_subnet(
+            self.network_db, "192.168.0.0/24")
+        self.ip_address_v4 = netaddr.IPAddress("192.168.0.0")
+        ip_address_db = self.insert_ip_address(self.ip_address_v4,
+                                               self.network_db,
+                                               self.subnet_v4_db)
+        self.insert_default_ip_policy(self.subnet_v4_db)
+        self.transaction = self.insert_transaction()
+        ip_kwargs = {
+            "network_id": self.network_db["id"],
+            "reuse_after": self.REUSE_AFTER,
+            "deallocated": True,
+            "version": 4,
+        }
+        reallocated = db_api.ip_address_reallocate(
+            self.context,
+            {"transaction_id": self.transaction.id},
+            **ip_kwargs)
+        self.assertFalse(reallocated)
+
+        self.assertEqual(
+            db_api.ip_address_purge_unreallocatable(self.context), 1)
         self.context.session.flush()
         self.assertIsNone(db_api.ip_address_find(self.context,
                                                  id=ip_address_db.id,
                                                  scope=db_api.ONE))
+
+    def test_policy_violation_claimed_when_requested(self):
+        self.network_db = self.insert_network()
+        self.subnet_v4_db = self.insert_subnet(
+            self.network_db, "192.168.0.0/24")
+        self.ip_address_v4 = netaddr.IPAddress("192.168.0.0")
+        self.insert_ip_address(self.ip_address_v4, self.network_db,
+                               self.subnet_v4_db)
+        self.insert_default_ip_policy(self.subnet_v4_db)
+        self.transaction = self.insert_transaction()
+        ip_kwargs = {
+            "network_id": self.network_db["id"],
+            "reuse_after": self.REUSE_AFTER,
+            "ip_address": self.ip_address_v4,
+            "version": 4,
+        }
+        reallocated = db_api.ip_address_reallocate(
+            self.context,
+            {"transaction_id": self.transaction.id},
+            **ip_kwargs)
+        self.assertTrue(reallocated)
+
+
+class QuarkIPReallocateUsageCountsTest(MySqlBaseFunctionalTest,
+                                       IPReallocateMixin):
+    def setUp(self):
+        super(QuarkIPReallocateUsageCountsTest, self).setUp()
+        self.network_db = self.insert_network()
+        self.subnet_v4_db = self.insert_subnet(
+            self.network_db, "192.168.0.0/24")
+        self.ip_address_v4 = netaddr.IPAddress("192.168.0.1")
+        self.ip_address_db = self.insert_ip_address(
+            self.ip_address_v4, self.network_db, self.subnet_v4_db)
+        self.transaction = self.insert_transaction()
+
+    def _counts(self):
+        self.context.session.refresh(self.subnet_v4_db)
+        return (self.subnet_v4_db["allocated_count"],
+                self.subnet_v4_db["deallocated_reusable_count"],
+                self.subnet_v4_db["ip_availability_used"])
+
+    def _reallocate_explicit(self):
+        ip_kwargs = {
+            "network_id": self.network_db["id"],
+            "ip_address": self.ip_address_v4,
+            "version": 4,
+        }
+        return db_api.ip_address_reallocate(
+            self.context,
+            {"transaction_id": self.transaction.id},
+            **ip_kwargs)
+
+    def test_explicit_allocated_address_leaves_counts(self):
+        self.ip_address_db["_deallocated"] = False
+        self.ip_address_db["deallocated_at"] = None
+        self.context.session.add(self.ip_address_db)
+        self.context.session.flush()
+        before = self._counts()
+
+        reallocated = self._reallocate_explicit()
+        self.assertEqual(reallocated, db_api.CLAIMED_ALLOCATED)
+        updated_address = db_api.ip_address_reallocate_find(
+            self.context, self.transaction.id,
+            deallocated=reallocated != db_api.CLAIMED_ALLOCATED)
+        self.assertEqual(updated_address["address"],
+                         int(self.ip_address_v4.ipv6()))
+        self.context.session.flush()
+        self.assertEqual(self._counts(), before)
+
+    def test_explicit_deallocated_address_moves_counts(self):
+        before = self._counts()
+
+        reallocated = self._reallocate_explicit()
+        self.assertEqual(reallocated, db_api.CLAIMED_DEALLOCATED)
+        db_api.ip_address_reallocate_find(
+            self.context, self.transaction.id,
+            deallocated=reallocated != db_api.CLAIMED_ALLOCATED)
+        self.context.session.flush()
+        self.assertEqual(self._counts(),
+                         (before[0] + 1, before[1] - 1, before[2] + 1))
@@ -0,0 +1,86 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for# the specific language governing permissions and limitations
+#  under the License.
+
+import contextlib
+
+import mock
+
+from quark.cache import security_groups_client as sg_client
+from quark.db import api as db_api
+import quark.plugin_modules.security_groups as sg_api
+from quark.tests.functional.base import BaseFunctionalTest
+
+
+class QuarkSecurityGroupRulePushTest(BaseFunctionalTest):
+    def setUp(self):
+        super(QuarkSecurityGroupRulePushTest, self).setUp()
+        sg_client.SecurityGroupsClient.connection_pool = None
+        sg_client.SERIALIZED_GROUP_CACHE.clear()
+        self.addCleanup(sg_client.SERIALIZED_GROUP_CACHE.clear)
+        with self.context.session.begin():
+            net = db_api.network_create(self.context, name="public",
+                                        tenant_id="fake",
+                                        network_plugin="BASE")
+            self.group = db_api.security_group_create(self.context,
+                                                      id="sg1", name="web")
+            db_api.port_create(self.context, network_id=net["id"],
+                               backend_key="1", device_id="device1",
+                               mac_address=0xAABBCCDDEEFF,
+                               security_groups=[self.group])
+
+    @contextlib.contextmanager
+    def _stubs(self):
+        with contextlib.nested(
+            mock.patch("quark.cache.redis_base.TwiceRedis"),
+            mock.patch.object(sg_client.SecurityGroupsClient,
+                              "apply_rules_many"),
+            mock.patch("neutron.quota.QUOTAS.limit_check")
+        ) as (twice_redis, apply_rules_many, limit_check):
+            yield apply_rules_many
+
+    def _pushed_rules(self, apply_rules_many):
+        vifs = apply_rules_many.call_args[0][0]
+        self.assertEqual(len(vifs), 1)
+        return vifs[0][2]
+
+    def _rule(self, port):
+        return dict(security_group_rule=dict(
+            security_group_id="sg1", tenant_id="fake", direction="ingress",
+            ethertype="IPv4", protocol="tcp", port_range_min=port,
+            port_range_max=port, remote_ip_prefix=None,
+            remote_group_id=None))
+
+    def test_create_rule_pushes_new_rule(self):
+        with self._stubs() as apply_rules_many:
+            sg_api.create_security_group_rule(self.context, self._rule(80))
+            self.assertEqual(
+                [r["port start"]
+                 for r in self._pushed_rules(apply_rules_many)], [80])
+
+            sg_api.create_security_group_rule(self.context, self._rule(443))
+            self.assertEqual(
+                sorted(r["port start"]
+                       for r in self._pushed_rules(apply_rules_many)),
+                [80, 443])
+
+    def test_delete_rule_pushes_remaining_rules(self):
+        with self._stubs() as apply_rules_many:
+            sg_api.create_security_group_rule(self.context, self._rule(80))
+            rule = sg_api.create_security_group_rule(self.context,
+                                                     self._rule(443))
+            sg_api.delete_security_group_rule(self.context, rule["id"])
+            self.assertEqual(
+                [r["port start"]
+                 for r in self._pushed_rules(apply_rules_many)], [80])
@@ -5,6 +5,7 @@ import netaddr
 from neutron.db import api as neutron_db_api
 from oslo_config import cfg
 
+from quark.db import api as db_api
 from quark.db import models
 from quark import ip_availability as ip_avail
 from quark.tests.functional.base import BaseFunctionalTest
@@ -331,3 +332,86 @@ class QuarkIpAvailabilityFilterTest(QuarkIpAvailabilityBaseFunctionalTest):
         output = ip_avail.get_ip_availability(**kwargs)
         self.assertEqual(output["used"], {"0": 2, "1": 1})
         self.assertEqual(output["unused"], {"0": 253 * 2, "1": 253})
+
+
+class QuarkIpAvailabilityRefreshTest(QuarkIpAvailabilityBaseFunctionalTest):
+    def _refresh(self, subnet_ids):
+        return ip_avail.refresh_ip_availability(neutron_db_api.get_session(),
+                                                subnet_ids)
+
+    def _set_materialized(self, subnet_id, **values):
+        self.connection.execute(
+            self.subnets.update().where(self.subnets.c.id == subnet_id),
+            **values)
+
+    def test_unrefreshed_subnets_are_counted(self):
+        self._default()
+        output = ip_avail.get_ip_availability(**self.default_kwargs)
+        self.assertEqual(output["used"], {"region-cell": 1})
+        self.assertEqual(output["unused"], {"region-cell": 253})
+        self.assertIsNone(output["age"])
+
+    @mock.patch("quark.ip_availability.timeutils.utcnow")
+    def test_refresh_matches_counted(self, utcnow_patch):
+        self._with_ip_policy(utcnow_patch)
+        self.assertEqual(self._refresh(range(72)), 72)
+        output = ip_avail.get_ip_availability(**self.default_kwargs)
+        self.assertEqual(output["used"], {"region-cell": 50})
+        self.assertEqual(output["unused"], {"region-cell": 254 * 72 - 50})
+        self.assertEqual(output["age"], 0)
+
+    @mock.patch("quark.ip_availability.timeutils.utcnow")
+    def test_served_from_materialized(self, utcnow_patch):
+        base = datetime.datetime(2015, 2, 13)
+        utcnow_patch.return_value = base
+        self._default()
+        self._insert_subnet(id=1, segment_id="other-cell")
+        self._set_materialized(0, ip_availability_size=254,
+                               ip_availability_used=10,
+                               ip_availability_refreshed_at=base)
+        utcnow_patch.return_value = base + datetime.timedelta(seconds=30)
+
+        output = ip_avail.get_ip_availability(**self.default_kwargs)
+        self.assertEqual(output["used"], {"region-cell": 10,
+                                          "other-cell": 0})
+        self.assertEqual(output["unused"], {"region-cell": 244,
+                                            "other-cell": 254})
+        self.assertEqual(output["age"], 30)
+
+    @mock.patch("quark.ip_availability.timeutils.utcnow")
+    def test_reallocate_after_refresh(self, utcnow_patch):
+        base = datetime.datetime(2015, 2, 13)
+        utcnow_patch.return_value = base
+        expired = base - datetime.timedelta(
+            seconds=cfg.CONF.QUARK.ipam_reuse_after + 1)
+        self._insert_ip_policy()
+        self._insert_network()
+        self._insert_subnet()
+        self._set_materialized(0, first_ip=0, last_ip=255)
+        self._insert_ip_address(deallocated=1, deallocated_at=expired)
+        self._insert_ip_address(address=2, address_readable="0.0.0.2",
+                                deallocated=1, deallocated_at=base)
+        self._refresh([0])
+
+        output = ip_avail.get_ip_availability(**self.default_kwargs)
+        self.assertEqual(output["used"], {"region-cell": 1})
+        self.assertEqual(output["unused"], {"region-cell": 253})
+
+        admin_ctx = self.context.elevated()
+        with admin_ctx.session.begin():
+            transaction = db_api.transaction_create(admin_ctx)
+        update_kwargs = {models.IPAddress.transaction_id: transaction.id,
+                         models.IPAddress.deallocated: False,
+                         models.IPAddress.deallocated_at: None}
+        with admin_ctx.session.begin():
+            self.assertTrue(db_api.ip_address_reallocate(
+                admin_ctx, update_kwargs, deallocated=True, address=1,
+                reuse_after=cfg.CONF.QUARK.ipam_reuse_after))
+            db_api.ip_address_reallocate_find(admin_ctx, transaction.id)
+
+        output = ip_avail.get_ip_availability(**self.default_kwargs)
+        self.assertEqual(output["used"], {"region-cell": 2})
+        self.assertEqual(output["unused"], {"region-cell": 252})
+
+    def test_refresh_unknown_subnets(self):
+        self.assertEqual(self._refresh([0]), 0)
@@ -1,6 +1,8 @@
 import netaddr
 
 from quark.db import api as db_api
+from quark.db import models
+from quark import ip_policy_cache
 from quark.tests.functional.base import BaseFunctionalTest
 
 
@@ -53,3 +55,49 @@ class QuarkIPPoliciesFirstLastIPTest(BaseFunctionalTest):
                              ippc["first_ip"])
             self.assertEqual(new_exclude_first_last[ippc["cidr"]],
                              ippc["last_ip"])
+
+
+class QuarkIPPoliciesRevisionTest(BaseFunctionalTest):
+    def setUp(self):
+        super(QuarkIPPoliciesRevisionTest, self).setUp()
+        ip_policy_cache.IP_POLICY_CACHE.clear()
+        self.addCleanup(ip_policy_cache.IP_POLICY_CACHE.clear)
+        with self.context.session.begin():
+            self.ip_policy = db_api.ip_policy_create(
+                self.context, exclude=["192.168.10.0/32"])
+
+    def _cached_revisions(self):
+        cache = ip_policy_cache.IP_POLICY_CACHE
+        return sorted(revision for policy_id, revision, kind
+                      in cache._entries if policy_id == self.ip_policy["id"])
+
+    def test_update_bumps_revision(self):
+        for revision, cidr in ((1, "192.168.10.1/32"),
+                               (2, "192.168.10.2/32")):
+            with self.context.session.begin():
+                db_api.ip_policy_update(self.context, self.ip_policy,
+                                        exclude=[cidr])
+            self.assertEqual(self.ip_policy["revision"], revision)
+
+    def test_uncommitted_revision_not_cached(self):
+        subnet = dict(ip_policy=self.ip_policy)
+        models.IPPolicy.get_ip_policy_ranges(subnet)
+        self.assertEqual(self._cached_revisions(), [0])
+        with self.assertRaises(ValueError):
+            with self.context.session.begin():
+                db_api.ip_policy_update(self.context, self.ip_policy,
+                                        exclude=["192.168.10.1/32"])
+                models.IPPolicy.get_ip_policy_ranges(subnet)
+                self.assertEqual(self._cached_revisions(), [0])
+                raise ValueError()
+        self.assertEqual(self._cached_revisions(), [])
+
+    def test_committed_update_invalidates(self):
+        subnet = dict(ip_policy=self.ip_policy)
+        models.IPPolicy.get_ip_policy_ranges(subnet)
+        with self.context.session.begin():
+            db_api.ip_policy_update(self.context, self.ip_policy,
+                                    exclude=["192.168.10.1/32"])
+        self.assertEqual(self._cached_revisions(), [])
+        models.IPPolicy.get_ip_policy_ranges(subnet)
+        self.assertEqual(self._cached_revisions(), [1])
@@ -327,6 +327,35 @@ class QuarkFindPortsFilterByDeviceOwner(BaseFunctionalTest):
         db_api.port_delete(self.context, port_mod3)
 
 
+class QuarkFindPortsInBatches(BaseFunctionalTest):
+    def test_port_find_batches_walks_every_port_once(self):
+        network = dict(name="public", tenant_id="fake", network_plugin="BASE")
+        net_mod = db_api.network_create(self.context, **network)
+        port_mods = []
+        for i in xrange(5):
+            port = dict(network_id=net_mod["id"], backend_key="1",
+                        device_id="1", device_owner="owner%d" % (i % 2))
+            port_mods.append(db_api.port_create(self.context, **port))
+        self.context.session.flush()
+
+        res = list(db_api.port_find_batches(self.context, 2))
+        self.assertEqual([p["id"] for p in res],
+                         sorted(p["id"] for p in port_mods))
+
+        res = list(db_api.port_find_batches(self.context, 2,
+                                            device_owner="owner0"))
+        self.assertEqual(len(res), 3)
+        self.assertTrue(all(p["device_owner"] == "owner0" for p in res))
+
+        res = list(db_api.port_find_batches(self.context, 2, keyset=False))
+        self.assertEqual([p["id"] for p in res],
+                         [p["id"] for p in db_api.port_find(self.context)])
+
+        db_api.network_delete(self.context, net_mod)
+        for port_mod in port_mods:
+            db_api.port_delete(self.context, port_mod)
+
+
 class QuarkPortFixedIPOperations(BaseFunctionalTest):
 
     def __init__(self, *args, **kwargs):
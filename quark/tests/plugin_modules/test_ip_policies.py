@@ -18,6 +18,7 @@ import contextlib
 import mock
 from neutron.common import exceptions
 
+from quark.db import models
 from quark import exceptions as quark_exceptions
 from quark.plugin_modules import ip_policies as ippol
 from quark.tests import test_base
@@ -243,13 +244,12 @@ class TestQuarkCreateIpPolicies(test_quark_plugin.TestQuarkPlugin):
                 ip_policy=dict(network_ids=[1, 2], exclude=["0.0.0.1/32"])))
             exclude = ['0.0.0.1/32', '0.0.0.0/32', '0.0.0.255/32']
             ip_policy_create.assert_called_once_with(
-                self.context, exclude=exclude,
-                networks=[{'subnets':
-                          [{'cidr': '0.0.0.0/24', 'ip_policy': None,
-                            'id': 1}], 'id': 1},
-                          {'subnets':
-                          [{'cidr': '0.0.0.0/24', 'ip_policy': None,
-                            'id': 2}], 'id': 2}])
+                self.context, exclude=exclude, networks=ipp["networks"])
+            self.assertEqual([net["id"] for net in ipp["networks"]], [1, 2])
+            for net in ipp["networks"]:
+                self.assertEqual(
+                    net["subnets"][0]["_allocation_pool_cache_version"],
+                    models.ALLOCATION_POOL_CACHE_VERSION)
             self.assertEqual(len(resp.keys()), 6)
             self.assertEqual(resp["subnet_ids"], [])
             self.assertEqual(resp["network_ids"], [1, 2])
@@ -274,9 +274,12 @@ class TestQuarkCreateIpPolicies(test_quark_plugin.TestQuarkPlugin):
                 ip_policy=dict(subnet_ids=[3, 4], exclude=["0.0.0.1/32"])))
             exclude = ['0.0.0.1/32', '0.0.0.0/32', '0.0.255.255/32']
             ip_policy_create.assert_called_once_with(
-                self.context, exclude=exclude,
-                subnets=[{'cidr': '0.0.0.0/16', 'id': 3},
-                         {'cidr': '0.0.0.0/16', 'id': 4}])
+                self.context, exclude=exclude, subnets=ipp["subnets"])
+            self.assertEqual([subnet["id"] for subnet in ipp["subnets"]],
+                             [3, 4])
+            for subnet in ipp["subnets"]:
+                self.assertEqual(subnet["_allocation_pool_cache_version"],
+                                 models.ALLOCATION_POOL_CACHE_VERSION)
             self.assertEqual(len(resp.keys()), 6)
             self.assertEqual(resp["subnet_ids"], [3, 4])
             self.assertEqual(resp["network_ids"], [])
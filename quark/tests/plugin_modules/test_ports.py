@@ -56,10 +56,13 @@ class TestQuarkGetPorts(test_quark_plugin.TestQuarkPlugin):
             port_models = port_model
 
         with contextlib.nested(
-            mock.patch("quark.db.api.port_find")
-        ) as (port_find,):
+            mock.patch("quark.db.api.port_find"),
+            mock.patch("quark.db.api.port_find_batches")
+        ) as (port_find, port_find_batches):
             port_find.return_value = port_models
-            yield
+            if isinstance(port_models, list):
+                port_find_batches.return_value = iter(port_models)
+            yield port_find_batches
 
     def test_port_list_no_ports(self):
         with self._stubs(ports=[]):
@@ -67,6 +70,18 @@ class TestQuarkGetPorts(test_quark_plugin.TestQuarkPlugin):
                                           fields=None)
             self.assertEqual(ports, [])
 
+    def test_port_list_streams_in_batches(self):
+        port = dict(mac_address="AA:BB:CC:DD:EE:FF", network_id=1,
+                    tenant_id=self.context.tenant_id, device_id=2)
+        with self._stubs(ports=[port, port]) as port_find_batches:
+            ports = list(self.plugin.get_ports(self.context,
+                                               filters={"device_id": [2]},
+                                               fields=None))
+            self.assertEqual(len(ports), 2)
+            port_find_batches.assert_called_once_with(
+                self.context, cfg.CONF.QUARK.port_list_batch_size,
+                fields=None, keyset=False, device_id=[2])
+
     def test_port_list_with_device_owner_dhcp(self):
         ip = dict(id=1, address=netaddr.IPAddress("192.168.1.100").value,
                   address_readable="192.168.1.100", subnet_id=1, network_id=2,
@@ -606,6 +621,114 @@ class TestQuarkCreatePortsSameDevBadRequest(test_quark_plugin.TestQuarkPlugin):
                     self.plugin.create_port(self.context, port)
 
 
+class TestQuarkCreatePortBulk(test_quark_plugin.TestQuarkPlugin):
+    @contextlib.contextmanager
+    def _stubs(self, network=None, macs=None):
+        network["network_plugin"] = "BASE"
+        network["ipam_strategy"] = "ANY"
+
+        def _create_db_port(context, **kwargs):
+            port_model = models.Port()
+            port_model.update(kwargs)
+            return port_model
+
+        def _alloc_macs(context, new_macs, net_id, port_ids, *args,
+                        **kwargs):
+            new_macs.extend(macs[:len(port_ids)])
+            return new_macs
+
+        def _alloc_ips(context, net_id, port_ids, *args, **kwargs):
+            addresses = []
+            for i, port_id in enumerate(port_ids):
+                ip_mod = models.IPAddress()
+                ip_mod.update(dict(address=i, address_readable="0.0.0.%d" % i,
+                                   version=4, subnet_id=1))
+                ip_mod.enabled_for_port = lambda x: True
+                addresses.append([ip_mod])
+            return addresses
+
+        with contextlib.nested(
+            mock.patch("quark.db.api.port_create"),
+            mock.patch("quark.db.api.network_find"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_ip_addresses"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_mac_addresses"),
+            mock.patch("quark.db.api.port_count_all"),
+            mock.patch("neutron.quota.QuotaEngine.limit_check"),
+            mock.patch("quark.plugin_modules.ports.create_port"),
+        ) as (port_create, net_find, alloc_ips, alloc_macs, port_count,
+              limit_check, create_port):
+            port_create.side_effect = _create_db_port
+            net_find.return_value = network
+            alloc_ips.side_effect = _alloc_ips
+            alloc_macs.side_effect = _alloc_macs
+            port_count.return_value = 0
+            yield port_create, alloc_ips, alloc_macs, create_port
+
+    def _ports(self, count, **kwargs):
+        ports = []
+        for i in xrange(count):
+            port = dict(network_id=1, tenant_id=self.context.tenant_id,
+                        device_id="device-%d" % i, name="port-%d" % i)
+            port.update(kwargs)
+            ports.append(dict(port=port))
+        return dict(ports=ports)
+
+    def test_create_port_bulk(self):
+        network = dict(id=1, tenant_id=self.context.tenant_id)
+        macs = [dict(address=0xAABBCCDDEE00 + i) for i in xrange(3)]
+        with self._stubs(network=network, macs=macs) as (
+                port_create, alloc_ips, alloc_macs, create_port):
+            result = self.plugin.create_port_bulk(self.context,
+                                                  self._ports(3))
+            self.assertEqual(alloc_macs.call_count, 1)
+            self.assertEqual(alloc_ips.call_count, 1)
+            self.assertEqual(port_create.call_count, 3)
+            self.assertFalse(create_port.called)
+            self.assertEqual(len(result), 3)
+            for i, port in enumerate(result):
+                self.assertEqual(port["name"], "port-%d" % i)
+                self.assertEqual(port["device_id"], "device-%d" % i)
+                self.assertEqual(
+                    port["mac_address"],
+                    str(netaddr.EUI(0xAABBCCDDEE00 + i)).replace('-', ':'))
+                args, kwargs = port_create.call_args_list[i]
+                self.assertEqual(kwargs["addresses"][0]["address_readable"],
+                                 "0.0.0.%d" % i)
+
+    def test_create_port_bulk_with_mac_falls_back(self):
+        network = dict(id=1, tenant_id=self.context.tenant_id)
+        with self._stubs(network=network, macs=[]) as (
+                port_create, alloc_ips, alloc_macs, create_port):
+            self.plugin.create_port_bulk(
+                self.context, self._ports(2, mac_address="AA:BB:CC:DD:EE:FF"))
+            self.assertEqual(create_port.call_count, 2)
+            self.assertFalse(alloc_macs.called)
+            self.assertFalse(alloc_ips.called)
+
+    def test_create_port_bulk_fall_back_undone_on_failure(self):
+        network = dict(id=1, tenant_id=self.context.tenant_id)
+        ports = self._ports(2, mac_address="AA:BB:CC:DD:EE:FF")
+        with self._stubs(network=network, macs=[]) as (
+                port_create, alloc_ips, alloc_macs, create_port):
+            create_port.side_effect = [
+                dict(id=1), exceptions.BadRequest(resource="ports",
+                                                  msg="failed")]
+            with mock.patch("quark.plugin_modules.ports.delete_port") as (
+                    delete_port):
+                with self.assertRaises(exceptions.BadRequest):
+                    self.plugin.create_port_bulk(self.context, ports)
+                delete_port.assert_called_once_with(self.context, 1)
+
+    def test_create_port_bulk_duplicate_device_fails(self):
+        network = dict(id=1, tenant_id=self.context.tenant_id)
+        ports = self._ports(2, device_id="device")
+        with self._stubs(network=network, macs=[]) as (
+                port_create, alloc_ips, alloc_macs, create_port):
+            with self.assertRaises(exceptions.BadRequest):
+                self.plugin.create_port_bulk(self.context, ports)
+            self.assertFalse(alloc_macs.called)
+
+
 class TestQuarkPortCreateQuota(test_quark_plugin.TestQuarkPlugin):
     @contextlib.contextmanager
     def _stubs(self, port=None, network=None, addr=None, mac=None):
@@ -1060,12 +1183,14 @@ class TestPortDiagnose(test_quark_plugin.TestQuarkPlugin):
             port_mod.network = network_mod
             port_res = port_mod
             if list_format:
-                ports = mock.MagicMock()
-                ports.all.return_value = [port_mod]
-                port_res = ports
+                port_res = [port_mod]
 
-        with mock.patch("quark.db.api.port_find") as port_find:
+        with contextlib.nested(
+            mock.patch("quark.db.api.port_find"),
+            mock.patch("quark.db.api.port_find_batches")
+        ) as (port_find, port_find_batches):
             port_find.return_value = port_res
+            port_find_batches.return_value = iter(port_res or [])
             yield
 
     def test_port_diagnose(self):
@@ -307,9 +307,12 @@ class TestQuarkCreateSecurityGroupRule(test_quark_plugin.TestQuarkPlugin):
             mock.patch("quark.db.api.security_group_find"),
             mock.patch("quark.db.api.security_group_rule_find"),
             mock.patch("quark.db.api.security_group_rule_create"),
+            mock.patch("quark.db.api.security_group_bump_revision"),
+            mock.patch("quark.plugin_modules.security_groups.SG_DRIVER"),
             mock.patch("quark.protocols.human_readable_protocol"),
             mock.patch("neutron.quota.QuotaEngine.limit_check")
-        ) as (group_find, rule_find, rule_create, human, limit_check):
+        ) as (group_find, rule_find, rule_create, bump, driver, human,
+              limit_check):
             group_find.return_value = dbgroup
             rule_find.return_value.count.return_value = group.get(
                 'port_rules', None) if group else 0
@@ -318,6 +321,7 @@ class TestQuarkCreateSecurityGroupRule(test_quark_plugin.TestQuarkPlugin):
             human.return_value = rule["protocol"]
             if limit_raise:
                 limit_check.side_effect = exceptions.OverQuota
+            self.bump, self.driver = bump, driver
             yield rule_create
 
     def _test_create_security_rule(self, limit_raise=False, **ruleset):
@@ -332,6 +336,9 @@ class TestQuarkCreateSecurityGroupRule(test_quark_plugin.TestQuarkPlugin):
         with self._stubs(rule, group, limit_raise) as rule_create:
             result = self.plugin.create_security_group_rule(self.context, hax)
             self.assertTrue(rule_create.called)
+            self.bump.assert_called_once_with(self.context, mock.ANY)
+            self.driver.update_group_rules.assert_called_once_with(
+                self.context, [group["id"]])
             for key in expected.keys():
                 self.assertEqual(expected[key], result[key])
         cfg.CONF.clear_override('environment_capabilities', 'QUARK')
@@ -415,6 +422,16 @@ class TestQuarkCreateSecurityGroupRule(test_quark_plugin.TestQuarkPlugin):
                 group={'id': 1, 'rules': [models.SecurityGroupRule()]},
                 limit_raise=True)
 
+    def test_create_security_rule_push_failure_not_raised(self):
+        rule = dict(self.rule, tenant_id=self.context.tenant_id)
+        group = rule.pop('group')
+        hax = {'security_group_rule': rule}
+        with self._stubs(rule, group) as rule_create:
+            self.driver.update_group_rules.side_effect = Exception
+            self.plugin.create_security_group_rule(self.context, hax)
+            self.assertTrue(rule_create.called)
+            self.assertTrue(self.bump.called)
+
     def test_create_security_group_no_proto_with_ranges_fails(self):
         with self.assertRaises(sg_ext.SecurityGroupProtocolRequiredWithPorts):
             self._test_create_security_rule(protocol=None, port_range_min=0)
@@ -439,9 +456,12 @@ class TestQuarkDeleteSecurityGroupRule(test_quark_plugin.TestQuarkPlugin):
                 mock.patch("quark.db.api.security_group_find"),
                 mock.patch("quark.db.api.security_group_rule_find"),
                 mock.patch("quark.db.api.security_group_rule_delete"),
-        ) as (group_find, rule_find, db_group_delete):
+                mock.patch("quark.db.api.security_group_bump_revision"),
+                mock.patch("quark.plugin_modules.security_groups.SG_DRIVER"),
+        ) as (group_find, rule_find, db_group_delete, bump, driver):
             group_find.return_value = dbgroup
             rule_find.return_value = dbrule
+            self.bump, self.driver = bump, driver
             yield db_group_delete
 
     def test_delete_security_group_rule(self):
@@ -452,6 +472,9 @@ class TestQuarkDeleteSecurityGroupRule(test_quark_plugin.TestQuarkPlugin):
         with self._stubs(dict(rule, group_id=1)) as (db_delete):
             self.plugin.delete_security_group_rule(self.context, 1)
             self.assertTrue(db_delete.called)
+            self.bump.assert_called_once_with(self.context, mock.ANY)
+            self.driver.update_group_rules.assert_called_once_with(
+                self.context, [1])
 
     def test_delete_security_group_rule_rule_not_found(self):
         with self._stubs():
@@ -879,16 +879,16 @@ class TestQuarkAllocationPoolCache(test_quark_plugin.TestQuarkPlugin):
                 subnet_update.return_value = new_subnet_mod
             yield subnet_mod
 
-    @mock.patch("quark.db.api.subnet_update_set_alloc_pool_cache")
-    def test_update_subnet_allocation_pools_invalidate_cache(self, set_cache):
+    @mock.patch("quark.db.api.subnet_update_policy_caches")
+    def test_update_subnet_allocation_pools_invalidate_cache(self,
+                                                             update_caches):
         og = cfg.CONF.QUARK.allow_allocation_pool_update
         cfg.CONF.set_override('allow_allocation_pool_update', True, 'QUARK')
         with self._stubs() as subnet_found:
             pools = [dict(start="172.16.0.1", end="172.16.0.12")]
             s = dict(subnet=dict(allocation_pools=pools))
             self.plugin.update_subnet(self.context, 1, s)
-            self.assertEqual(set_cache.call_count, 1)
-            set_cache.assert_called_with(self.context, subnet_found)
+            update_caches.assert_called_once_with(self.context, subnet_found)
         cfg.CONF.set_override('allow_allocation_pool_update', og, 'QUARK')
 
     @mock.patch("quark.db.api.subnet_update_set_alloc_pool_cache")
@@ -900,6 +900,28 @@ class TestQuarkAllocationPoolCache(test_quark_plugin.TestQuarkPlugin):
                                          [dict(start="172.16.0.1",
                                                end="172.16.0.254")])
 
+    @mock.patch("quark.db.api.subnet_update_set_alloc_pool_cache")
+    def test_get_subnet_set_alloc_cache_if_cache_is_stale(self, set_cache):
+        with self._stubs() as subnet_found:
+            subnet_found["_allocation_pool_cache"] = (
+                '[{"start": "172.16.0.10", "end": "172.16.0.20"}]')
+            self.plugin.get_subnet(self.context, 1)
+            set_cache.assert_called_once_with(self.context, subnet_found,
+                                              [dict(start="172.16.0.1",
+                                                    end="172.16.0.254")])
+
+    @mock.patch("quark.db.api.subnet_update_set_alloc_pool_cache")
+    def test_get_subnet_uses_current_alloc_cache(self, set_cache):
+        with self._stubs() as subnet_found:
+            subnet_found["_allocation_pool_cache"] = (
+                '[{"start": "172.16.0.10", "end": "172.16.0.20"}]')
+            subnet_found["_allocation_pool_cache_version"] = (
+                models.ALLOCATION_POOL_CACHE_VERSION)
+            resp = self.plugin.get_subnet(self.context, 1)
+            self.assertFalse(set_cache.called)
+            self.assertEqual(resp["allocation_pools"],
+                             [dict(start="172.16.0.10", end="172.16.0.20")])
+
 
 class TestQuarkUpdateSubnet(test_quark_plugin.TestQuarkPlugin):
     DEFAULT_ROUTE = [dict(destination="0.0.0.0/0",
@@ -1650,6 +1672,7 @@ class TestQuarkGetSubnetsShared(test_quark_plugin.TestQuarkPlugin):
                                            join_routes=True,
                                            defaults=["public_v4", "public_v6"],
                                            join_dns=True,
+                                           join_ip_policy=True,
                                            provider_query=False)
 
     def test_get_subnets_shared_false(self):
@@ -1667,7 +1690,8 @@ class TestQuarkGetSubnetsShared(test_quark_plugin.TestQuarkPlugin):
                                            defaults=[invert, "public_v4",
                                                      "public_v6"],
                                            provider_query=False,
-                                           join_routes=True, join_dns=True)
+                                           join_routes=True, join_dns=True,
+                                           join_ip_policy=True)
 
     def test_get_subnets_no_shared(self):
         sub0 = dict(id='public_v4', tenant_id="provider", name="public_v4",
@@ -1682,4 +1706,5 @@ class TestQuarkGetSubnetsShared(test_quark_plugin.TestQuarkPlugin):
                                            None, None,
                                            defaults=[],
                                            provider_query=False,
-                                           join_routes=True, join_dns=True)
+                                           join_routes=True, join_dns=True,
+                                           join_ip_policy=True)
@@ -0,0 +1,136 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import netaddr
+
+from quark.address_index import FreeAddressIndex
+from quark.db import models
+from quark.tests import test_base
+
+
+def _ip(addr):
+    return netaddr.IPAddress(addr).ipv6().value
+
+
+def _subnet(cidr, exclude=None, with_bounds=True):
+    subnet = models.Subnet(cidr=cidr)
+    policy_cidrs = []
+    for excluded in exclude or []:
+        net = netaddr.IPNetwork(excluded).ipv6()
+        if with_bounds:
+            policy_cidrs.append(models.IPPolicyCIDR(cidr=excluded,
+                                                    first_ip=net.first,
+                                                    last_ip=net.last))
+        else:
+            policy_cidrs.append(models.IPPolicyCIDR(cidr=excluded))
+    subnet["ip_policy"] = models.IPPolicy(exclude=policy_cidrs)
+    return subnet
+
+
+class TestFreeAddressIndex(test_base.TestBase):
+    def test_no_policy(self):
+        subnet = models.Subnet(cidr="192.168.0.0/24")
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertEqual(index.ranges(),
+                         [[_ip("192.168.0.0"), _ip("192.168.0.255")]])
+        self.assertEqual(index.size, 256)
+
+    def test_policy_subtracted(self):
+        subnet = _subnet("192.168.0.0/24",
+                         exclude=["192.168.0.0/32", "192.168.0.255/32",
+                                  "192.168.0.16/28"])
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertEqual(index.ranges(),
+                         [[_ip("192.168.0.1"), _ip("192.168.0.15")],
+                          [_ip("192.168.0.32"), _ip("192.168.0.254")]])
+        self.assertEqual(index.size, 256 - 2 - 16)
+
+    def test_overlapping_policies_merged(self):
+        subnet = _subnet("192.168.0.0/24",
+                         exclude=["192.168.0.0/25", "192.168.0.64/26",
+                                  "192.168.0.128/32"])
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertEqual(index.ranges(),
+                         [[_ip("192.168.0.129"), _ip("192.168.0.255")]])
+
+    def test_policy_covers_subnet(self):
+        subnet = _subnet("192.168.0.0/30", exclude=["192.168.0.0/24"])
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertEqual(index.ranges(), [])
+        self.assertEqual(index.size, 0)
+        self.assertIsNone(index.next_free(_ip("192.168.0.0")))
+
+    def test_policy_without_bounds_uses_cidr(self):
+        subnet = _subnet("192.168.0.0/24", exclude=["192.168.0.0/31"],
+                         with_bounds=False)
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertEqual(index.ranges(),
+                         [[_ip("192.168.0.2"), _ip("192.168.0.255")]])
+
+    def test_next_free(self):
+        subnet = _subnet("192.168.0.0/24",
+                         exclude=["192.168.0.0/32", "192.168.0.16/28",
+                                  "192.168.0.255/32"])
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertEqual(index.next_free(_ip("192.168.0.0")),
+                         _ip("192.168.0.1"))
+        self.assertEqual(index.next_free(_ip("192.168.0.5")),
+                         _ip("192.168.0.5"))
+        self.assertEqual(index.next_free(_ip("192.168.0.16")),
+                         _ip("192.168.0.32"))
+        self.assertEqual(index.next_free(_ip("192.168.0.31")),
+                         _ip("192.168.0.32"))
+        self.assertIsNone(index.next_free(_ip("192.168.0.255")))
+
+    def test_take(self):
+        subnet = _subnet("192.168.0.0/24",
+                         exclude=["192.168.0.0/32", "192.168.0.4/30",
+                                  "192.168.0.255/32"])
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertEqual(index.take(_ip("192.168.0.0"), 5),
+                         [_ip("192.168.0.1"), _ip("192.168.0.2"),
+                          _ip("192.168.0.3"), _ip("192.168.0.8"),
+                          _ip("192.168.0.9")])
+        self.assertEqual(index.take(_ip("192.168.0.253"), 5),
+                         [_ip("192.168.0.253"), _ip("192.168.0.254")])
+        self.assertEqual(index.take(_ip("192.168.0.255"), 5), [])
+
+    def test_contains(self):
+        subnet = _subnet("192.168.0.0/24", exclude=["192.168.0.16/28"])
+        index = FreeAddressIndex.from_subnet(subnet)
+        self.assertIn(_ip("192.168.0.15"), index)
+        self.assertNotIn(_ip("192.168.0.16"), index)
+        self.assertNotIn(_ip("192.168.1.0"), index)
+
+    def test_round_trip(self):
+        subnet = _subnet("192.168.0.0/24", exclude=["192.168.0.16/28"])
+        index = FreeAddressIndex.from_subnet(subnet)
+        loaded = FreeAddressIndex.loads(index.dumps())
+        self.assertEqual(loaded.ranges(), index.ranges())
+
+    def test_for_subnet_prefers_persisted_index(self):
+        subnet = _subnet("192.168.0.0/24")
+        subnet["_free_address_index"] = FreeAddressIndex(
+            [(_ip("192.168.0.10"), _ip("192.168.0.20"))]).dumps()
+        index = FreeAddressIndex.for_subnet(subnet)
+        self.assertEqual(index.ranges(),
+                         [[_ip("192.168.0.10"), _ip("192.168.0.20")]])
+
+    def test_for_subnet_rebuilds_malformed_index(self):
+        subnet = _subnet("192.168.0.0/24", exclude=["192.168.0.0/32"])
+        subnet["_free_address_index"] = "garbage"
+        index = FreeAddressIndex.for_subnet(subnet)
+        self.assertEqual(index.ranges(),
+                         [[_ip("192.168.0.1"), _ip("192.168.0.255")]])
@@ -13,6 +13,7 @@
 # License for the specific language governing permissions and limitations
 #  under the License.
 
+from netaddr import IPAddress
 from netaddr import IPSet
 
 from quark.db import models
@@ -38,3 +39,64 @@ class TestDBModels(test_base.TestBase):
                       network=dict(ip_policy=None), ip_policy=None)
         ip_policy_rules = models.IPPolicy.get_ip_policy_cidrs(subnet)
         self.assertEqual(ip_policy_rules, IPSet())
+
+    def test_get_ip_policy_ranges(self):
+        policy = models.IPPolicy(exclude=[
+            models.IPPolicyCIDR(cidr="0.0.0.0/32"),
+            models.IPPolicyCIDR(cidr="0.0.0.255/32")])
+        subnet = dict(id=1, ip_version=4, cidr="0.0.0.0/24",
+                      ip_policy=policy)
+        ip_policy_ranges = models.IPPolicy.get_ip_policy_ranges(subnet)
+        self.assertIn(IPAddress("0.0.0.0"), ip_policy_ranges)
+        self.assertNotIn(IPAddress("0.0.0.1"), ip_policy_ranges)
+        self.assertEqual(ip_policy_ranges.size, 2)
+
+    def test_subnet_allocation_pools_from_policy(self):
+        subnet = models.Subnet(cidr="192.168.0.0/24")
+        subnet["ip_policy"] = models.IPPolicy(exclude=[
+            models.IPPolicyCIDR(cidr="192.168.0.0/32"),
+            models.IPPolicyCIDR(cidr="192.168.0.16/28"),
+            models.IPPolicyCIDR(cidr="192.168.0.255/32")])
+        self.assertEqual(subnet.allocation_pools,
+                         [dict(start="192.168.0.1", end="192.168.0.15"),
+                          dict(start="192.168.0.32", end="192.168.0.254")])
+
+    def test_subnet_allocation_pools_v6_no_policy(self):
+        subnet = models.Subnet(cidr="fc00::/64")
+        self.assertEqual(subnet.allocation_pools,
+                         [dict(start="fc00::",
+                               end="fc00::ffff:ffff:ffff:ffff")])
+
+    def test_subnet_allocation_pools_from_current_cache(self):
+        subnet = models.Subnet(cidr="192.168.0.0/24")
+        subnet["_allocation_pool_cache"] = (
+            '[{"start": "192.168.0.10", "end": "192.168.0.20"}]')
+        subnet["_allocation_pool_cache_version"] = (
+            models.ALLOCATION_POOL_CACHE_VERSION)
+        self.assertTrue(models.Subnet.allocation_pool_cache_is_current(
+            subnet))
+        self.assertEqual(subnet.allocation_pools,
+                         [dict(start="192.168.0.10", end="192.168.0.20")])
+
+    def test_subnet_allocation_pools_ignores_cache_of_old_policy(self):
+        subnet = models.Subnet(cidr="192.168.0.0/24",
+                               ip_policy=models.IPPolicy(revision=2))
+        subnet["_allocation_pool_cache"] = (
+            '[{"start": "192.168.0.10", "end": "192.168.0.20"}]')
+        subnet["_allocation_pool_cache_version"] = (
+            models.ALLOCATION_POOL_CACHE_VERSION)
+        subnet["_allocation_pool_cache_policy_revision"] = 1
+        self.assertFalse(models.Subnet.allocation_pool_cache_is_current(
+            subnet))
+        subnet["_allocation_pool_cache_policy_revision"] = 2
+        self.assertTrue(models.Subnet.allocation_pool_cache_is_current(
+            subnet))
+
+    def test_subnet_allocation_pools_ignores_stale_cache(self):
+        subnet = models.Subnet(cidr="192.168.0.0/24")
+        subnet["_allocation_pool_cache"] = (
+            '[{"start": "192.168.0.10", "end": "192.168.0.20"}]')
+        self.assertFalse(models.Subnet.allocation_pool_cache_is_current(
+            subnet))
+        self.assertEqual(subnet.allocation_pools,
+                         [dict(start="192.168.0.0", end="192.168.0.255")])
@@ -0,0 +1,109 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import netaddr
+
+from quark.db import api as db_api
+from quark.db import models
+from quark import ip_policy_cache
+from quark.tests import test_base
+
+
+class TestIPPolicyCache(test_base.TestBase):
+    def setUp(self):
+        super(TestIPPolicyCache, self).setUp()
+        self.cache = ip_policy_cache.IPPolicyCache(max_size=2)
+
+    def test_hit_and_miss(self):
+        build = mock.Mock(return_value=netaddr.IPSet(["10.0.0.0/30"]))
+        first = self.cache.get("a", 0, build)
+        second = self.cache.get("a", 0, build)
+        self.assertIs(first, second)
+        self.assertEqual(build.call_count, 1)
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_new_revision_misses(self):
+        build = mock.Mock(side_effect=lambda: netaddr.IPSet())
+        self.cache.get("a", 0, build)
+        self.cache.get("a", 1, build)
+        self.assertEqual(build.call_count, 2)
+
+    def test_evicts_least_recently_used(self):
+        build = mock.Mock(side_effect=lambda: netaddr.IPSet())
+        self.cache.get("a", 0, build)
+        self.cache.get("b", 0, build)
+        self.cache.get("a", 0, build)
+        self.cache.get("c", 0, build)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        self.cache.get("a", 0, build)
+        self.assertEqual(build.call_count, 3)
+        self.cache.get("b", 0, build)
+        self.assertEqual(build.call_count, 4)
+
+    def test_invalidate(self):
+        build = mock.Mock(side_effect=lambda: netaddr.IPSet())
+        self.cache.get("a", 0, build)
+        self.cache.get("a", 1, build)
+        self.cache.invalidate("a")
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_no_id_not_cached(self):
+        build = mock.Mock(side_effect=lambda: netaddr.IPSet())
+        self.cache.get(None, 0, build)
+        self.cache.get(None, 0, build)
+        self.assertEqual(build.call_count, 2)
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_disabled(self):
+        cache = ip_policy_cache.IPPolicyCache(max_size=0)
+        build = mock.Mock(side_effect=lambda: netaddr.IPSet())
+        cache.get("a", 0, build)
+        cache.get("a", 0, build)
+        self.assertEqual(build.call_count, 2)
+
+
+class TestGetIPPolicyCidrsCached(test_base.TestBase):
+    def setUp(self):
+        super(TestGetIPPolicyCidrsCached, self).setUp()
+        ip_policy_cache.IP_POLICY_CACHE.clear()
+        self.addCleanup(ip_policy_cache.IP_POLICY_CACHE.clear)
+        self.context.session.add = mock.Mock()
+
+    def _subnet(self, exclude):
+        policy = models.IPPolicy(id="policy-1", revision=0)
+        policy["exclude"] = [models.IPPolicyCIDR(cidr=c) for c in exclude]
+        subnet = models.Subnet(cidr="192.168.0.0/24")
+        subnet["ip_policy"] = policy
+        return subnet
+
+    def test_cached_until_policy_updated(self):
+        subnet = self._subnet(["192.168.0.0/32"])
+        first = models.IPPolicy.get_ip_policy_cidrs(subnet)
+        self.assertIs(models.IPPolicy.get_ip_policy_cidrs(subnet), first)
+
+        def _bump(context, ip_policy):
+            ip_policy["revision"] += 1
+
+        with mock.patch("quark.db.api.ip_policy_bump_revision") as bump:
+            bump.side_effect = _bump
+            db_api.ip_policy_update(self.context, subnet["ip_policy"],
+                                    exclude=["192.168.0.255/32"])
+        self.assertEqual(subnet["ip_policy"]["revision"], 1)
+        updated = models.IPPolicy.get_ip_policy_cidrs(subnet)
+        self.assertEqual(updated, netaddr.IPSet(["192.168.0.255/32"]))
@@ -99,6 +99,10 @@ class QuarkIpamBaseTest(test_base.TestBase):
         self.context.session.begin = FakeContext
         self.context.session.add = mock.Mock()
 
+        patcher = mock.patch("quark.db.api.subnet_update_usage_counts")
+        self.usage_counts = patcher.start()
+        self.addCleanup(patcher.stop)
+
 
 class QuarkMacAddressAllocateDeallocated(QuarkIpamBaseTest):
     @contextlib.contextmanager
@@ -254,6 +258,57 @@ class QuarkNewMacAddressAllocation(QuarkIpamBaseTest):
             self.assertEqual(mr[0]["next_auto_assign_mac"], -1)
 
 
+class QuarkLeasedMacAddressAllocation(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkLeasedMacAddressAllocation, self).setUp()
+        cfg.CONF.set_override("mac_address_lease_block_size", 4, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "mac_address_lease_block_size", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, leased, addresses):
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_address_reallocate"),
+            mock.patch("quark.mac_address_leases.MAC_LEASES.next_address"),
+            mock.patch("quark.db.api.mac_address_create"),
+            mock.patch("quark.db.api."
+                       "mac_address_range_find_allocation_counts")
+        ) as (mac_realloc, next_address, mac_create, mac_range_count):
+            mac_realloc.return_value = False
+            next_address.side_effect = leased
+            mac_create.side_effect = [mac_helper(a) if isinstance(a, dict)
+                                      else a for a in addresses]
+            yield next_address, mac_create, mac_range_count
+
+    def test_allocate_mac_from_lease(self):
+        with self._stubs(leased=[(10, 1)], addresses=[dict(address=10)]) as (
+                next_address, mac_create, mac_range_count):
+            address = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(address["address"], 10)
+            mac_create.assert_called_once_with(self.context, address=10,
+                                               mac_address_range_id=1)
+            self.assertFalse(mac_range_count.called)
+
+    def test_allocate_mac_from_lease_skips_taken_address(self):
+        with self._stubs(leased=[(10, 1), (11, 1)],
+                         addresses=[Exception, dict(address=11)]) as (
+                next_address, mac_create, mac_range_count):
+            address = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(address["address"], 11)
+            self.assertEqual(next_address.call_count, 2)
+
+    def test_allocate_specific_mac_bypasses_lease(self):
+        mar = dict(id=1, first_address=0, last_address=255,
+                   next_auto_assign_mac=0)
+        with self._stubs(leased=[], addresses=[dict(address=254)]) as (
+                next_address, mac_create, mac_range_count):
+            mac_range_count.return_value = (range_helper(mar), 0)
+            address = self.ipam.allocate_mac_address(self.context, 0, 0, 0,
+                                                     mac_address=254)
+            self.assertEqual(address["address"], 254)
+            self.assertFalse(next_address.called)
+
+
 class QuarkNewMacAddressAllocationCreateConflict(QuarkIpamBaseTest):
     @contextlib.contextmanager
     def _stubs(self, addresses=None, ranges=None):
@@ -313,6 +368,122 @@ class QuarkNewMacAddressReallocationDeadlocks(QuarkIpamBaseTest):
             self.assertEqual(mac_realloc.call_count, 1)
 
 
+class QuarkBulkMacAddressAllocation(QuarkIpamBaseTest):
+    @contextlib.contextmanager
+    def _stubs(self, reallocated=None, ranges=None):
+        reallocated = [mac_helper(m) for m in reallocated or []]
+        ranges = [(range_helper(r), c) if r else None
+                  for r, c in ranges or []]
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_address_reallocate_many"),
+            mock.patch("quark.db.api.mac_address_reallocate_find_many"),
+            mock.patch("quark.db.api."
+                       "mac_address_range_find_allocation_counts"),
+            mock.patch("quark.db.api.mac_range_update_next_auto_assign_mac"),
+            mock.patch("quark.db.api.mac_range_update_set_full"),
+            mock.patch("quark.db.api.mac_address_create"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_mac_address")
+        ) as (mac_realloc, mac_realloc_find, mac_range_count, mac_range_inc,
+              mac_range_full, mac_create, alloc_mac):
+            mac_realloc.return_value = len(reallocated)
+            mac_realloc_find.return_value = reallocated
+            mac_range_count.side_effect = ranges + [None]
+            mac_create.side_effect = lambda context, **kw: mac_helper(kw)
+            alloc_mac.side_effect = lambda *args, **kw: mac_helper(
+                dict(address=0))
+            yield mac_range_inc, mac_range_full, alloc_mac
+
+    def test_allocate_reallocates_then_creates_block(self):
+        mar = dict(id=1, first_address=0, last_address=255,
+                   next_auto_assign_mac=5, cidr="AA:BB:CC/24")
+        with self._stubs(reallocated=[dict(address=100)],
+                         ranges=[(mar, 5)]) as (inc, full, alloc_mac):
+            macs = self.ipam.allocate_mac_addresses(self.context, [], 0,
+                                                    [1, 2, 3], 0)
+            self.assertEqual([m["address"] for m in macs], [100, 5, 6])
+            self.assertEqual(inc.call_count, 1)
+            args, kwargs = inc.call_args
+            self.assertEqual(kwargs["count"], 2)
+            self.assertFalse(full.called)
+            self.assertFalse(alloc_mac.called)
+
+    def test_allocate_fills_range_and_falls_back(self):
+        mar = dict(id=1, first_address=0, last_address=255,
+                   next_auto_assign_mac=254, cidr="AA:BB:CC/24")
+        with self._stubs(ranges=[(mar, 254)]) as (inc, full, alloc_mac):
+            macs = self.ipam.allocate_mac_addresses(self.context, [], 0,
+                                                    [1, 2, 3], 0)
+            self.assertEqual([m["address"] for m in macs], [254, 255, 0])
+            self.assertFalse(inc.called)
+            self.assertEqual(full.call_count, 1)
+            self.assertEqual(alloc_mac.call_count, 1)
+
+
+class QuarkBulkIPAddressAllocation(QuarkIpamBaseTest):
+    @contextlib.contextmanager
+    def _stubs(self, subnets=None):
+        with contextlib.nested(
+            mock.patch("quark.db.api.ip_address_reallocate_many"),
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.db.api.subnet_update_set_full"),
+            mock.patch("quark.ipam.QuarkIpam._notify_new_addresses"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_ip_address")
+        ) as (addr_realloc, subnet_find, subnet_update, subnet_set_full,
+              notify, alloc_ip):
+            addr_realloc.return_value = 0
+            subnet_find.return_value = [(subnet_helper(s), c)
+                                        for s, c in subnets]
+            subnet_update.return_value = 1
+
+            def _alloc_ip(context, new_addresses, *args, **kwargs):
+                new_addresses.append(ip_helper(dict(address=0, version=4)))
+
+            alloc_ip.side_effect = _alloc_ip
+            yield subnet_update, alloc_ip
+
+    def _subnet(self, next_ip):
+        net = netaddr.IPNetwork("192.168.0.0/24").ipv6()
+        excluded = netaddr.IPNetwork("192.168.0.0/30").ipv6()
+        next_ip = netaddr.IPAddress(next_ip).ipv6()
+        return dict(id=1, first_ip=net.first, last_ip=net.last,
+                    cidr="192.168.0.0/24", ip_version=4,
+                    next_auto_assign_ip=next_ip.value,
+                    ip_policy=dict(size=4, exclude=[
+                        models.IPPolicyCIDR(cidr="192.168.0.0/30",
+                                            first_ip=excluded.first,
+                                            last_ip=excluded.last)]))
+
+    def test_allocate_ip_addresses_in_one_subnet(self):
+        subnet = self._subnet("192.168.0.0")
+        with self._stubs(subnets=[(subnet, 0)]) as (subnet_update, alloc_ip):
+            addresses = self.ipam.allocate_ip_addresses(self.context, 0,
+                                                        [1, 2, 3], 0)
+            self.assertEqual([[a["address_readable"] for a in addrs]
+                              for addrs in addresses],
+                             [["192.168.0.4"], ["192.168.0.5"],
+                              ["192.168.0.6"]])
+            self.assertEqual(subnet_update.call_count, 1)
+            args, kwargs = subnet_update.call_args
+            self.assertEqual(
+                kwargs["next_ip"],
+                netaddr.IPAddress("::ffff:192.168.0.6").value)
+            self.assertFalse(alloc_ip.called)
+
+    def test_allocate_ip_addresses_falls_back_when_short(self):
+        subnet = self._subnet("192.168.0.254")
+        with self._stubs(subnets=[(subnet, 250)]) as (subnet_update,
+                                                      alloc_ip):
+            addresses = self.ipam.allocate_ip_addresses(self.context, 0,
+                                                        [1, 2, 3], 0)
+            self.assertEqual(len(addresses), 3)
+            self.assertEqual(addresses[0][0]["address_readable"],
+                             "192.168.0.254")
+            self.assertEqual(addresses[1][0]["address_readable"],
+                             "192.168.0.255")
+            self.assertEqual(alloc_ip.call_count, 1)
+
+
 class QuarkMacAddressDeallocation(QuarkIpamBaseTest):
     @contextlib.contextmanager
     def _stubs(self, mac, mac_range):
@@ -373,6 +544,8 @@ class QuarkIPAddressDeallocation(QuarkIpamBaseTest):
                         len(port["ip_addresses"]) == 0)
         self.assertTrue(addr["deallocated"])
         self.assertEqual(addr["address_type"], None)
+        self.usage_counts.assert_called_once_with(
+            self.context, 1, allocated=-1, deallocated_reusable=1)
 
     def test_deallocate_ip_address_specific_ip(self):
         port_dict = dict(ip_addresses=[], device_id="foo")
@@ -1496,6 +1669,34 @@ class QuarkNewIPAddressAllocation(QuarkIpamBaseTest):
                                           address_type='floating')
             self.assertEqual(address[0]["address_type"], 'floating')
 
+    def test_allocate_new_ip_address_skips_policy_holes(self):
+        net = netaddr.IPNetwork("192.168.0.0/24").ipv6()
+        excluded = netaddr.IPNetwork("192.168.0.0/28").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="192.168.0.0/24", ip_version=4,
+                      next_auto_assign_ip=net.first,
+                      ip_policy=dict(size=16, exclude=[
+                          models.IPPolicyCIDR(cidr="192.168.0.0/28",
+                                              first_ip=excluded.first,
+                                              last_ip=excluded.last)]))
+        with contextlib.nested(
+            self._stubs(subnets=[(subnet, 0)], addresses=[None, None]),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("sqlalchemy.orm.session.Session.refresh")
+        ) as (addr_realloc, subnet_update, refresh):
+            def refresh_mock(sub):
+                args, kwargs = subnet_update.call_args
+                sub["next_auto_assign_ip"] = kwargs["next_ip"] + 1
+
+            subnet_update.return_value = 1
+            refresh.side_effect = refresh_mock
+            address = []
+            self.ipam.allocate_ip_address(self.context, address, 0, 0, 0,
+                                          version=4)
+            self.assertEqual(subnet_update.call_count, 1)
+            self.assertEqual(address[0]["address"],
+                             netaddr.IPAddress("::ffff:192.168.0.16").value)
+
 
 class QuarkIPAddressAllocationTestRetries(QuarkIpamBaseTest):
     @contextlib.contextmanager
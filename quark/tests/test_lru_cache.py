@@ -0,0 +1,60 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from quark import lru_cache
+from quark.tests import test_base
+
+
+class TestLRUCache(test_base.TestBase):
+    def setUp(self):
+        super(TestLRUCache, self).setUp()
+        self.cache = lru_cache.LRUCache(max_size=2)
+
+    def test_get_or_build(self):
+        build = mock.Mock(return_value=[])
+        first = self.cache.get_or_build("a", build)
+        second = self.cache.get_or_build("a", build)
+        self.assertIs(first, second)
+        self.assertEqual(build.call_count, 1)
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.store("a", 1)
+        self.cache.store("b", 2)
+        self.assertEqual(self.cache.lookup("a"), 1)
+        self.cache.store("c", 3)
+        self.assertIsNone(self.cache.lookup("b"))
+        self.assertEqual(self.cache.lookup("a"), 1)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_discard_where(self):
+        self.cache.store(("a", 0), 1)
+        self.cache.store(("b", 0), 2)
+        self.cache.discard_where(lambda key: key[0] == "a")
+        self.assertIsNone(self.cache.lookup(("a", 0)))
+        self.assertEqual(self.cache.lookup(("b", 0)), 2)
+
+    def test_disabled(self):
+        cache = lru_cache.LRUCache(max_size=0)
+        build = mock.Mock(return_value=[])
+        cache.get_or_build("a", build)
+        cache.get_or_build("a", build)
+        self.assertEqual(build.call_count, 2)
+        self.assertEqual(cache.stats()["size"], 0)
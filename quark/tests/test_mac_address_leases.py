@@ -0,0 +1,124 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+
+import mock
+from oslo_config import cfg
+
+from quark.db import models
+from quark import mac_address_leases
+from quark.tests import test_base
+
+
+class TestMacAddressLeasePool(test_base.TestBase):
+    def setUp(self):
+        super(TestMacAddressLeasePool, self).setUp()
+        self.pool = mac_address_leases.MacAddressLeasePool()
+        cfg.CONF.set_override("mac_address_lease_block_size", 4, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "mac_address_lease_block_size", "QUARK")
+
+        class FakeContext(object):
+            def __enter__(*args, **kwargs):
+                pass
+
+            def __exit__(*args, **kwargs):
+                pass
+
+        self.context.session.begin = FakeContext
+
+    @contextlib.contextmanager
+    def _stubs(self, ranges):
+        ranges = [models.MacAddressRange(**r) if r else None for r in ranges]
+        db_mod = "quark.db.api"
+        with contextlib.nested(
+            mock.patch("%s.mac_address_range_find_for_lease" % db_mod),
+            mock.patch("%s.mac_range_update_next_auto_assign_mac" % db_mod),
+            mock.patch("%s.mac_range_update_set_full" % db_mod),
+            mock.patch("%s.mac_range_update_rewind_next_auto_assign_mac" %
+                       db_mod),
+            mock.patch("%s.mac_address_create" % db_mod),
+            mock.patch("%s.mac_address_update" % db_mod)
+        ) as (range_find, range_inc, range_full, range_rewind, mac_create,
+              mac_update):
+            range_find.side_effect = ranges
+            yield range_find, range_inc, range_full, range_rewind, mac_create
+
+    def test_next_address_serves_from_one_lease(self):
+        mar = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                   last_address=255, next_auto_assign_mac=10)
+        with self._stubs([mar]) as (range_find, range_inc, range_full,
+                                    range_rewind, mac_create):
+            addresses = [self.pool.next_address(self.context)
+                         for _ in xrange(4)]
+            self.assertEqual(addresses, [(10, 1), (11, 1), (12, 1), (13, 1)])
+            self.assertEqual(range_find.call_count, 1)
+            range_inc.assert_called_once_with(self.context, mock.ANY,
+                                              count=4)
+            self.assertFalse(range_full.called)
+
+    def test_next_address_leases_again_when_exhausted(self):
+        mar1 = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                    last_address=255, next_auto_assign_mac=254)
+        mar2 = dict(id=2, cidr="AA:BB:CD/24", first_address=256,
+                    last_address=511, next_auto_assign_mac=256)
+        with self._stubs([mar1, mar2]) as (range_find, range_inc, range_full,
+                                           range_rewind, mac_create):
+            addresses = [self.pool.next_address(self.context)
+                         for _ in xrange(3)]
+            self.assertEqual(addresses, [(254, 1), (255, 1), (256, 2)])
+            self.assertEqual(range_find.call_count, 2)
+            self.assertEqual(range_full.call_count, 1)
+
+    def test_next_address_no_ranges(self):
+        with self._stubs([None]):
+            self.assertIsNone(self.pool.next_address(self.context))
+
+    def test_release_rewinds_range(self):
+        mar = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                   last_address=255, next_auto_assign_mac=10)
+        with self._stubs([mar]) as (range_find, range_inc, range_full,
+                                    range_rewind, mac_create):
+            range_rewind.return_value = 1
+            self.pool.next_address(self.context)
+            self.pool.release(self.context)
+            range_rewind.assert_called_once_with(self.context, dict(id=1),
+                                                 14, 11)
+            self.assertFalse(mac_create.called)
+
+    def test_release_deallocates_when_range_moved_on(self):
+        mar = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                   last_address=255, next_auto_assign_mac=10)
+        with self._stubs([mar]) as (range_find, range_inc, range_full,
+                                    range_rewind, mac_create):
+            range_rewind.return_value = 0
+            self.pool.next_address(self.context)
+            self.pool.release(self.context)
+            self.assertEqual(mac_create.call_count, 3)
+
+    def test_expired_lease_returned_and_replaced(self):
+        mar1 = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                    last_address=255, next_auto_assign_mac=10)
+        mar2 = dict(id=1, cidr="AA:BB:CC/24", first_address=0,
+                    last_address=255, next_auto_assign_mac=14)
+        with self._stubs([mar1, mar2]) as (range_find, range_inc, range_full,
+                                           range_rewind, mac_create):
+            range_rewind.return_value = 0
+            self.pool.next_address(self.context)
+            self.pool._lease.leased_at -= (
+                cfg.CONF.QUARK.mac_address_lease_ttl + 1)
+            self.assertEqual(self.pool.next_address(self.context), (14, 1))
+            self.assertEqual(range_rewind.call_count, 1)
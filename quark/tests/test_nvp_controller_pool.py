@@ -0,0 +1,129 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+from oslo_config import cfg
+
+from quark.drivers import nvp_controller_pool
+from quark.tests import test_base
+
+CONF = cfg.CONF
+
+
+class TestControllerPool(test_base.TestBase):
+    def setUp(self):
+        super(TestControllerPool, self).setUp()
+        for name, value in (("controller_max_consecutive_failures", 3),
+                            ("controller_error_min_requests", 4),
+                            ("controller_error_threshold", 0.5),
+                            ("controller_ejection_seconds", 30)):
+            CONF.set_override(name, value, "NVP")
+            self.addCleanup(CONF.clear_override, name, "NVP")
+        self.controllers = [dict(ip_address="10.0.0.%d" % i, http_timeout=30)
+                            for i in xrange(3)]
+        self.pool = nvp_controller_pool.ControllerPool(self.controllers)
+        patcher = mock.patch("time.time", return_value=1000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, elapsed=0.1, healthy=True, index=None):
+        if index is None:
+            index = self.pool.acquire()
+        self.pool.release(index, elapsed, healthy)
+        return index
+
+    def test_acquire_no_controllers(self):
+        self.assertIsNone(nvp_controller_pool.ControllerPool([]).acquire())
+
+    def test_unmeasured_controllers_tried_first(self):
+        self.assertEqual([self._request(elapsed=i + 1) for i in xrange(3)],
+                         [0, 1, 2])
+
+    def test_lowest_latency_preferred(self):
+        for index, elapsed in ((0, 2.0), (1, 0.1), (2, 1.0)):
+            self._request(elapsed=elapsed, index=index)
+        self.assertEqual(self.pool.acquire(), 1)
+
+    def test_in_flight_requests_spread(self):
+        for index in xrange(3):
+            self._request(elapsed=0.1, index=index)
+        self.assertEqual(sorted(self.pool.acquire() for _ in xrange(3)),
+                         [0, 1, 2])
+
+    def test_consecutive_failures_eject(self):
+        for _ in xrange(3):
+            self._request(index=0, healthy=False)
+        self._request(index=1, elapsed=5.0)
+        self._request(index=2, elapsed=5.0)
+        self.assertNotIn(0, [self._request() for _ in xrange(5)])
+        self.assertEqual(self.pool.stats()[0]["ejections"], 1)
+
+    def test_failed_controller_not_retried(self):
+        for index, elapsed in ((0, 0.1), (1, 0.5), (2, 1.0)):
+            self._request(elapsed=elapsed, index=index)
+        index = self.pool.acquire()
+        self.assertEqual(index, 0)
+        self.pool.release(index, 0.01, False)
+        self.assertTrue(self.pool.stats()[0]["available"])
+        self.assertEqual(self.pool.acquire(), 1)
+
+    def test_failed_unmeasured_controller_not_retried(self):
+        self.assertEqual(self._request(elapsed=0.01, healthy=False), 0)
+        self.assertEqual(self._request(), 1)
+        self.assertEqual(self.pool.acquire(), 2)
+
+    def test_error_rate_ejects(self):
+        for healthy in (True, False, True, False):
+            self._request(index=0, healthy=healthy)
+        self.assertFalse(self.pool.stats()[0]["available"])
+
+    def test_ejected_controller_probed_after_cooldown(self):
+        for _ in xrange(3):
+            self._request(index=0, healthy=False)
+        self._request(index=1, elapsed=5.0)
+        self._request(index=2, elapsed=5.0)
+        self.time.return_value += 31
+        self.assertEqual(self.pool.acquire(), 0)
+        # NOTE: only one probe at a time
+        self.assertNotEqual(self.pool.acquire(), 0)
+        self.pool.release(0, 0.1, True)
+        self.assertEqual(self.pool.acquire(), 0)
+
+    def test_failed_probe_ejects_again(self):
+        for _ in xrange(3):
+            self._request(index=0, healthy=False)
+        self.time.return_value += 31
+        index = self.pool.acquire()
+        self.assertEqual(index, 0)
+        self.pool.release(index, 0.1, False)
+        self.assertFalse(self.pool.stats()[0]["available"])
+        self.assertEqual(self.pool.stats()[0]["ejections"], 2)
+
+    def test_all_ejected_fails_open(self):
+        for index in xrange(3):
+            for _ in xrange(3):
+                self._request(index=index, healthy=False)
+            self.time.return_value += 1
+        self.assertEqual(self.pool.acquire(), 0)
+
+    def test_start_breaks_ties(self):
+        self.pool.start = 2
+        self.assertEqual(self.pool.acquire(), 2)
+
+    def test_added_controllers_picked_up(self):
+        self.controllers.append(dict(ip_address="10.0.0.3"))
+        for index in xrange(3):
+            self._request(elapsed=0.1, index=index)
+        self.assertEqual(self.pool.acquire(), 3)
@@ -47,6 +47,16 @@ class TestNVPDriver(test_base.TestBase):
         self.max_spanning = 3
         self.driver.limits.update({'max_rules_per_group': 3,
                                    'max_rules_per_port': 2})
+        self.context.session.add = mock.Mock(return_value=None)
+        patcher = mock.patch.multiple(
+            "quark.drivers.nvp_driver.NVPDriver",
+            _lport_profiles_set=mock.DEFAULT,
+            _lport_profiles_clear=mock.DEFAULT,
+            _lport_rule_counts_shift=mock.DEFAULT,
+            _lport_rule_count_max=mock.DEFAULT)
+        self.lport_records = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lport_records["_lport_rule_count_max"].return_value = 0
 
     def _create_connection(self, switch_count=1,
                            has_switches=False, maxed_ports=False):
@@ -373,13 +383,14 @@ class TestNVPDriverCreatePort(TestNVPDriver):
     def _stubs(self, has_lswitch=True, maxed_ports=False, net_details=None):
         with contextlib.nested(
             mock.patch("%s._connection" % self.d_pkg),
-            mock.patch("%s._next_connection" % self.d_pkg),
             mock.patch("%s._lswitches_for_network" % self.d_pkg),
             mock.patch("%s._get_network_details" % self.d_pkg),
-        ) as (conn, next_conn, get_switches, get_net_dets):
+            mock.patch("%s._query_security_group" % self.d_pkg),
+        ) as (conn, get_switches, get_net_dets, query_group):
             connection = self._create_connection(has_switches=has_lswitch,
                                                  maxed_ports=maxed_ports)
             conn.return_value = connection
+            query_group.return_value = None
             get_switches.return_value = connection.lswitch().query()
             get_net_dets.return_value = net_details
             yield connection
@@ -523,8 +534,9 @@ class TestNVPDriverUpdatePort(TestNVPDriver):
     def _stubs(self):
         with contextlib.nested(
             mock.patch("%s._connection" % self.d_pkg),
-            mock.patch("%s._next_connection" % self.d_pkg),
-        ) as (conn, next_conn):
+            mock.patch("%s._query_security_group" % self.d_pkg),
+        ) as (conn, query_group):
+            query_group.return_value = None
             connection = self._create_connection()
             connection.securityprofile = self._create_security_profile()
             conn.return_value = connection
@@ -615,10 +627,7 @@ class TestSwitchCopying(TestNVPDriver):
 class TestNVPDriverDeletePort(TestNVPDriver):
     @contextlib.contextmanager
     def _stubs(self, switch_count=1):
-        with contextlib.nested(
-            mock.patch("%s._connection" % self.d_pkg),
-            mock.patch("%s._next_connection" % self.d_pkg),
-        ) as (conn, next_conn):
+        with mock.patch("%s._connection" % self.d_pkg) as conn:
             connection = self._create_connection(switch_count=switch_count)
             conn.return_value = connection
             yield connection
@@ -736,13 +745,98 @@ class TestNVPDriverDeletePortWithExceptions(TestNVPDriver):
                 self.assertTrue(connection.lswitch_port().delete.called)
 
 
-class TestNVPDriverCreateSecurityGroup(TestNVPDriver):
+class TestNVPDriverLSwitchPortCache(TestNVPDriver):
     @contextlib.contextmanager
-    def _stubs(self):
+    def _stubs(self, lswitches=None):
+        cfg.CONF.set_override('environment_capabilities', [], 'QUARK')
         with contextlib.nested(
             mock.patch("%s._connection" % self.d_pkg),
-            mock.patch("%s._next_connection" % self.d_pkg),
-        ) as (conn, next_conn):
+            mock.patch("%s._lswitch_query_by_port" % self.d_pkg),
+        ) as (conn, query_by_port):
+            connection = self._create_connection()
+            connection.securityprofile = self._create_security_profile()
+            conn.return_value = connection
+            query_by_port.side_effect = lswitches or [self.lswitch_uuid]
+            yield connection, query_by_port
+        cfg.CONF.clear_override('environment_capabilities', 'QUARK')
+
+    def test_update_port_looks_lswitch_up_once(self):
+        with self._stubs() as (connection, query_by_port):
+            self.driver.update_port(self.context, self.lport_uuid)
+            self.driver.update_port(self.context, self.lport_uuid)
+            query_by_port.assert_called_once_with(self.context,
+                                                  self.lport_uuid)
+            connection.lswitch_port.assert_called_with(self.lswitch_uuid,
+                                                       self.lport_uuid)
+
+    def test_create_port_records_lswitch(self):
+        with self._stubs() as (connection, query_by_port):
+            with mock.patch("%s._create_or_choose_lswitch" % self.d_pkg) as (
+                    choose):
+                choose.return_value = self.lswitch_uuid
+                self.driver.create_port(self.context, self.net_id,
+                                        self.port_id)
+            self.driver.update_port(self.context, self.lport_uuid)
+            self.assertFalse(query_by_port.called)
+
+    def test_update_port_404_looks_lswitch_up_again(self):
+        self.driver.lswitch_port_cache.set(self.lport_uuid, "stale")
+        with self._stubs() as (connection, query_by_port):
+            connection.lswitch_port().update.side_effect = [
+                aiclib.core.AICException(404, 'foo'), {}]
+            self.driver.update_port(self.context, self.lport_uuid)
+            query_by_port.assert_called_once_with(self.context,
+                                                  self.lport_uuid)
+            connection.lswitch_port.assert_called_with(self.lswitch_uuid,
+                                                       self.lport_uuid)
+
+    def test_delete_port_forgets_lswitch(self):
+        self.driver.lswitch_port_cache.set(self.lport_uuid, self.lswitch_uuid)
+        with self._stubs() as (connection, query_by_port):
+            self.driver.delete_port(self.context, self.lport_uuid)
+            connection.lswitch_port.assert_called_with(self.lswitch_uuid,
+                                                       self.lport_uuid)
+            self.assertFalse(query_by_port.called)
+        self.assertIsNone(self.driver.lswitch_port_cache.get(self.lport_uuid))
+
+    def test_delete_port_stale_lswitch_verified(self):
+        self.driver.lswitch_port_cache.set(self.lport_uuid, "stale")
+        with self._stubs() as (connection, query_by_port):
+            connection.lswitch_port().delete.side_effect = [
+                aiclib.core.AICException(404, 'foo'), None]
+            self.driver.delete_port(self.context, self.lport_uuid)
+            query_by_port.assert_called_once_with(self.context,
+                                                  self.lport_uuid)
+            connection.lswitch_port.assert_called_with(self.lswitch_uuid,
+                                                       self.lport_uuid)
+            self.assertEqual(connection.lswitch_port().delete.call_count, 2)
+
+    def test_delete_port_already_gone(self):
+        self.driver.lswitch_port_cache.set(self.lport_uuid, self.lswitch_uuid)
+        with self._stubs(lswitches=[None]) as (connection, query_by_port):
+            connection.lswitch_port().delete.side_effect = (
+                aiclib.core.AICException(404, 'foo'))
+            self.driver.delete_port(self.context, self.lport_uuid)
+            self.assertEqual(connection.lswitch_port().delete.call_count, 1)
+        self.assertIsNone(self.driver.lswitch_port_cache.get(self.lport_uuid))
+
+    def test_cache_bounded(self):
+        cache = quark.drivers.nvp_driver.LSwitchPortCache(max_size=2)
+        for port_id in ("p1", "p2", "p3"):
+            cache.set(port_id, "s-%s" % port_id)
+        self.assertIsNone(cache.get("p1"))
+        self.assertEqual(cache.get("p3"), "s-p3")
+
+    def test_cache_disabled(self):
+        cache = quark.drivers.nvp_driver.LSwitchPortCache(max_size=0)
+        cache.set("p1", "s1")
+        self.assertIsNone(cache.get("p1"))
+
+
+class TestNVPDriverCreateSecurityGroup(TestNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self):
+        with mock.patch("%s._connection" % self.d_pkg) as conn:
             connection = self._create_connection()
             connection.securityprofile = self._create_security_profile()
             conn.return_value = connection
@@ -796,8 +890,9 @@ class TestNVPDriverDeleteSecurityGroup(TestNVPDriver):
     def _stubs(self):
         with contextlib.nested(
             mock.patch("%s._connection" % self.d_pkg),
-            mock.patch("%s._next_connection" % self.d_pkg),
-        ) as (conn, next_conn):
+            mock.patch("%s._query_security_group" % self.d_pkg),
+        ) as (conn, query_group):
+            query_group.return_value = None
             connection = self._create_connection()
             connection.securityprofile = self._create_security_profile()
             conn.return_value = connection
@@ -826,8 +921,9 @@ class TestNVPDriverUpdateSecurityGroup(TestNVPDriver):
     def _stubs(self):
         with contextlib.nested(
             mock.patch("%s._connection" % self.d_pkg),
-            mock.patch("%s._next_connection" % self.d_pkg),
-        ) as (conn, next_conn):
+            mock.patch("%s._query_security_group" % self.d_pkg),
+        ) as (conn, query_group):
+            query_group.return_value = None
             connection = self._create_connection()
             connection.securityprofile = self._create_security_profile()
             conn.return_value = connection
@@ -887,8 +983,9 @@ class TestNVPDriverCreateSecurityGroupRule(TestNVPDriver):
     def _stubs(self):
         with contextlib.nested(
             mock.patch("%s._connection" % self.d_pkg),
-            mock.patch("%s._next_connection" % self.d_pkg),
-        ) as (conn, next_conn):
+            mock.patch("%s._query_security_group" % self.d_pkg),
+        ) as (conn, query_group):
+            query_group.return_value = None
             connection = self._create_connection()
             connection.securityprofile = self._create_security_profile()
             connection.securityrule = self._create_security_rule()
@@ -951,9 +1048,25 @@ class TestNVPDriverCreateSecurityGroupRule(TestNVPDriver):
                     {'ethertype': 'IPv4', 'direction': 'egress'})
 
     def test_security_rule_create_over_port(self):
+        rule_count_max = self.lport_records["_lport_rule_count_max"]
+        rule_count_max.return_value = 2
+        with self._stubs() as connection:
+            with self.assertRaises(sg_ext.nexception.InvalidInput):
+                self.driver.create_security_group_rule(
+                    self.context, 1,
+                    {'ethertype': 'IPv4', 'direction': 'egress'})
+            rule_count_max.assert_called_once_with(self.context, 1)
+            self.assertFalse(connection.lswitch_port().query.called)
+
+    def test_security_rule_create_over_unrecorded_port(self):
+        rule_count_max = self.lport_records["_lport_rule_count_max"]
+        rule_count_max.return_value = None
         with self._stubs() as connection:
             connection.securityprofile().read().update(
                 {'logical_port_ingress_rules': [1, 2]})
+            connection.lswitch_port().query().security_profile_uuid(
+            ).results.return_value = {
+                'results': [{'security_profiles': [self.profile_id]}]}
             with self.assertRaises(sg_ext.nexception.InvalidInput):
                 self.driver.create_security_group_rule(
                     self.context, 1,
@@ -971,7 +1084,9 @@ class TestNVPDriverDeleteSecurityGroupRule(TestNVPDriver):
                 rule)
         with contextlib.nested(
                 mock.patch("%s._connection" % self.d_pkg),
-        ) as (conn,):
+                mock.patch("%s._query_security_group" % self.d_pkg),
+        ) as (conn, query_group):
+            query_group.return_value = None
             connection = self._create_connection()
             connection.securityprofile = self._create_security_profile()
             connection.securityrule = self._create_security_rule()
@@ -1001,6 +1116,99 @@ class TestNVPDriverDeleteSecurityGroupRule(TestNVPDriver):
                     {'ethertype': 'IPv6', 'direction': 'egress'})
 
 
+class TestNVPDriverSecurityProfileRecords(TestNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self, rule_count=1):
+        cfg.CONF.set_override('environment_capabilities', [], 'QUARK')
+        with contextlib.nested(
+            mock.patch("%s._connection" % self.d_pkg),
+            mock.patch("%s._lswitch_from_port" % self.d_pkg),
+            mock.patch("%s._query_security_group" % self.d_pkg),
+        ) as (conn, switch, query_group):
+            connection = self._create_connection()
+            connection.securityprofile = self._create_security_profile()
+            connection.securityrule = self._create_security_rule()
+            conn.return_value = connection
+            switch.return_value = self.lswitch_uuid
+            profile = quark.drivers.nvp_driver.SecurityProfile(
+                id=1, nvp_id=self.profile_id, rule_count=rule_count)
+            query_group.return_value = profile
+            yield connection, profile
+        cfg.CONF.clear_override('environment_capabilities', 'QUARK')
+
+    def test_create_security_group_records_profile(self):
+        with self._stubs() as (connection, _):
+            connection.securityprofile().create.return_value = {
+                'uuid': self.profile_id}
+            self.driver.create_security_group(
+                self.context, 'foo', group_id=1,
+                port_ingress_rules=[{'ethertype': 'IPv4'}],
+                port_egress_rules=[{'ethertype': 'IPv6'}])
+        profile = self.context.session.add.call_args[0][0]
+        self.assertEqual(profile.id, 1)
+        self.assertEqual(profile.nvp_id, self.profile_id)
+        self.assertEqual(profile.rule_count, 2)
+
+    def test_update_port_records_profiles(self):
+        with self._stubs() as (connection, profile):
+            self.driver.update_port(self.context, self.lport_uuid,
+                                    security_groups=[1])
+            self.assertFalse(connection.securityprofile().query.called)
+            connection.lswitch_port().assert_has_calls([
+                mock.call.security_profiles([self.profile_id]),
+            ], any_order=True)
+        self.lport_records["_lport_profiles_set"].assert_called_once_with(
+            self.context, self.lport_uuid, [profile])
+
+    def test_update_port_counts_rules_locally(self):
+        with self._stubs(rule_count=3) as (connection, _):
+            with self.assertRaises(sg_ext.nexception.InvalidInput):
+                self.driver.update_port(self.context, self.lport_uuid,
+                                        security_groups=[1])
+            self.assertFalse(connection.securityprofile().query.called)
+            self.assertFalse(connection.securityprofile().read.called)
+        self.assertFalse(self.lport_records["_lport_profiles_set"].called)
+
+    def test_delete_port_clears_profiles(self):
+        with self._stubs():
+            self.driver.delete_port(self.context, self.lport_uuid)
+        self.lport_records["_lport_profiles_clear"].assert_called_once_with(
+            self.context, self.lport_uuid)
+
+    def test_rule_create_shifts_port_counts(self):
+        with self._stubs(rule_count=0) as (connection, profile):
+            self.driver.create_security_group_rule(
+                self.context, 1,
+                {'ethertype': 'IPv4', 'direction': 'ingress'})
+            self.assertFalse(connection.securityprofile().query.called)
+            self.assertFalse(connection.lswitch_port().query.called)
+            connection.securityprofile.assert_any_call(self.profile_id)
+        self.assertEqual(profile.rule_count, 1)
+        shift = self.lport_records["_lport_rule_counts_shift"]
+        shift.assert_called_once_with(self.context, 1, 1)
+
+    def test_rule_delete_shifts_port_counts(self):
+        with self._stubs() as (connection, profile):
+            connection.securityprofile().read().update(
+                {'logical_port_ingress_rules': [{'ethertype': 'IPv4'}]})
+            self.driver.delete_security_group_rule(
+                self.context, 1,
+                {'ethertype': 'IPv4', 'direction': 'ingress'})
+        self.assertEqual(profile.rule_count, 0)
+        shift = self.lport_records["_lport_rule_counts_shift"]
+        shift.assert_called_once_with(self.context, 1, -1)
+
+    def test_delete_security_group_forgets_profile(self):
+        with self._stubs() as (connection, profile):
+            session_delete = self.context.session.delete
+            self.context.session.delete = mock.Mock(return_value=None)
+            self.driver.delete_security_group(self.context, 1)
+            self.assertFalse(connection.securityprofile().query.called)
+            connection.securityprofile.assert_any_call(self.profile_id)
+            self.context.session.delete.assert_called_once_with(profile)
+            self.context.session.delete = session_delete
+
+
 class TestNVPDriverLoadConfig(TestNVPDriver):
     def test_load_config(self):
         controllers = "192.168.221.139:443:admin:admin:30:10:2:2"
@@ -1043,8 +1251,7 @@ class TestNVPGetConnection(TestNVPDriver):
         controllers = "192.168.221.139:443:admin:admin:30:10:2:2"
         cfg.CONF.set_override("controller_connection", [controllers], "NVP")
         if has_conn:
-            self.driver.nvp_connections.append(dict(connection="foo",
-                                                    usages=0))
+            self.driver.nvp_connections.append(dict(connection="foo"))
         else:
             self.driver.nvp_connections.append(dict(port="443",
                                                     ip_address="192.168.0.1",
@@ -1052,58 +1259,49 @@ class TestNVPGetConnection(TestNVPDriver):
                                                     password="admin",
                                                     http_timeout=10,
                                                     retries=1,
-                                                    backoff=0,
-                                                    usages=0))
+                                                    backoff=0))
         with contextlib.nested(
             mock.patch("aiclib.nvp.Connection"),
-            mock.patch("%s._next_connection" % self.d_pkg)
-        ) as (aiclib_conn, next_conn):
-            yield aiclib_conn, next_conn
+            mock.patch.object(self.driver.controller_pool, "release")
+        ) as (aiclib_conn, release):
+            yield aiclib_conn, release
         cfg.CONF.clear_override("controller_connection", "NVP")
 
     def test_get_connection(self):
-        with self._stubs(has_conn=False) as (aiclib_conn, next_conn):
+        with self._stubs(has_conn=False) as (aiclib_conn, release):
             with self.driver.get_connection():
                 pass
             self.assertTrue(aiclib_conn.called)
-            self.assertFalse(next_conn.called)
+            release.assert_called_once_with(0, mock.ANY, True)
 
     def test_get_connection_connection_defined(self):
-        with self._stubs(has_conn=True) as (aiclib_conn, next_conn):
-            with self.driver.get_connection():
-                pass
+        with self._stubs(has_conn=True) as (aiclib_conn, release):
+            with self.driver.get_connection() as connection:
+                self.assertEqual(connection, "foo")
             self.assertFalse(aiclib_conn.called)
-            self.assertFalse(next_conn.called)
+            release.assert_called_once_with(0, mock.ANY, True)
 
-    def test_get_connection_iterates(self):
-        with self._stubs(has_conn=True) as (aiclib_conn, next_conn):
-            try:
+    def test_get_connection_records_failure(self):
+        with self._stubs(has_conn=True) as (aiclib_conn, release):
+            with self.assertRaises(Exception):
                 with self.driver.get_connection():
                     raise Exception("Failure")
-            except Exception:
-                pass
-            self.assertFalse(aiclib_conn.called)
-            self.assertTrue(next_conn.called)
-
-    def test_get_connection_with_threshold(self):
-        cfg.CONF.set_override("connection_switching_threshold", 1, "NVP")
-        with self._stubs(has_conn=True) as (aiclib_conn, next_conn):
-            with self.driver.get_connection():
-                pass
-
             self.assertFalse(aiclib_conn.called)
-            self.assertTrue(next_conn.called)
-        cfg.CONF.clear_override("connection_switching_threshold", "NVP")
+            release.assert_called_once_with(0, mock.ANY, False)
 
-    def test_get_connection_with_threshold_next_conn_not_called(self):
-        cfg.CONF.set_override("connection_switching_threshold", 2, "NVP")
-        with self._stubs(has_conn=True) as (aiclib_conn, next_conn):
-            with self.driver.get_connection():
-                pass
+    def test_get_connection_controller_error_is_healthy(self):
+        with self._stubs(has_conn=True) as (aiclib_conn, release):
+            with self.assertRaises(aiclib.core.AICException):
+                with self.driver.get_connection():
+                    raise aiclib.core.AICException(404, "Not Found")
+            release.assert_called_once_with(0, mock.ANY, True)
 
-            self.assertFalse(aiclib_conn.called)
-            self.assertFalse(next_conn.called)
-        cfg.CONF.clear_override("connection_switching_threshold", "NVP")
+    def test_get_connection_server_error_is_unhealthy(self):
+        with self._stubs(has_conn=True) as (aiclib_conn, release):
+            with self.assertRaises(aiclib.core.AICException):
+                with self.driver.get_connection():
+                    raise aiclib.core.AICException(503, "Unavailable")
+            release.assert_called_once_with(0, mock.ANY, False)
 
 
 class TestNVPGetConnectionNoneDefined(TestNVPDriver):
@@ -1111,39 +1309,3 @@ class TestNVPGetConnectionNoneDefined(TestNVPDriver):
         with self.assertRaises(q_exc.NoBackendConnectionsDefined):
             with self.driver.get_connection():
                 pass
-
-
-class TestNVPNextConnection(TestNVPDriver):
-    @contextlib.contextmanager
-    def _stubs(self, rand=False):
-        controllers = "192.168.221.139:443:admin:admin:30:10:2:2"
-        cfg.CONF.set_override("controller_connection", [controllers], "NVP")
-        if rand:
-            cfg.CONF.set_override("connection_switching_random", True, "NVP")
-        conn1 = dict(port="443", ip_address="192.168.0.1", username="admin",
-                     password="admin", http_timeout=10, retries=1, backoff=0,
-                     usages=0)
-        conn2 = conn1.copy()
-        conn2["ip_address"] = "192.168.0.2"
-
-        self.driver.nvp_connections.extend([conn1, conn2])
-        with contextlib.nested(
-            mock.patch("random.randint")
-        ) as (randint,):
-            randint.return_value = 1
-            yield randint
-        cfg.CONF.clear_override("controller_connection", "NVP")
-        if rand:
-            cfg.CONF.clear_override("connection_switching_random", "NVP")
-
-    def test_get_connection(self):
-        with self._stubs() as randint:
-            self.driver._next_connection()
-            self.assertEqual(1, self.driver.conn_index)
-            self.assertFalse(randint.called)
-
-    def test_get_connection_random(self):
-        with self._stubs(rand=True) as randint:
-            self.driver._next_connection()
-            self.assertEqual(1, self.driver.conn_index)
-            self.assertTrue(randint.called)
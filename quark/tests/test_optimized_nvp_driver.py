@@ -20,6 +20,7 @@ import contextlib
 import mock
 
 import quark.db.models
+import quark.drivers.nvp_driver
 import quark.drivers.optimized_nvp_driver
 import quark.tests.test_nvp_driver as test_nvp_driver
 
@@ -46,6 +47,12 @@ class TestOptimizedNVPDriver(test_nvp_driver.TestNVPDriver):
         lport.switch.port_count = port_count
         return lport
 
+    def _port_count_add(self, context, switch, delta, max_ports=0):
+        if max_ports and switch.port_count >= max_ports:
+            return False
+        switch.port_count += delta
+        return True
+
 
 class TestOptimizedNVPDriverDeleteNetwork(TestOptimizedNVPDriver):
     '''Need to ensure that network of X switches deletes X switches.'''
@@ -156,8 +163,10 @@ class TestOptimizedNVPDriverDeletePortMultiSwitch(TestOptimizedNVPDriver):
             mock.patch("%s._lswitch_select_by_nvp_id" % self.d_pkg),
             mock.patch("%s._lswitches_for_network" % self.d_pkg),
             mock.patch("%s._lport_delete" % self.d_pkg),
+            mock.patch("%s._lswitch_port_count_add" % self.d_pkg),
         ) as (conn, select_port, select_switch,
-              two_switch, port_delete):
+              two_switch, port_delete, count_add):
+            count_add.side_effect = self._port_count_add
             connection = self._create_connection()
             port = self._create_lport_mock(port_count)
             switch = self._create_lswitch_mock()
@@ -248,7 +257,9 @@ class TestOptimizedNVPDriverDeletePortSingleSwitch(TestOptimizedNVPDriver):
             mock.patch("%s._lport_select_by_id" % self.d_pkg),
             mock.patch("%s._lswitch_select_by_nvp_id" % self.d_pkg),
             mock.patch("%s._lswitches_for_network" % self.d_pkg),
-        ) as (conn, select_port, select_switch, one_switch):
+            mock.patch("%s._lswitch_port_count_add" % self.d_pkg),
+        ) as (conn, select_port, select_switch, one_switch, count_add):
+            count_add.side_effect = self._port_count_add
             connection = self._create_connection()
             port = self._create_lport_mock(port_count)
             switch = self._create_lswitch_mock()
@@ -268,6 +279,33 @@ class TestOptimizedNVPDriverDeletePortSingleSwitch(TestOptimizedNVPDriver):
             self.assertFalse(connection.lswitch().delete.called)
 
 
+class TestOptimizedNVPDriverDeleteUnrecordedPort(TestOptimizedNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self):
+        with contextlib.nested(
+            mock.patch("%s._connection" % self.d_pkg),
+            mock.patch("%s._lport_select_by_id" % self.d_pkg),
+            mock.patch("%s._lswitch_select_by_nvp_id" % self.d_pkg),
+            mock.patch("%s._lswitch_query_by_port" % self.d_pkg),
+            mock.patch("%s._lswitch_port_count_add" % self.d_pkg),
+        ) as (conn, select_port, select_switch, query_by_port, count_add):
+            connection = self._create_connection()
+            conn.return_value = connection
+            select_port.return_value = None
+            select_switch.return_value = self._create_lswitch_mock()
+            query_by_port.return_value = self.lswitch_uuid
+            yield connection, count_add
+
+    def test_delete_port_without_row(self):
+        with self._stubs() as (connection, count_add):
+            self.driver.delete_port(self.context, self.port_id)
+            connection.lswitch_port.assert_any_call(self.lswitch_uuid,
+                                                    self.port_id)
+            self.assertTrue(connection.lswitch_port().delete.called)
+        self.assertFalse(self.context.session.add.called)
+        self.assertFalse(count_add.called)
+
+
 class TestOptimizedNVPDriverCreatePort(TestOptimizedNVPDriver):
     '''In no case should the optimized driver query for an lswitch.'''
 
@@ -279,20 +317,24 @@ class TestOptimizedNVPDriverCreatePort(TestOptimizedNVPDriver):
             mock.patch("%s._lswitch_select_first" % self.d_pkg),
             mock.patch("%s._lswitch_select_by_nvp_id" % self.d_pkg),
             mock.patch("%s._lswitch_create_optimized" % self.d_pkg),
-            mock.patch("%s._get_network_details" % self.d_pkg)
+            mock.patch("%s._get_network_details" % self.d_pkg),
+            mock.patch("%s._lswitch_port_count_add" % self.d_pkg),
+            mock.patch("%s._lswitch_precreate_check" % self.d_pkg),
         ) as (conn, select_free, select_first,
-              select_by_id, create_opt, get_net_dets):
+              select_by_id, create_opt, get_net_dets, count_add,
+              precreate_check):
             connection = self._create_connection()
             conn.return_value = connection
+            count_add.return_value = True
             if has_lswitch:
                 select_first.return_value = mock.Mock(nvp_id=self.lswitch_uuid)
             if not has_lswitch:
                 select_first.return_value = None
-                select_free.return_value = None
+                select_free.return_value = []
             elif not maxed_ports:
-                select_free.return_value = self._create_lswitch_mock()
+                select_free.return_value = [self._create_lswitch_mock()]
             else:
-                select_free.return_value = None
+                select_free.return_value = []
 
             select_by_id.return_value = self._create_lswitch_mock()
             get_net_dets.return_value = dict(foo=3)
@@ -409,6 +451,109 @@ class TestOptimizedNVPDriverCreatePort(TestOptimizedNVPDriver):
             self.assertTrue(False in status_args)
 
 
+class TestOptimizedNVPDriverReserveLSwitch(TestOptimizedNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self, switches):
+        self.driver.limits['max_ports_per_switch'] = self.max_spanning
+        with contextlib.nested(
+            mock.patch("%s._connection" % self.d_pkg),
+            mock.patch("%s._lswitch_select_free" % self.d_pkg),
+            mock.patch("%s._lswitch_create_for_network" % self.d_pkg),
+            mock.patch("%s._lswitch_port_count_add" % self.d_pkg),
+            mock.patch("%s._lswitch_precreate_check" % self.d_pkg),
+            mock.patch("quark.drivers.optimized_nvp_driver.random.shuffle"),
+        ) as (conn, select_free, create_switch, count_add, precreate_check,
+              shuffle):
+            connection = self._create_connection()
+            conn.return_value = connection
+            select_free.return_value = switches
+            create_switch.return_value = mock.Mock(nvp_id="new", port_count=0)
+            count_add.side_effect = self._port_count_add
+            yield connection, create_switch, count_add, precreate_check
+
+    def _switch(self, nvp_id, port_count):
+        return mock.Mock(id=nvp_id, nvp_id=nvp_id, port_count=port_count)
+
+    def test_create_port_skips_switch_filled_meanwhile(self):
+        full = self._switch("full", self.max_spanning)
+        free = self._switch("free", 1)
+        with self._stubs([full, free]) as (connection, create_switch,
+                                           count_add, precreate_check):
+            self.driver.create_port(self.context, self.net_id, self.port_id)
+            connection.lswitch_port.assert_any_call("free")
+            self.assertEqual(full.port_count, self.max_spanning)
+            self.assertEqual(free.port_count, 2)
+            self.assertFalse(create_switch.called)
+            precreate_check.assert_called_once_with(self.context, self.net_id)
+        lport = self.context.session.add.call_args[0][0]
+        self.assertEqual(lport.switch_id, "free")
+
+    def test_create_port_creates_switch_when_all_full(self):
+        full = self._switch("full", self.max_spanning)
+        with self._stubs([full]) as (connection, create_switch,
+                                     count_add, precreate_check):
+            self.driver.create_port(self.context, self.net_id, self.port_id)
+            connection.lswitch_port.assert_any_call("new")
+            self.assertEqual(create_switch.return_value.port_count, 1)
+
+    def test_create_port_failure_releases_reservation(self):
+        free = self._switch("free", 1)
+        with self._stubs([free]) as (connection, create_switch,
+                                     count_add, precreate_check):
+            connection.lswitch_port().create.side_effect = Exception("foo")
+            with self.assertRaises(Exception):
+                self.driver.create_port(self.context, self.net_id,
+                                        self.port_id)
+            self.assertEqual(free.port_count, 1)
+            count_add.assert_called_with(self.context, free, -1)
+            self.assertFalse(precreate_check.called)
+
+
+class TestOptimizedNVPDriverPrecreateLSwitch(TestOptimizedNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self, used, capacity):
+        self.driver.limits['max_ports_per_switch'] = self.max_spanning
+        mod = "quark.drivers.optimized_nvp_driver"
+        with contextlib.nested(
+            mock.patch("%s._lswitch_usage" % self.d_pkg),
+            mock.patch("%s._get_network_details" % self.d_pkg),
+            mock.patch("%s._lswitch_create_switch" % self.d_pkg),
+            mock.patch("%s.neutron_context.Context" % mod),
+            mock.patch("%s.threading.Thread" % mod),
+        ) as (usage, net_details, create_switch, context_cls, thread_cls):
+            usage.return_value = (used, capacity)
+            net_details.return_value = dict(network_name="public")
+            thread_cls.side_effect = (
+                lambda target: mock.Mock(start=target))
+            yield create_switch, context_cls
+
+    def test_precreate_below_threshold(self):
+        with self._stubs(5, 10) as (create_switch, context_cls):
+            self.driver._lswitch_precreate_check(self.context, self.net_id)
+            self.assertFalse(create_switch.called)
+
+    def test_precreate_above_threshold(self):
+        with self._stubs(9, 10) as (create_switch, context_cls):
+            self.driver._lswitch_precreate_check(self.context, self.net_id)
+            create_switch.assert_called_once_with(
+                context_cls.return_value, network_id=self.net_id,
+                network_name="public")
+            self.assertEqual(self.driver._precreating, set())
+
+    def test_precreate_once_per_network(self):
+        self.driver._precreating.add(self.net_id)
+        with self._stubs(9, 10) as (create_switch, context_cls):
+            self.driver._lswitch_precreate_check(self.context, self.net_id)
+            self.assertFalse(create_switch.called)
+        self.driver._precreating.discard(self.net_id)
+
+    def test_precreate_failure_is_logged(self):
+        with self._stubs(9, 10) as (create_switch, context_cls):
+            create_switch.side_effect = Exception("foo")
+            self.driver._lswitch_precreate_check(self.context, self.net_id)
+            self.assertEqual(self.driver._precreating, set())
+
+
 class TestOptimizedNVPDriverUpdatePort(TestOptimizedNVPDriver):
     def test_update_port(self):
         mod_path = "quark.drivers.%s"
@@ -425,6 +570,54 @@ class TestOptimizedNVPDriverUpdatePort(TestOptimizedNVPDriver):
             self.assertEqual(ret_port.switch_id, 2)
 
 
+class TestOptimizedNVPDriverLSwitchFromPort(TestOptimizedNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self, lport=None, switch=None):
+        with contextlib.nested(
+            mock.patch("%s._lport_select_by_id" % self.d_pkg),
+            mock.patch("%s._lswitch_select_by_nvp_id" % self.d_pkg),
+            mock.patch("quark.drivers.nvp_driver.NVPDriver."
+                       "_lswitch_query_by_port"),
+            mock.patch("%s._lswitch_port_count_add" % self.d_pkg),
+        ) as (lport_find, switch_find, query_by_port, count_add):
+            count_add.side_effect = self._port_count_add
+            lport_find.return_value = lport
+            switch_find.return_value = switch
+            query_by_port.return_value = "nvp_switch"
+            yield query_by_port
+
+    def test_lswitch_from_port_recorded(self):
+        lport = self._create_lport_mock(1)
+        with self._stubs(lport=lport) as query_by_port:
+            self.assertEqual(
+                self.driver._lswitch_from_port(self.context, self.lport_uuid),
+                lport.switch.nvp_id)
+            self.assertFalse(query_by_port.called)
+
+    def test_lswitch_from_port_falls_back_to_nvp(self):
+        switch = self._create_lswitch_mock()
+        with self._stubs(switch=switch) as query_by_port:
+            self.assertEqual(
+                self.driver._lswitch_from_port(self.context, self.lport_uuid),
+                "nvp_switch")
+            query_by_port.assert_called_once_with(self.context,
+                                                  self.lport_uuid)
+        lport = self.context.session.add.call_args[0][0]
+        self.assertEqual(lport.port_id, self.lport_uuid)
+        self.assertEqual(lport.switch_id, switch.id)
+        self.assertEqual(switch.port_count, 2)
+
+    def test_delete_port_without_lport_row(self):
+        with contextlib.nested(
+            mock.patch("%s._lport_select_by_id" % self.d_pkg),
+            mock.patch("quark.drivers.nvp_driver.NVPDriver.delete_port"),
+        ) as (lport_find, delete_port):
+            lport_find.return_value = None
+            self.driver.delete_port(self.context, self.lport_uuid)
+            delete_port.assert_called_once_with(self.context,
+                                                self.lport_uuid)
+
+
 class TestCreateSecurityGroups(TestOptimizedNVPDriver):
     def test_create_security_group(self):
         with mock.patch("%s._connection" % self.d_pkg):
@@ -434,16 +627,16 @@ class TestCreateSecurityGroups(TestOptimizedNVPDriver):
 
 class TestDeleteSecurityGroups(TestOptimizedNVPDriver):
     def test_delete_security_group(self):
-        mod_path = "quark.drivers.nvp_driver.NVPDriver"
         with contextlib.nested(
                 mock.patch("%s._connection" % self.d_pkg),
-                mock.patch("%s._query_security_group" % self.d_pkg),
-                mock.patch("%s.delete_security_group" % mod_path)):
+                mock.patch("%s._query_security_group" % self.d_pkg)) as (
+                conn, query_group):
 
             session_delete = self.context.session.delete
             self.context.session.delete = mock.Mock(return_value=None)
             self.driver.delete_security_group(self.context, 1)
-            self.assertTrue(self.context.session.delete.called)
+            self.context.session.delete.assert_called_once_with(
+                query_group.return_value)
             self.context.session.delete = session_delete
 
 
@@ -456,8 +649,8 @@ class TestSecurityGroupRules(TestOptimizedNVPDriver):
                 mock.patch("%s._query_security_group" % self.d_pkg),
                 mock.patch("%s._check_rule_count_per_port" % self.d_pkg),
         ) as (conn, query_sec_group, rule_count):
-            query_sec_group.return_value = (quark.drivers.optimized_nvp_driver.
-                                            SecurityProfile())
+            query_sec_group.return_value = (
+                quark.drivers.nvp_driver.SecurityProfile())
             connection = self._create_connection()
             rule_count.return_value = 1
             connection.securityprofile = self._create_security_profile()
@@ -574,6 +767,13 @@ class TestQueryMethods(TestOptimizedNVPDriver):
             self.driver._lswitch_select_free(self.context, 1)
             self.assertTrue(query_return.filter.called)
 
+    def test_lswitch_port_count_add(self):
+        with self._stubs() as query_return:
+            self.driver._lswitch_port_count_add(self.context, mock.Mock(), 1,
+                                                max_ports=3)
+            self.assertTrue(query_return.filter.called)
+            self.assertTrue(query_return.filter().filter().update.called)
+
     def test_lswitches_for_network(self):
         with self._stubs() as query_return:
             self.driver._lswitches_for_network(self.context, 1)
@@ -0,0 +1,85 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import netaddr
+
+from quark.policy_ranges import PolicyRanges
+from quark.tests import test_base
+
+
+def _ip(addr):
+    return netaddr.IPAddress(addr).ipv6().value
+
+
+def _policy(*cidrs):
+    ranges = []
+    for cidr in cidrs:
+        net = netaddr.IPNetwork(cidr).ipv6()
+        ranges.append((net.first, net.last))
+    return PolicyRanges(ranges)
+
+
+class TestPolicyRanges(test_base.TestBase):
+    def test_ranges_merged(self):
+        policy = _policy("192.168.0.16/28", "192.168.0.8/29",
+                         "192.168.0.20/30", "192.168.0.0/32")
+        self.assertEqual(policy.ranges(),
+                         [[_ip("192.168.0.0"), _ip("192.168.0.0")],
+                          [_ip("192.168.0.8"), _ip("192.168.0.31")]])
+        self.assertEqual(policy.size, 25)
+
+    def test_contains(self):
+        policy = _policy("192.168.0.16/28")
+        self.assertIn(netaddr.IPAddress("192.168.0.16"), policy)
+        self.assertIn(netaddr.IPAddress("::ffff:192.168.0.31"), policy)
+        self.assertIn(_ip("192.168.0.20"), policy)
+        self.assertIn("192.168.0.20", policy)
+        self.assertNotIn(netaddr.IPAddress("192.168.0.15"), policy)
+        self.assertNotIn(netaddr.IPAddress("192.168.0.32"), policy)
+
+    def test_empty(self):
+        policy = PolicyRanges()
+        self.assertFalse(policy)
+        self.assertNotIn(netaddr.IPAddress("192.168.0.1"), policy)
+        self.assertEqual(policy.size, 0)
+
+    def test_next_allowed(self):
+        policy = _policy("192.168.0.0/32", "192.168.0.16/28")
+        self.assertEqual(policy.next_allowed(_ip("192.168.0.0")),
+                         _ip("192.168.0.1"))
+        self.assertEqual(policy.next_allowed(_ip("192.168.0.5")),
+                         _ip("192.168.0.5"))
+        self.assertEqual(policy.next_allowed(_ip("192.168.0.20")),
+                         _ip("192.168.0.32"))
+
+    def test_allowed(self):
+        policy = _policy("192.168.0.0/32", "192.168.0.16/28",
+                         "192.168.0.255/32", "10.0.0.0/8")
+        net = netaddr.IPNetwork("192.168.0.0/24").ipv6()
+        self.assertEqual(policy.allowed(net.first, net.last),
+                         [[_ip("192.168.0.1"), _ip("192.168.0.15")],
+                          [_ip("192.168.0.32"), _ip("192.168.0.254")]])
+        self.assertEqual(policy.excluded_within(net.first, net.last), 18)
+
+    def test_allowed_fully_excluded(self):
+        policy = _policy("192.168.0.0/16")
+        net = netaddr.IPNetwork("192.168.0.0/24").ipv6()
+        self.assertEqual(policy.allowed(net.first, net.last), [])
+
+    def test_ip_ranges(self):
+        policy = _policy("192.168.0.0/32", "192.168.0.16/28")
+        self.assertEqual(policy.ip_ranges(4),
+                         [netaddr.IPRange("192.168.0.0", "192.168.0.0"),
+                          netaddr.IPRange("192.168.0.16", "192.168.0.31")])
@@ -0,0 +1,86 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+
+import mock
+from oslo_config import cfg
+
+from quark.db import models
+from quark.drivers import security_groups as sg_driver
+from quark.environment import Capabilities
+from quark import exceptions as q_exc
+from quark.tests import test_base
+
+CONF = cfg.CONF
+
+
+class TestSecurityGroupDriverUpdateGroupRules(test_base.TestBase):
+    def setUp(self):
+        super(TestSecurityGroupDriverUpdateGroupRules, self).setUp()
+        CONF.set_override("environment_capabilities",
+                          [Capabilities.SECURITY_GROUPS], "QUARK")
+        self.addCleanup(CONF.clear_override, "environment_capabilities",
+                        "QUARK")
+        self.driver = sg_driver.SecurityGroupDriver()
+
+    def _port(self, id, device_id, mac_address, groups):
+        port = models.Port(id=id, device_id=device_id,
+                           mac_address=mac_address)
+        port.security_groups = groups
+        return port
+
+    @contextlib.contextmanager
+    def _stubs(self, batches):
+        with contextlib.nested(
+            mock.patch("quark.db.api.security_group_port_batches"),
+            mock.patch("quark.cache.security_groups_client."
+                       "SecurityGroupsClient")
+        ) as (port_batches, client_cls):
+            port_batches.return_value = iter(batches)
+            client = client_cls.return_value
+            client.serialize_groups.side_effect = lambda groups: [
+                dict(id=rule["id"]) for group in groups
+                for rule in group.rules]
+            yield port_batches, client
+
+    def test_update_group_rules(self):
+        group = models.SecurityGroup(id="sg1", revision=3)
+        group.rules = [models.SecurityGroupRule(id="r1")]
+        batches = [[self._port("p1", "dev1", 1, [group]),
+                    self._port("p2", "dev2", 2, [group])],
+                   [self._port("p3", None, 3, [group])]]
+        with self._stubs(batches) as (port_batches, client):
+            result = self.driver.update_group_rules(self.context, ["sg1"])
+            port_batches.assert_called_once_with(
+                self.context, ["sg1"],
+                CONF.QUARK.security_group_fanout_batch_size)
+            self.assertEqual(client.serialize_groups.call_count, 2)
+            self.assertEqual(client.apply_rules_many.call_count, 2)
+            client.apply_rules_many.assert_any_call(
+                [("dev1", 1, [dict(id="r1")]), ("dev2", 2, [dict(id="r1")])])
+            client.apply_rules_many.assert_any_call([])
+        self.assertEqual(result, dict(ports=3, written=2, failed=[]))
+
+    def test_update_group_rules_records_failed_batch(self):
+        group = models.SecurityGroup(id="sg1", revision=0)
+        group.rules = []
+        batches = [[self._port("p1", "dev1", 1, [group])],
+                   [self._port("p2", "dev2", 2, [group])]]
+        with self._stubs(batches) as (port_batches, client):
+            client.apply_rules_many.side_effect = [
+                q_exc.RedisConnectionFailure, None]
+            result = self.driver.update_group_rules(self.context, ["sg1"])
+        self.assertEqual(result, dict(ports=2, written=1, failed=["p1"]))
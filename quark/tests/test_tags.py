@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import mock
 from neutron.common import exceptions
 
 from quark.db import models
@@ -204,6 +205,36 @@ class TestTagBase(test_base.TestBase):
         self.assertEqual(self.tag.pop(model), None)
         self._assert_tags(model, tags=[])
 
+    def test_index_cached_until_set(self):
+        model_tags = [
+            self.tag.serialize(self.value)
+        ]
+        model = self._create_test_model(1, tags=model_tags)
+        self.assertEqual(self.registry.get_all(model),
+                         {self.tag.get_name(): str(self.value)})
+        index = getattr(model, tags.TAG_INDEX_ATTR)
+        self.assertIs(tags.get_index(model), index)
+
+        self.tag.set(model, self.value2)
+        self.assertFalse(hasattr(model, tags.TAG_INDEX_ATTR))
+        self.assertEqual(self.tag.get(model), str(self.value2))
+
+        self.assertEqual(self.tag.pop(model), str(self.value2))
+        self.assertEqual(self.registry.get_all(model), {})
+
+    def test_index_validates_once(self):
+        model_tags = [
+            self.tag.serialize(self.invalid_value),
+            self.tag.serialize(self.value)
+        ]
+        model = self._create_test_model(1, tags=model_tags)
+        with mock.patch.object(self.tag, "validate",
+                               wraps=self.tag.validate) as validate:
+            self.assertEqual(self.tag.get(model), str(self.value))
+            self.assertEqual(self.tag.get(model), str(self.value))
+            self.assertTrue(self.tag.has_tag(model))
+            self.assertEqual(validate.call_count, 2)
+
 
 class TestVlanTag(TestTagBase):
 
@@ -0,0 +1,213 @@
+# Copyright 2016 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+
+from oslo_config import cfg
+
+from quark.db import ip_types
+from quark.db import models
+from quark.drivers import unicorn_driver
+from quark import exceptions as ex
+from quark.tests import test_base
+
+CONF = cfg.CONF
+
+
+class StubUnicornServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           StubUnicornHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.clients = set()
+        self.responses = {}
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def handle_error(self, request, client_address):
+        # NOTE: clients that time out hang up before the response is sent
+        pass
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d/v1.0/floating_ips" % self.server_port
+
+
+class StubUnicornHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self, method):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        server = self.server
+        with server.lock:
+            server.requests.append((method, self.path, body))
+            server.clients.add(self.client_address)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+            statuses = server.responses.get((method, self.path))
+            status = statuses.pop(0) if statuses else None
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+
+        status = status or {"POST": 201, "PUT": 200, "DELETE": 204}[method]
+        content = json.dumps({}) if status != 204 else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class TestUnicornDriver(test_base.TestBase):
+    def setUp(self):
+        super(TestUnicornDriver, self).setUp()
+        self.server = StubUnicornServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self._override(floating_ip_base_url=self.server.base_url,
+                       floating_ip_retry_backoff=0,
+                       floating_ip_read_timeout=2)
+        self.driver = unicorn_driver.UnicornDriver()
+        self.addCleanup(self.driver.reset_session)
+
+    def _override(self, **overrides):
+        for name, value in overrides.items():
+            CONF.set_override(name, value, "QUARK")
+            self.addCleanup(CONF.clear_override, name, "QUARK")
+
+    def _flip(self, id, address):
+        subnet = models.Subnet(id="subnet1", cidr="192.168.0.0/24")
+        fixed_ip = models.IPAddress(id="fixed-%s" % id,
+                                    address_readable="192.168.0.%s" % id,
+                                    version=4, address_type=ip_types.FIXED,
+                                    subnet=subnet)
+        port = models.Port(id="port-%s" % id, name="port", network_id="net1",
+                           mac_address=id, device_id="dev-%s" % id,
+                           device_owner="compute:nova")
+        port.ip_addresses = [fixed_ip]
+        flip = models.IPAddress(id=id, address_readable=address, version=4,
+                                address_type=ip_types.FLOATING)
+        return flip, port, fixed_ip
+
+    def test_register_floating_ip_reuses_connection(self):
+        flip, port, fixed_ip = self._flip("1", "10.0.0.1")
+        self.driver.register_floating_ip(flip, port, fixed_ip)
+        self.driver.update_floating_ip(flip, port, fixed_ip)
+        self.driver.remove_floating_ip(flip)
+
+        methods = [(method, path) for method, path, _ in self.server.requests]
+        self.assertEqual(methods, [
+            ("POST", "/v1.0/floating_ips"),
+            ("PUT", "/v1.0/floating_ips/10.0.0.1"),
+            ("DELETE", "/v1.0/floating_ips/10.0.0.1")])
+        body = json.loads(self.server.requests[0][2])
+        self.assertEqual(body["floating_ip"]["public_ip"], "10.0.0.1")
+        endpoint = body["floating_ip"]["endpoints"][0]
+        self.assertEqual(endpoint["private_ip"], "192.168.0.1")
+        self.assertEqual(endpoint["port"]["uuid"], "port-1")
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_update_floating_ip_retries_unavailable(self):
+        flip, port, fixed_ip = self._flip("1", "10.0.0.1")
+        self.server.responses[("PUT", "/v1.0/floating_ips/10.0.0.1")] = [
+            503, 502]
+        self.driver.update_floating_ip(flip, port, fixed_ip)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_update_floating_ip_retries_exhausted(self):
+        self._override(floating_ip_retries=1)
+        flip, port, fixed_ip = self._flip("1", "10.0.0.1")
+        self.server.responses[("PUT", "/v1.0/floating_ips/10.0.0.1")] = [
+            503, 503, 503]
+        with self.assertRaises(ex.RegisterFloatingIpFailure):
+            self.driver.update_floating_ip(flip, port, fixed_ip)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_register_floating_ip_not_retried(self):
+        flip, port, fixed_ip = self._flip("1", "10.0.0.1")
+        self.server.responses[("POST", "/v1.0/floating_ips")] = [503]
+        with self.assertRaises(ex.RegisterFloatingIpFailure):
+            self.driver.register_floating_ip(flip, port, fixed_ip)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_register_floating_ip_read_timeout(self):
+        self._override(floating_ip_read_timeout=0.1)
+        self.server.delay = 0.5
+        flip, port, fixed_ip = self._flip("1", "10.0.0.1")
+        with self.assertRaises(ex.RegisterFloatingIpFailure):
+            self.driver.register_floating_ip(flip, port, fixed_ip)
+
+    def test_remove_floating_ip_not_found(self):
+        flip, port, fixed_ip = self._flip("1", "10.0.0.1")
+        self.server.responses[("DELETE", "/v1.0/floating_ips/10.0.0.1")] = [
+            404]
+        self.driver.remove_floating_ip(flip)
+
+    def test_register_floating_ips(self):
+        self.server.delay = 0.05
+        self.server.responses[("POST", "/v1.0/floating_ips")] = [500]
+        registrations = [self._flip(str(i), "10.0.0.%d" % i)
+                         for i in xrange(1, 11)]
+        result = self.driver.register_floating_ips(registrations,
+                                                   concurrency=3)
+        self.assertEqual(result["registered"], 9)
+        self.assertEqual(len(result["failed"]), 1)
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertTrue(1 < self.server.max_in_flight <= 3)
+        self.assertTrue(len(self.server.clients) <= 3)
+
+    def test_register_floating_ips_builds_on_calling_thread(self):
+        build = unicorn_driver.UnicornDriver._build_request_body
+        threads = []
+
+        def _build_request_body(*registration):
+            threads.append(threading.current_thread())
+            return build(*registration)
+
+        self.driver._build_request_body = _build_request_body
+        registrations = [self._flip(str(i), "10.0.0.%d" % i)
+                         for i in xrange(1, 6)]
+        result = self.driver.register_floating_ips(registrations,
+                                                   concurrency=3)
+        self.assertEqual(result["registered"], 5)
+        self.assertEqual(threads, [threading.current_thread()] * 5)
@@ -19,7 +19,6 @@ import contextlib
 
 import mock
 
-from quark.cache import security_groups_client
 from quark.db import models
 from quark import exceptions as q_exc
 from quark.tests import test_base
@@ -59,6 +58,11 @@ class QuarkRedisSgToolTestDispatch(QuarkRedisSgToolBase):
         self._client_dispatch("vifs-in-redis")
         vif_count.assert_called_with()
 
+    @mock.patch("%s.index_vifs" % TOOL_MOD)
+    def test_dispatch_index_vifs(self, index_vifs):
+        self._client_dispatch("index-vifs")
+        index_vifs.assert_called_with()
+
     @mock.patch("%s.num_groups" % TOOL_MOD)
     def test_dispatch_num_groups(self, num_groups):
         self._client_dispatch("num-groups")
@@ -118,8 +122,17 @@ class QuarkRedisSgToolVifCount(QuarkRedisSgToolBase):
         get_conn.return_value = conn_mock
         cli = sg_client()
         cli.vif_count()
-        conn_mock.vif_keys.assert_called_with(
-            field=security_groups_client.SECURITY_GROUP_HASH_ATTR)
+        conn_mock.indexed_vif_count.assert_called_with()
+
+
+class QuarkRedisSgToolIndexVifs(QuarkRedisSgToolBase):
+    @mock.patch("%s._get_connection" % TOOL_MOD)
+    def test_index_vifs(self, get_conn):
+        conn_mock = mock.MagicMock()
+        get_conn.return_value = conn_mock
+        cli = sg_client()
+        cli.index_vifs()
+        conn_mock.rebuild_vif_index.assert_called_with()
 
 
 class QuarkRedisSgToolNumGroups(QuarkRedisSgToolBase):
@@ -164,7 +177,7 @@ class QuarkRedisSgToolPurgeOrphans(QuarkRedisSgToolBase):
             ctxt_mock = mock.MagicMock()
             get_admin_ctxt.return_value = ctxt_mock
             ports_with_groups_mock.all.return_value = ports
-            connection_mock.vif_keys.return_value = vifs
+            connection_mock.iter_indexed_vif_keys.return_value = vifs
             yield get_conn, connection_mock, db_ports_groups, ctxt_mock
 
     def test_purge_orphans_dry_run(self):
@@ -176,7 +189,7 @@ class QuarkRedisSgToolPurgeOrphans(QuarkRedisSgToolBase):
             get_conn.assert_called_with(use_master=False)
             connection_mock.vif_key.assert_any_call(1, 1)
             db_ports_groups.assert_called_with(ctxt_mock)
-            connection_mock.delete_key.assert_not_called()
+            connection_mock.delete_vif_key.assert_not_called()
 
     def test_purge_orphans(self):
         with self._stubs() as (get_conn, connection_mock, db_ports_groups,
@@ -187,8 +200,8 @@ class QuarkRedisSgToolPurgeOrphans(QuarkRedisSgToolBase):
             db_ports_groups.assert_called_with(ctxt_mock)
             get_conn.assert_called_with(use_master=True)
             connection_mock.vif_key.assert_any_call(1, 1)
-            connection_mock.delete_key.assert_any_call("2.2")
-            connection_mock.delete_key.assert_any_call("3.3")
+            connection_mock.delete_vif_key.assert_any_call("2.2")
+            connection_mock.delete_vif_key.assert_any_call("3.3")
 
     @mock.patch("time.sleep")
     def test_purge_orphans_raises(self, sleep):
@@ -197,7 +210,7 @@ class QuarkRedisSgToolPurgeOrphans(QuarkRedisSgToolBase):
         with self._stubs() as (get_conn, connection_mock, db_ports_groups,
                                ctxt_mock):
             redis_exc = q_exc.RedisConnectionFailure
-            connection_mock.delete_key.side_effect = redis_exc
+            connection_mock.delete_vif_key.side_effect = redis_exc
             cli = sg_client({"--retry-delay": retry_delay,
                              "--retries": retries})
             cli.purge_orphans(dryrun=False)
@@ -205,8 +218,8 @@ class QuarkRedisSgToolPurgeOrphans(QuarkRedisSgToolBase):
             db_ports_groups.assert_called_with(ctxt_mock)
             get_conn.assert_called_with(giveup=False, use_master=True)
             connection_mock.vif_key.assert_any_call(1, 1)
-            connection_mock.delete_key.assert_any_call("2.2")
-            connection_mock.delete_key.assert_any_call("3.3")
+            connection_mock.delete_vif_key.assert_any_call("2.2")
+            connection_mock.delete_vif_key.assert_any_call("3.3")
             sleep.assert_called_with(1)
 
 
@@ -241,7 +254,7 @@ class QuarkRedisSgToolWriteGroups(QuarkRedisSgToolBase):
             ctxt_mock = mock.MagicMock()
             get_admin_ctxt.return_value = ctxt_mock
             ports_with_groups_mock.all.return_value = port_mods
-            connection_mock.vif_keys.return_value = vifs
+            connection_mock.indexed_vif_count.return_value = len(vifs)
             connection_mock.serialize_rules.return_value = "rules"
             yield (get_conn, connection_mock, db_ports_groups, ctxt_mock,
                    sg_rule)
@@ -251,7 +264,7 @@ class QuarkRedisSgToolWriteGroups(QuarkRedisSgToolBase):
                                ctxt_mock, sg_rule):
             cli = sg_client()
             cli.write_groups(dryrun=True)
-            connection_mock.vif_keys.assert_called_with()
+            connection_mock.indexed_vif_count.assert_called_with()
             connection_mock.get_rules_for_port.assert_called_with(1, 1)
 
             self.assertTrue(get_conn.call_count, 1)
@@ -262,7 +275,7 @@ class QuarkRedisSgToolWriteGroups(QuarkRedisSgToolBase):
                                ctxt_mock, sg_rule):
             cli = sg_client()
             cli.write_groups(dryrun=False)
-            self.assertFalse(connection_mock.vif_keys.called)
+            self.assertFalse(connection_mock.indexed_vif_count.called)
             self.assertFalse(connection_mock.get_rules_for_port.called)
             self.assertFalse(connection_mock.get_rules_for_port.called)
             connection_mock.serialize_rules.assert_called_with([sg_rule])
@@ -283,7 +296,7 @@ class QuarkRedisSgToolWriteGroups(QuarkRedisSgToolBase):
             connection_mock.apply_rules.side_effect = redis_exc
 
             cli.write_groups(dryrun=False)
-            self.assertFalse(connection_mock.vif_keys.called)
+            self.assertFalse(connection_mock.indexed_vif_count.called)
             self.assertFalse(connection_mock.get_rules_for_port.called)
             self.assertFalse(connection_mock.get_rules_for_port.called)
             connection_mock.serialize_rules.assert_called_with([sg_rule])
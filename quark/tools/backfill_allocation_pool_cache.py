@@ -0,0 +1,58 @@
+"""
+Writes the allocation pool cache of every subnet whose cache is missing,
+was stamped by an older ALLOCATION_POOL_CACHE_VERSION or was computed from
+an older revision of the subnet's IP policy, so subnet listings are served
+straight from the cache. Safe to run against a live deployment.
+"""
+
+import sys
+
+from neutron.common import config
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark.db import api as db_api
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+backfill_opts = [
+    cfg.IntOpt("backfill_allocation_pool_cache_batch_size",
+               default=100,
+               help=_("Number of subnets whose allocation pool cache is "
+                      "rewritten in a single transaction"))
+]
+
+CONF.register_opts(backfill_opts, "QUARK")
+
+
+def main():
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+
+    context = neutron_context.get_admin_context()
+    count = backfill_allocation_pool_cache(
+        context, CONF.QUARK.backfill_allocation_pool_cache_batch_size)
+    LOG.info("Wrote the allocation pool cache of {0} subnet(s)".format(count))
+
+
+def backfill_allocation_pool_cache(context, batch_size):
+    count = 0
+    while True:
+        with context.session.begin():
+            subnets = db_api.subnet_find_stale_alloc_pool_cache(
+                context, limit=batch_size)
+            for subnet in subnets:
+                db_api.subnet_update_policy_caches(context, subnet)
+        count += len(subnets)
+        if not subnets or len(subnets) < batch_size:
+            return count
+
+
+if __name__ == "__main__":
+    main()
@@ -154,8 +154,7 @@ def _find_or_create_address(context, network_ids, address):
             version=subnet["ip_version"],
             network_id=subnet["network_id"],
             address_type=ip_types.FIXED)
-        address_model["deallocated"] = 1
-        context.session.add(address_model)
+        db_api.ip_address_deallocate(context, address_model)
     return address_model
 
 
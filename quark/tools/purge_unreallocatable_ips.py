@@ -0,0 +1,55 @@
+"""
+Purges deallocated IP addresses that IP reallocation will never claim:
+those outside the bounds of their subnet or excluded by its IP policy.
+Intended to be run periodically, out of band of the API.
+"""
+
+import sys
+
+from neutron.common import config
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark.db import api as db_api
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+purge_opts = [
+    cfg.IntOpt("purge_unreallocatable_ips_batch_size",
+               default=500,
+               help=_("Number of deallocated IP addresses purged in a "
+                      "single transaction"))
+]
+
+CONF.register_opts(purge_opts, "QUARK")
+
+
+def main():
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+
+    context = neutron_context.get_admin_context()
+    purged = purge_unreallocatable_ips(
+        context, CONF.QUARK.purge_unreallocatable_ips_batch_size)
+    LOG.info("Purged {0} unreallocatable IP address(es)".format(purged))
+
+
+def purge_unreallocatable_ips(context, batch_size):
+    total = 0
+    while True:
+        with context.session.begin():
+            purged = db_api.ip_address_purge_unreallocatable(
+                context, limit=batch_size)
+        total += purged
+        if purged < batch_size:
+            return total
+
+
+if __name__ == "__main__":
+    main()
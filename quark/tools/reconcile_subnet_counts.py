@@ -0,0 +1,59 @@
+"""
+Recounts the addresses in each subnet and corrects the denormalized
+allocated_count / deallocated_reusable_count columns used for subnet
+selection. Safe to run against a live deployment, e.g. from cron.
+"""
+
+import sys
+
+from neutron.common import config
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark.db import api as db_api
+from quark.db import models
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+reconcile_opts = [
+    cfg.IntOpt("reconcile_subnet_counts_batch_size",
+               default=100,
+               help=_("Number of subnets whose usage counts are recounted "
+                      "and locked in a single transaction"))
+]
+
+CONF.register_opts(reconcile_opts, "QUARK")
+
+
+def main():
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+
+    context = neutron_context.get_admin_context()
+    corrected = reconcile_subnet_counts(
+        context, CONF.QUARK.reconcile_subnet_counts_batch_size)
+    LOG.info("Corrected usage counts of {0} subnet(s)".format(
+        len(corrected)))
+
+
+def reconcile_subnet_counts(context, batch_size):
+    query = context.session.query(models.Subnet.id)
+    subnet_ids = [subnet_id for subnet_id, in query.order_by(models.Subnet.id)]
+
+    corrected = []
+    for i in xrange(0, len(subnet_ids), batch_size):
+        batch = subnet_ids[i:i + batch_size]
+        with context.session.begin():
+            corrected.extend(db_api.subnet_reconcile_usage_counts(
+                context, subnet_ids=batch))
+    return corrected
+
+
+if __name__ == "__main__":
+    main()
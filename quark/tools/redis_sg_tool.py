@@ -29,6 +29,7 @@ Options:
 Available commands are:
     redis_sg_tool test-connection
     redis_sg_tool vifs-in-redis
+    redis_sg_tool index-vifs
     redis_sg_tool num-groups
     redis_sg_tool ports-with-groups
     redis_sg_tool purge-orphans [--yarly]
@@ -88,6 +89,8 @@ class QuarkRedisTool(object):
             self.test_connection()
         elif command == "vifs-in-redis":
             self.vif_count()
+        elif command == "index-vifs":
+            self.index_vifs()
         elif command == "num-groups":
             self.num_groups()
         elif command == "ports-with-groups":
@@ -122,7 +125,11 @@ class QuarkRedisTool(object):
 
     def vif_count(self):
         client = self._get_connection()
-        print(len(client.vif_keys(field=sg_client.SECURITY_GROUP_HASH_ATTR)))
+        print(client.indexed_vif_count())
+
+    def index_vifs(self):
+        client = self._get_connection()
+        print("Indexed %d VIFs" % client.rebuild_vif_index())
 
     def num_groups(self):
         ctx = neutron.context.get_admin_context()
@@ -147,30 +154,27 @@ class QuarkRedisTool(object):
             print("Found %s ports with security groups" %
                   len(ports_with_groups))
 
-        # Pre-spin the list of orphans
-        vifs = {}
-        for vif in client.vif_keys():
-            vifs[vif] = False
-
-        if dryrun:
-            print("Found %d VIFs in Redis" % len(vifs))
-
-        # Pop off the ones we find in the database
-        for port in ports_with_groups:
-            vif_key = client.vif_key(port["device_id"], port["mac_address"])
-            vifs.pop(vif_key, None)
+        # Only the database side is held in memory, indexed VIF keys are
+        # streamed out of Redis and checked against it as they arrive
+        known_vifs = set(client.vif_key(port["device_id"],
+                                        port["mac_address"])
+                         for port in ports_with_groups)
 
         if dryrun:
-            print("Found %d orphaned VIF rule sets" % len(vifs))
             print('=' * 80)
 
-        for orphan in vifs.keys():
+        vif_count = orphan_count = 0
+        for orphan in client.iter_indexed_vif_keys():
+            vif_count += 1
+            if orphan in known_vifs:
+                continue
+            orphan_count += 1
             if dryrun:
                 print("VIF %s is orphaned" % orphan)
             else:
                 for retry in xrange(self._retries):
                     try:
-                        client.delete_key(orphan)
+                        client.delete_vif_key(orphan)
                         break
                     except q_exc.RedisConnectionFailure:
                         time.sleep(self._retry_delay)
@@ -178,6 +182,8 @@ class QuarkRedisTool(object):
                                                       giveup=False)
         if dryrun:
             print('=' * 80)
+            print("Found %d VIFs in Redis" % vif_count)
+            print("Found %d orphaned VIF rule sets" % orphan_count)
             print()
             print("Re-run with --yarly to apply changes")
 
@@ -199,7 +205,7 @@ class QuarkRedisTool(object):
                   len(ports_with_groups))
 
         if dryrun:
-            vifs = len(client.vif_keys())
+            vifs = client.indexed_vif_count()
             if vifs > 0:
                 print("There are %d VIFs with rules in Redis, some of which "
                       "may be overwritten!" % vifs)
@@ -0,0 +1,57 @@
+"""
+Recounts the IP availability materialized on each subnet and served by the
+ip_availability API, correcting any drift. Safe to run against a live
+deployment, e.g. from cron. Subnets that predate the materialized columns
+are counted on every request until this has run.
+"""
+
+import sys
+
+from neutron.common import config
+from neutron.db import api as neutron_db_api
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark.db import models
+from quark import ip_availability
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+refresh_opts = [
+    cfg.IntOpt("refresh_ip_availability_batch_size",
+               default=100,
+               help=_("Number of subnets whose IP availability is recounted "
+                      "and locked in a single transaction"))
+]
+
+CONF.register_opts(refresh_opts, "QUARK")
+
+
+def main():
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+
+    refreshed = refresh_ip_availability(
+        neutron_db_api.get_session(),
+        CONF.QUARK.refresh_ip_availability_batch_size)
+    LOG.info("Refreshed IP availability of {0} subnet(s)".format(refreshed))
+
+
+def refresh_ip_availability(session, batch_size):
+    query = session.query(models.Subnet.id)
+    subnet_ids = [subnet_id for subnet_id, in query.order_by(models.Subnet.id)]
+
+    refreshed = 0
+    for i in xrange(0, len(subnet_ids), batch_size):
+        refreshed += ip_availability.refresh_ip_availability(
+            session, subnet_ids[i:i + batch_size])
+    return refreshed
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Registers every associated floating IP with unicorn again, e.g. after
+unicorn lost its state. The request bodies are built from the database up
+front on the main thread; only the requests themselves are sent with
+bounded concurrency over the driver's keep-alive session. Registering an
+already known floating IP is up to unicorn to tolerate.
+"""
+
+import sys
+
+from neutron.common import config
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark.db import api as db_api
+from quark.db import ip_types
+from quark.drivers import unicorn_driver
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+
+def main():
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+
+    context = neutron_context.get_admin_context()
+    result = reregister_floating_ips(context, unicorn_driver.UnicornDriver())
+    LOG.info("Registered {0} floating ip(s), {1} failed: {2}".format(
+        result["registered"], len(result["failed"]),
+        ", ".join(result["failed"])))
+    if result["failed"]:
+        sys.exit(1)
+
+
+def _registrations(context):
+    flips = db_api.floating_ip_find(context, address_type=ip_types.FLOATING,
+                                    _deallocated=False)
+    for flip in flips:
+        if flip.ports and flip.fixed_ip:
+            yield flip, flip.ports[0], flip.fixed_ip
+
+
+def reregister_floating_ips(context, driver, concurrency=None):
+    return driver.register_floating_ips(_registrations(context),
+                                        concurrency=concurrency)
+
+
+if __name__ == "__main__":
+    main()